@@ -0,0 +1,344 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+The asynchronous batch HTTP client performs batch requests on a Twisted
+reactor, so that a batch round trip doesn't block the calling thread and
+many batches can be in flight at once over a pool of persistent
+connections.
+
+Batches are built and their subresponses decoded with the same `BatchRequest`
+and `Request` classes as the synchronous `batchhttp.client.BatchClient`,
+including the use of an `httplib2.Http` instance's cache and credentials.
+
+"""
+
+import logging
+from urlparse import urljoin
+import zlib
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import httplib2
+from twisted.internet import defer, protocol
+from twisted.python import failure
+from twisted.web.client import Agent, FileBodyProducer, ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+try:
+    from twisted.web.client import HTTPConnectionPool
+except ImportError:
+    # Twisted before 12.1 can't keep connections alive.
+    HTTPConnectionPool = None
+
+from batchhttp.client import BatchError, BatchRequest, NonBatchResponseError
+from batchhttp.client import PartialBatchError, authorize
+from batchhttp.multipart import MultipartFeedParser, ParserError, SharedHeaders
+from batchhttp.multipart import TRANSFER_ENCODINGS
+from batchhttp.twistedutil import BodyCollector
+
+log = logging.getLogger(__name__)
+
+
+class BatchResponseReceiver(protocol.Protocol):
+
+    """Receives the content of a batch response, dispatching each subresponse
+    to its callback as soon as it has arrived.
+
+    Once the batch response is complete, the `finished` Deferred is fired. If
+    the content is not a complete multipart response, or a callback raises
+    an exception, the rest of the batch response is ignored and `finished`
+    fails instead.
+
+    """
+
+    def __init__(self, batchrequest, http, response, finished):
+        self.batchrequest = batchrequest
+        self.http = http
+        self.parser = MultipartFeedParser(batchrequest.response_boundary(response),
+            batchrequest.spill_threshold)
+        self.shared = SharedHeaders()
+        self.finished = finished
+        self.error = None
+
+        encoding = response.get('content-encoding', '').lower()
+        if encoding == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            self.decoder = None
+
+    def feed(self, data):
+        try:
+            for part in self.shared.apply(self.parser.feed(data)):
+                self.batchrequest.dispatch_part(self.http, part)
+        except Exception:
+            self.error = failure.Failure()
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self.error is not None:
+            return
+        if self.decoder is not None:
+            data = self.decoder.decompress(data)
+        self.feed(data)
+
+    def connectionLost(self, reason):
+        if self.error is None:
+            if not reason.check(ResponseDone, PotentialDataLoss):
+                self.error = reason
+            elif self.decoder is not None:
+                self.feed(self.decoder.flush())
+        if self.error is None:
+            try:
+                self.parser.close()
+            except ParserError, exc:
+                self.error = failure.Failure(BatchError('Batch response was incomplete: %s' % (exc,)))
+
+        if self.error is not None:
+            self.finished.errback(self.error)
+        else:
+            self.finished.callback(None)
+
+
+class AsyncBatchClient(object):
+
+    """An HTTP client for performing batch HTTP requests without blocking on
+    a Twisted reactor.
+
+    `AsyncBatchClient` mirrors the `batch_request()`, `batch()` and
+    `complete_batch()` interface of `batchhttp.client.BatchClient`, but
+    `complete_batch()` returns a `Deferred` instead of waiting for the batch
+    response. As soon as it returns, another batch request can be opened::
+
+        client.batch_request()
+        client.batch({'uri': uri}, callback=handle_result)
+        d = client.complete_batch()
+
+    The `Deferred` fires once every subresponse has been given to its
+    callback. Subresponses are dispatched as they arrive, on the reactor
+    thread.
+
+    """
+
+    def __init__(self, endpoint=None, http=None, reactor=None, agent=None,
+                 persistent=True, transfer_encoding='quoted-printable',
+                 max_subrequests=None, max_batch_bytes=None):
+        """Configures the `AsyncBatchClient` instance to use the given batch
+        processor endpoint.
+
+        Parameter `endpoint` is the base URL of the batch processor, as for
+        `BatchClient`. Parameter `http` is the `httplib2.Http` instance whose
+        cache and credentials are used when building subrequests and decoding
+        subresponses; it is never used to make requests itself. If it's not
+        given, an `httplib2.Http` with no cache is used.
+
+        Batch requests are made with a `twisted.web.client.Agent` on
+        `reactor` (by default, the global reactor). Unless `persistent` is
+        false, the agent keeps its connections alive in an
+        `HTTPConnectionPool` for use by later batches. An `agent` to use
+        instead can also be provided.
+
+        Parameters `transfer_encoding`, `max_subrequests` and
+        `max_batch_bytes` are as for `BatchClient`. Batches that are split
+        into several batch requests have all of them in flight at once.
+
+        """
+        if transfer_encoding.lower() not in TRANSFER_ENCODINGS:
+            raise ValueError('Unsupported transfer encoding %r' % (transfer_encoding,))
+        if http is None:
+            http = httplib2.Http()
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.endpoint = endpoint
+        self.http = http
+        self.reactor = reactor
+        self.transfer_encoding = transfer_encoding
+        self.max_subrequests = max_subrequests
+        self.max_batch_bytes = max_batch_bytes
+        self.batch_extensions = {}
+
+        self.pool = None
+        if agent is None:
+            if HTTPConnectionPool is not None:
+                self.pool = HTTPConnectionPool(reactor, persistent=persistent)
+                agent = Agent(reactor, pool=self.pool)
+            else:
+                agent = Agent(reactor)
+        self.agent = agent
+
+    def batch_request(self, headers=None):
+        """Opens a batch request.
+
+        If a batch request is already open, a `BatchError` is raised. The
+        `headers` parameter is as for `BatchClient.batch_request()`.
+
+        """
+        if hasattr(self, 'batchrequest'):
+            raise BatchError("There's already an open batch request")
+        self.batchrequest = BatchRequest(headers=headers,
+            transfer_encoding=self.transfer_encoding,
+            max_subrequests=self.max_subrequests,
+            max_batch_bytes=self.max_batch_bytes,
+            extensions=self.batch_extensions.setdefault(self.endpoint, set()))
+        return self
+
+    def batch(self, reqinfo, callback=None):
+        """Adds the given subrequest to the open batch request.
+
+        The parameters are as for `BatchClient.batch()`; if `callback` is
+        omitted, a `batchhttp.client.BatchFuture` is returned. Its callbacks
+        run on the reactor thread, so don't wait on its `result()` there. If
+        no batch request is open, a `BatchError` is raised.
+
+        """
+        if not hasattr(self, 'batchrequest'):
+            raise BatchError("There's no open batch request to add an object to")
+        return self.batchrequest.add(reqinfo, callback)
+
+    def clear_batch(self):
+        """Closes a batch request without performing it."""
+        try:
+            del self.batchrequest
+        except AttributeError:
+            pass
+
+    def complete_batch(self):
+        """Closes a batch request and starts performing it.
+
+        Returns a `Deferred` that fires with ``None`` once all the
+        subresponses have been dispatched to their callbacks, or fails with
+        the `BatchError` (or exception raised by a callback) that stopped
+        them.
+
+        If no batch request is open, a `BatchError` is raised immediately.
+
+        """
+        if not hasattr(self, 'batchrequest'):
+            raise BatchError("There's no open batch request to complete")
+        if self.endpoint is None:
+            raise BatchError("There's no batch processor endpoint to which to send a batch request")
+        batchrequest = self.batchrequest
+        del self.batchrequest
+
+        def finish(result):
+            if batchrequest.cache is not None:
+                batchrequest.cache.flush()
+            if isinstance(result, failure.Failure):
+                batchrequest.fail_futures(result.value)
+            else:
+                batchrequest.fail_futures(BatchError('Batch response included no subresponse for the request'))
+            return result
+        return self._complete(batchrequest).addBoth(finish)
+
+    def _complete(self, batchrequest):
+        try:
+            log.debug('Making batch request for %d items' % len(batchrequest))
+            chunks = batchrequest.construct_chunks(self.http)
+            batchrequest.dispatch_fresh()
+        except Exception:
+            return defer.fail()
+        if not chunks:
+            return defer.succeed(None)
+
+        batch_url = urljoin(self.endpoint, '/batch-processor')
+        deferreds = [self.perform(batchrequest, batch_url, headers, body)
+            for headers, body in chunks]
+        if len(deferreds) == 1:
+            return deferreds[0]
+
+        def check(results):
+            errors = [result.value for success, result in results if not success]
+            if errors:
+                raise PartialBatchError(errors, len(results))
+        d = defer.DeferredList(deferreds, consumeErrors=True)
+        return d.addCallback(check)
+
+    def perform(self, batchrequest, batch_url, headers, body):
+        """Makes one batch HTTP request of `batchrequest` to `batch_url`,
+        returning a `Deferred` that fires once its subresponses have been
+        dispatched."""
+        if batchrequest.headers:
+            headers.update(batchrequest.headers)
+        headers = dict([(k.lower(), v) for k, v in headers.iteritems()])
+        if 'user-agent' not in headers:
+            headers['user-agent'] = 'Python-httplib2/%s' % httplib2.__version__
+        authorize(self.http, 'POST', batch_url, headers, body)
+        # The body producer gives the agent the length to send.
+        headers.pop('content-length', None)
+
+        d = self.agent.request('POST', batch_url,
+            Headers(dict([(k, [v]) for k, v in headers.iteritems()])),
+            FileBodyProducer(StringIO(body)))
+        return d.addCallback(self.handle_response, batchrequest)
+
+    def handle_response(self, response, batchrequest):
+        """Starts receiving the batch HTTP response `response` (a
+        `twisted.web.iweb.IResponse`) for `batchrequest`, returning a
+        `Deferred` that fires once its subresponses have been dispatched."""
+        info = dict([(k.lower(), ', '.join(v))
+            for k, v in response.headers.getAllRawHeaders()])
+        info['status'] = str(response.code)
+        httpresponse = httplib2.Response(info)
+        httpresponse.reason = response.phrase
+        batchrequest.note_extensions(httpresponse)
+
+        finished = defer.Deferred()
+        if response.code == 207:
+            try:
+                receiver = BatchResponseReceiver(batchrequest, self.http,
+                    httpresponse, finished)
+            except BatchError:
+                error = failure.Failure()
+            else:
+                response.deliverBody(receiver)
+                return finished
+        else:
+            error = failure.Failure(NonBatchResponseError(response.code, response.phrase))
+
+        # Read the rest of the response anyway, so the connection can be
+        # used again.
+        def fail(content):
+            log.debug('Received non-batch response %d %s with content:\n%s'
+                % (response.code, response.phrase, content))
+            return error
+        response.deliverBody(BodyCollector(finished))
+        return finished.addCallback(fail)
+
+    def close(self):
+        """Closes any persistent connections, returning a `Deferred` that
+        fires once they're closed."""
+        if self.pool is None:
+            return defer.succeed(None)
+        return self.pool.closeCachedConnections()
@@ -0,0 +1,192 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+The automatic batcher coalesces subrequests made independently, from any
+number of threads, into batch requests.
+
+Rather than opening and completing a batch request around a known set of
+subrequests, callers submit each subrequest to a shared `AutoBatcher` as they
+need it. Subrequests submitted within a short time of each other are sent in
+the same batch request, and each caller gets its own subresponse back::
+
+    batcher = AutoBatcher(client, max_wait=0.002, max_size=50)
+    response, content = batcher.submit({'uri': uri}).result()
+
+"""
+
+import logging
+import threading
+import time
+
+from batchhttp.client import BatchError
+
+log = logging.getLogger(__name__)
+
+
+class AutoBatcher(object):
+
+    """Gathers subrequests submitted from any thread into batch requests
+    performed by a `BatchClient`.
+
+    A batch request is started when the first subrequest is submitted, and
+    performed once it is `max_wait` seconds old or holds `max_size`
+    subrequests, whichever comes first. Batch requests are performed on
+    `concurrency` background threads, so while one is in flight the next one
+    is already being gathered.
+
+    """
+
+    def __init__(self, client, max_wait=0.002, max_size=100, concurrency=2,
+                 headers=None):
+        """Configures the `AutoBatcher` to perform batch requests with the
+        `BatchClient` `client`, and starts its threads.
+
+        The subrequests are performed with `client`'s connections, cache,
+        credentials and other options; `client` may still be used directly by
+        other code. Parameter `headers`
+        gives additional headers to send with every batch request, as for
+        `BatchClient.batch_request()`.
+
+        """
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.client = client
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.headers = headers
+
+        self._cond = threading.Condition()
+        self._batchrequest = None
+        self._deadline = None
+        self._ready = []
+        self._closed = False
+
+        self._threads = []
+        for i in range(concurrency):
+            thread = threading.Thread(target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, reqinfo, callback=None):
+        """Adds the given subrequest to the batch request being gathered.
+
+        The parameters are as for `BatchClient.batch()`: `callback` is held
+        only weakly, and if it is omitted a `batchhttp.client.BatchFuture` is
+        returned that resolves to the subresponse. As the batch request is
+        performed on another thread, `callback` is called on that thread.
+
+        If the `AutoBatcher` has been closed, a `BatchError` is raised.
+
+        """
+        self._cond.acquire()
+        try:
+            if self._closed:
+                raise BatchError('The AutoBatcher is closed')
+            if self._batchrequest is None:
+                self._batchrequest = self.client.new_batch_request(self.headers)
+                self._deadline = time.time() + self.max_wait
+                self._cond.notifyAll()
+            callback = self._batchrequest.add(reqinfo, callback)
+            if len(self._batchrequest.requests) >= self.max_size:
+                # Set it aside so the next subrequest starts a new batch.
+                self._ready.append(self._batchrequest)
+                self._batchrequest = None
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        return callback
+
+    def flush(self):
+        """Performs the batch request being gathered without waiting any
+        longer for more subrequests."""
+        self._cond.acquire()
+        try:
+            self._deadline = 0
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """Performs the batch request being gathered, if any, and stops the
+        `AutoBatcher`'s threads once they've finished their batch requests."""
+        self._cond.acquire()
+        try:
+            self._closed = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for thread in self._threads:
+            thread.join()
+
+    def _take(self):
+        # Wait for a batch request to become due, returning None if closed.
+        self._cond.acquire()
+        try:
+            while True:
+                if self._ready:
+                    return self._ready.pop(0)
+                if self._batchrequest is None:
+                    if self._closed:
+                        return None
+                    self._cond.wait()
+                    continue
+                if self._closed:
+                    break
+                remaining = self._deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batchrequest, self._batchrequest = self._batchrequest, None
+            return batchrequest
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        while True:
+            batchrequest = self._take()
+            if batchrequest is None:
+                return
+            self.perform(batchrequest)
+
+    def perform(self, batchrequest):
+        """Performs the `batchhttp.client.BatchRequest` `batchrequest`.
+
+        Failures are logged, and given to the `BatchFuture` instances of the
+        subrequests.
+
+        """
+        log.debug('Making automatic batch request for %d items'
+            % len(batchrequest.requests))
+        try:
+            self.client.process_batch(batchrequest)
+        except Exception:
+            log.exception('Automatic batch request failed')
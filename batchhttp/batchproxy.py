@@ -28,7 +28,9 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 from twisted.internet import reactor, defer
-from twisted.web import proxy, server, http
+from twisted.web import proxy, resource, server, http
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool
+from twisted.web.http_headers import Headers
 from twisted.internet import interfaces
 from twisted.python import log
 from zope.interface import implements
@@ -42,9 +44,14 @@ from email.MIMEMessage import MIMEMessage
 from email.Message import Message
 import urlparse
 import base64
-import sys
+from collections import deque
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import zlib
 from batchhttp import multipart
-log.startLogging(sys.stdout)
+from batchhttp.twistedutil import BodyCollector
 
 from twisted.internet.protocol import Factory
 Factory.noisy = False # stfu.
@@ -58,70 +65,452 @@ class StringTransport(http.StringTransport):
         pass
 
 
-class BatchProxyClient(proxy.ProxyClient):
-    def __init__(self, deferred, command, rest, version, headers, data, father):
-        self.father = father
-        self.command = command
-        self.rest = rest
-        headers.append(('connection', 'close'))
-        self.headers = headers
-        self.data = data
-        self.deferred = deferred
+# Seconds after which clients are told to retry shed subrequests and batches.
+RETRY_AFTER = 5
+
+# Headers that describe a single connection, which aren't forwarded.
+HOP_BY_HOP = ('connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+              'transfer-encoding', 'upgrade')
+
+
+def end_to_end(headers):
+    """
+    Return the (name, value) pairs of `headers` that aren't hop-by-hop:
+    neither one of `HOP_BY_HOP` nor named in a Connection header.
+    """
+    hop_by_hop = set(HOP_BY_HOP)
+    for name, value in headers:
+        if name.lower() == 'connection':
+            hop_by_hop.update(token.strip().lower() for token in value.split(','))
+    return [(name, value) for name, value in headers
+            if name.lower() not in hop_by_hop]
+
+
+class BackendPool(HTTPConnectionPool):
+
+    """A pool of persistent HTTP/1.1 connections to the backend server,
+    shared by all the batches a `BatchProxyResource` processes.
+
+    Up to `maxPersistentPerHost` idle connections are kept, each for at most
+    `cachedConnectionTimeout` seconds. A pooled connection is checked before
+    it's reused, and is discarded if the server has since closed it; an
+    idempotent subrequest that fails on a reused connection before any
+    response arrives is retried once on a new one.
+
+    The pool counts the subrequests that reused a connection (`hits`), those
+    that had to open one (`misses`), and the pooled connections found dead
+    when they were wanted (`discarded`).
+
+    """
+
+    def __init__(self, reactor, max_idle=16, idle_timeout=60):
+        HTTPConnectionPool.__init__(self, reactor, persistent=True)
+        self.maxPersistentPerHost = max_idle
+        self.cachedConnectionTimeout = idle_timeout
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+
+    def healthy(self, connection):
+        """Returns whether the pooled `connection` can take another request."""
+        transport = connection.transport
+        return (connection.state == 'QUIESCENT' and transport is not None
+                and not getattr(transport, 'disconnecting', False))
+
+    def getConnection(self, key, endpoint):
+        connections = self._connections.get(key)
+        while connections:
+            if self.healthy(connections[0]):
+                self.hits += 1
+                return HTTPConnectionPool.getConnection(self, key, endpoint)
+            connection = connections.pop(0)
+            self._timeouts.pop(connection).cancel()
+            if connection.transport is not None:
+                connection.transport.loseConnection()
+            self.discarded += 1
+        self.misses += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def stats(self):
+        """Returns a dictionary of the pool's counters and the number of
+        connections idle in it."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'discarded': self.discarded,
+            'idle': sum([len(c) for c in self._connections.values()]),
+        }
+
+
+class OverloadedError(Exception):
+    """The subrequest was shed because its queue was overloaded."""
+
 
-    def connectionMade(self):
-        self.sendCommand(self.command, self.rest)
-        for header, value in self.headers:
-            self.sendHeader(header, value)
-        self.endHeaders()
-        self.transport.write(self.data)
+# The turn of no flow in a SubrequestQueue, as None is a flow of its own.
+NO_TURN = object()
+# The place of the fast lane in the round-robin.
+FAST_LANE = object()
 
-    def handleResponseEnd(self):
-        self.transport.loseConnection()
-        self.deferred.callback("response generated")
 
+class SubrequestQueue(object):
 
-class BatchProxyClientFactory(proxy.ProxyClientFactory):
-    protocol = BatchProxyClient
+    """Limits the number of subrequests being forwarded at once to `limit`,
+    sharing out the free slots fairly between the flows waiting for them.
 
-    def __init__(self, *args, **kwargs):
-        proxy.ProxyClientFactory.__init__(self, *args, **kwargs)
-        self.deferred = defer.Deferred()
+    Each subrequest belongs to a flow, such as the client that sent its
+    batch. Waiting flows are served by deficit round-robin: each turn, a flow
+    may forward up to `quantum` subrequests times its weight from `weights`
+    (1 if it has none), so one flow's huge batch can't hold up the others.
+    Subrequests marked `fast` (those of small, interactive batches) share a
+    fast lane, which takes turns in the round-robin like a flow with the
+    weight `fast_weight`, but goes next whenever it has been idle. So small
+    batches don't wait behind big ones, yet a client sending nothing but
+    small batches gets no more than the fast lane's share. The quantum and
+    weights must be positive, or a `ValueError` is raised.
 
-    def buildProtocol(self, addr):
-        return self.protocol(self.deferred, self.command, self.rest, self.version,
-                             self.headers, self.data, self.father)
+    A queue may have a `parent`, such as a global queue shared by the queues
+    of several backends, in which case a subrequest also waits its turn in
+    the parent before it's forwarded.
 
-    def clientConnectionFailed(self, connector, reason):
-        proxy.ProxyClientFactory.clientConnectionFailed(self, connector, reason)
-        self.deferred.errback(reason)
+    If more than `max_queued` subrequests stay waiting for `overload_timeout`
+    seconds, the queue is overloaded: the most recently queued subrequests
+    of the longest flows are shed until `max_queued` are left, failing with
+    an `OverloadedError`, and so are any more that arrive, until the queue
+    has drained to half of `max_queued`. `overloaded()` is true meanwhile. If
+    `max_queued` is ``None``, nothing is ever shed.
+
+    """
+
+    def __init__(self, limit, parent=None, max_queued=None, overload_timeout=5,
+                 reactor=reactor, quantum=1, weights=None, fast_weight=2):
+        if quantum <= 0:
+            raise ValueError('quantum must be positive')
+        if fast_weight <= 0:
+            raise ValueError('fast_weight must be positive')
+        for flow, weight in (weights or {}).items():
+            if not weight > 0:
+                raise ValueError('Weight of flow %r must be positive' % (flow,))
+        self.limit = limit
+        self.parent = parent
+        self.max_queued = max_queued
+        self.overload_timeout = overload_timeout
+        self.reactor = reactor
+        self.quantum = quantum
+        self.weights = weights or {}
+        self.fast_weight = fast_weight
+        self.active = 0
+        self.queued = 0
+        self.fast = deque()
+        self.flows = {}
+        self.deficits = {}
+        self.rotation = deque()
+        self._turn = NO_TURN
+        self.is_overloaded = False
+        self.peak_queued = 0
+        self.shed = 0
+        self._overload_call = None
+
+    def overloaded(self):
+        """Returns whether this queue or its parent is overloaded."""
+        if self.parent is not None and self.parent.overloaded():
+            return True
+        return self.is_overloaded
+
+    def _enqueue(self, d, flow, fast):
+        if fast:
+            if not self.fast:
+                # The fast lane goes next: after the flow having its turn,
+                # or first if none is.
+                self.deficits[FAST_LANE] = 0
+                if self.rotation and self._turn == self.rotation[0]:
+                    self.rotation.insert(1, FAST_LANE)
+                else:
+                    self.rotation.appendleft(FAST_LANE)
+            self.fast.append(d)
+        elif flow in self.flows:
+            self.flows[flow].append(d)
+        else:
+            self.flows[flow] = deque([d])
+            self.deficits[flow] = 0
+            self.rotation.append(flow)
+        self.queued += 1
+
+    def _waiting(self, flow):
+        if flow is FAST_LANE:
+            return self.fast
+        return self.flows[flow]
+
+    def _drop_flow(self, flow):
+        if flow is not FAST_LANE:
+            del self.flows[flow]
+        del self.deficits[flow]
+        self.rotation.remove(flow)
+        if self._turn == flow:
+            self._turn = NO_TURN
+
+    def _dequeue(self):
+        # Returns the next waiting Deferred to fire.
+        self.queued -= 1
+        while True:
+            flow = self.rotation[0]
+            if self._turn != flow:
+                # The flow's turn begins, adding its quantum to its deficit.
+                self._turn = flow
+                if flow is FAST_LANE:
+                    weight = self.fast_weight
+                else:
+                    weight = self.weights.get(flow, 1)
+                self.deficits[flow] += self.quantum * weight
+            if self.deficits[flow] >= 1:
+                self.deficits[flow] -= 1
+                waiting = self._waiting(flow)
+                d = waiting.popleft()
+                if not waiting:
+                    self._drop_flow(flow)
+                return d
+            self.rotation.rotate(-1)
+            self._turn = NO_TURN
+
+    def _shed_one(self):
+        # Sheds the newest subrequest of the longest flow, or of the fast
+        # lane if no flow is waiting.
+        if self.flows:
+            flow = max([flow for flow in self.rotation if flow is not FAST_LANE],
+                       key=lambda flow: len(self.flows[flow]))
+        else:
+            flow = FAST_LANE
+        waiting = self._waiting(flow)
+        d = waiting.pop()
+        if not waiting:
+            self._drop_flow(flow)
+        self.queued -= 1
+        self.shed += 1
+        d.errback(OverloadedError('Too many subrequests waiting to be forwarded'))
+
+    def _queue_changed(self):
+        self.peak_queued = max(self.peak_queued, self.queued)
+        if self.is_overloaded:
+            while self.queued > self.max_queued:
+                self._shed_one()
+            if self.queued <= self.max_queued // 2:
+                self.is_overloaded = False
+        elif self.max_queued is None or self.queued <= self.max_queued:
+            if self._overload_call is not None:
+                self._overload_call.cancel()
+                self._overload_call = None
+        elif self._overload_call is None:
+            self._overload_call = self.reactor.callLater(self.overload_timeout,
+                                                         self._overloading)
+
+    def _overloading(self):
+        # The queue has been over its threshold for overload_timeout seconds.
+        self._overload_call = None
+        self.is_overloaded = True
+        self._queue_changed()
+
+    def acquire(self, flow=None, fast=False):
+        """Returns a Deferred that fires when a subrequest of `flow` may be
+        forwarded, which must be followed by a call to `release()`."""
+        if self.active < self.limit and not self.queued:
+            self.active += 1
+            return defer.succeed(self)
+        d = defer.Deferred()
+        self._enqueue(d, flow, fast)
+        self._queue_changed()
+        return d
+
+    def release(self):
+        """Lets the next queued subrequest be forwarded."""
+        self.active -= 1
+        while self.queued and self.active < self.limit:
+            self.active += 1
+            self._dequeue().callback(self)
+        self._queue_changed()
+
+    def run(self, f, *args, **kwargs):
+        """Calls `f` with the given arguments once this queue (and its
+        parent's) let it, returning a Deferred that fires with its result.
+        The keyword arguments `flow` and `fast` are given to `acquire()`."""
+        flow = kwargs.pop('flow', None)
+        fast = kwargs.pop('fast', False)
+        def acquired(ignored):
+            if self.parent is not None:
+                d = self.parent.run(f, flow=flow, fast=fast, *args, **kwargs)
+            else:
+                d = defer.maybeDeferred(f, *args, **kwargs)
+            return d.addBoth(released)
+        def released(result):
+            self.release()
+            return result
+        return self.acquire(flow, fast).addCallback(acquired)
+
+    def stats(self):
+        """Returns a dictionary of the queue's current depth and counters."""
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'flows': len(self.flows),
+            'peak_queued': self.peak_queued,
+            'shed': self.shed,
+            'overloaded': self.overloaded(),
+        }
 
 
 class BatchRequest(object):
-    def __init__(self, host, port, request, reactor=reactor):
+    def __init__(self, host, port, request, agent):
         self.host = host
         self.port = port
         self.request = request
-        self.reactor = reactor
+        self.agent = agent
         self.transport = StringTransport()
+        # Seconds the subrequest waited in the queue before it was forwarded.
+        self.wait = None
 
     def process(self):
         """
-        Render a request by forwarding it to the proxied server.
+        Render a request by forwarding it to the proxied server over one of
+        the agent's pooled connections. The response is written to the
+        `transport` as the text of an HTTP response message.
         """
-        client_factory = BatchProxyClientFactory(self.request.command, self.request.path, 
-                                                 self.request.version, self.request.headers, 
-                                                 self.request.data, self)
-        self.reactor.connectTCP(self.host, self.port, client_factory)
-        return client_factory.deferred
+        headers = Headers()
+        for header, value in end_to_end(self.request.headers):
+            if header.lower() != 'content-length':
+                headers.addRawHeader(header, value)
+        producer = None
+        if self.request.data:
+            producer = FileBodyProducer(StringIO(self.request.data))
+        url = 'http://%s:%d%s' % (self.host, self.port, self.request.path)
+        d = self.agent.request(self.request.command, url, headers, producer)
+        d.addCallback(self.read_response)
+        d.addCallbacks(self.write_response, self.write_error)
+        return d
+
+    def read_response(self, response):
+        finished = defer.Deferred()
+        response.deliverBody(BodyCollector(finished))
+        return finished.addCallback(lambda body: (response, body))
+
+    def write_response(self, result):
+        response, body = result
+        lines = ["%s/%d.%d %d %s" % (response.version + (response.code, response.phrase))]
+        headers = end_to_end([(header, value) for header, values
+                              in response.headers.getAllRawHeaders()
+                              for value in values])
+        lines.extend(["%s: %s" % header for header in headers])
+        # The backend's Content-Length is kept, as for a HEAD request or a
+        # response that can't have a body it isn't the length of the body.
+        # A de-chunked body gets one of its own.
+        bodiless = (self.request.command == 'HEAD'
+                    or response.code in (204, 304) or 100 <= response.code < 200)
+        if not bodiless and not response.headers.hasHeader('content-length'):
+            lines.append("Content-Length: %d" % len(body))
+        self.transport.write(CRLF.join(lines) + CRLF + CRLF + body)
+
+    def write_unavailable(self, reason):
+        reason.trap(OverloadedError)
+        self.transport.write("HTTP/1.1 503 Service Unavailable" + CRLF
+                             + "Retry-After: %d" % RETRY_AFTER + CRLF
+                             + "Content-Length: 0" + CRLF + CRLF)
+
+    def write_error(self, reason):
+        log.msg('Could not forward subrequest to %s:%d: %s'
+                % (self.host, self.port, reason.getErrorMessage()))
+        self.transport.write("HTTP/1.1 502 Bad Gateway" + CRLF
+                             + "Content-Length: 0" + CRLF + CRLF)
+
+
+class StatsResource(resource.Resource):
+
+    """Serves the `BatchProxyResource.stats()` of a batch proxy as JSON."""
+
+    isLeaf = True
+
+    def __init__(self, batch_proxy):
+        resource.Resource.__init__(self)
+        self.batch_proxy = batch_proxy
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        request.setHeader('cache-control', 'no-cache')
+        return json.dumps(self.batch_proxy.stats(), sort_keys=True)
 
 
 class BatchProxyResource(proxy.ReverseProxyResource):
     response_code = http.MULTI_STATUS
     server = 'BatchProxy/0.1'
 
-    def __init__(self, host, port, batch_path):
-        proxy.ReverseProxyResource.__init__(self, host, port, '')
+    def __init__(self, host, port, batch_path, transfer_encoding=None,
+                 max_connections=16, idle_timeout=60, reactor=reactor, agent=None,
+                 streaming=False, global_queue=None, max_queued=None,
+                 overload_timeout=5, stats_path=None, client_header='batch-client',
+                 client_weights=None, small_batch=8):
+        """Configures the batch proxy to forward subrequests to the server at
+        `host` and `port`, and to process batches posted to `batch_path`.
+
+        Subresponses are sent with the Content-Transfer-Encoding named by
+        `transfer_encoding`. If it is ``None``, each subresponse is sent in
+        the same encoding as its subrequest, so clients that send binary or
+        8bit subrequests get their subresponses that way too.
+
+        Subrequests are forwarded over persistent connections from a
+        `BackendPool` shared by all batches. At most `max_connections`
+        subrequests are forwarded at once, and connections left idle for
+        `idle_timeout` seconds are closed. An `agent` to forward subrequests
+        with may be given instead, in which case `pool` is ``None``.
+
+        Subrequests waiting to be forwarded are held in a `SubrequestQueue`.
+        A `global_queue` shared with the resources for other backends may be
+        given to limit the subrequests forwarded to all of them at once too.
+        When more than `max_queued` subrequests have been waiting for
+        `overload_timeout` seconds, the excess get ``503 Service
+        Unavailable`` subresponses, and new batches get a ``503`` batch
+        response until the queue has drained. If `stats_path` is given, the
+        queue and pool metrics are served as JSON there (see `stats()`).
+
+        Queued subrequests are forwarded fairly between the clients whose
+        batches are waiting, so one client's huge batch doesn't hold up the
+        others' (see `SubrequestQueue`). Clients are told apart by the
+        request header named by `client_header`, or by address if they don't
+        send it, and may be given more of the backend with `client_weights`,
+        a mapping of client to weight. Batches of up to `small_batch`
+        subrequests go in the queue's fast lane, ahead of the larger ones
+        but not to their exclusion (see `SubrequestQueue`). How long each
+        batch waited for the backend is logged, counted in `stats()`, and
+        sent in a ``Batch-Queue-Wait`` header when the response isn't
+        `streaming`.
+
+        If `streaming` is true, the batch response is sent in the chunked
+        Transfer-Encoding as soon as the batch request is read, and each
+        subresponse is written to it, and let go of, as soon as it's complete
+        (see `stream_batch()`).
+
+        """
+        proxy.ReverseProxyResource.__init__(self, host, port, '', reactor)
         self.batch_path = batch_path
+        self.transfer_encoding = transfer_encoding
+        self.pool = None
+        if agent is None:
+            self.pool = BackendPool(reactor, max_connections, idle_timeout)
+            agent = Agent(reactor, pool=self.pool)
+        self.agent = agent
+        self.queue = SubrequestQueue(max_connections, global_queue, max_queued,
+                                     overload_timeout, reactor, weights=client_weights)
+        self.stats_path = stats_path
+        self.client_header = client_header
+        self.small_batch = small_batch
+        self.shed_batches = 0
+        self.waited_batches = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.streaming = streaming
+
+    def response_encoding(self, request):
+        if self.transfer_encoding is not None:
+            return self.transfer_encoding
+        encoding = (request.transfer_encoding or '').lower()
+        if encoding in multipart.TRANSFER_ENCODINGS:
+            return encoding
+        return 'quoted-printable'
 
     def getChild(self, path, request):
         # Set x-forwarded-host before the request is sent to the application server.
@@ -129,15 +518,23 @@ class BatchProxyResource(proxy.ReverseProxyResource):
 
         if path == self.batch_path:
             return self
+        elif self.stats_path is not None and path == self.stats_path:
+            return StatsResource(self)
         else:
             return proxy.ReverseProxyResource(self.host, self.port, '/' + quote(path, safe=""))
 
     def parse_batch_request(self, request):
+        """Parses the subrequests out of the batch request `request`,
+        inflating its body first if it has ``Content-Encoding: gzip``."""
         message = StringIO()
         message.write("Content-type: %s%s" % (request.received_headers['content-type'], CRLF))
         message.write("Mime-version: %s%s" % (request.received_headers.get('mime-version', 1.0), CRLF))
         request.content.seek(0, 0)
-        message.write(request.content.read())
+        content = request.content.read()
+        encoding = request.received_headers.get('content-encoding', '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            content = multipart.gunzip(content)
+        message.write(content)
         message.seek(0, 0)
         parser = multipart.HTTPParser(message)
 
@@ -146,37 +543,213 @@ class BatchProxyResource(proxy.ReverseProxyResource):
             request.headers = [header for header in request.headers if header[0].lower() not in ('connection', 'proxy-connection')]
         return requests
 
-    def render_batch(self, results, requests, client):
-        message = multipart.MultipartHTTPMessage()
-        for batch_request, response in zip(requests, results):
+    def accepts_shared_headers(self, request):
+        """Returns whether the batch request `request` offered the
+        ``shared-headers`` extension, so its batch response may declare
+        headers common to all its subresponses once."""
+        extensions = request.received_headers.get('batch-extensions', '')
+        return multipart.SHARED_HEADERS_EXTENSION in [ext.strip().lower()
+            for ext in extensions.split(',')]
+
+    def response_parts(self, requests, shared_headers=False):
+        """Returns a `multipart.MultipartWriter` holding the subresponses of
+        the proxied `requests`. If `shared_headers` is true, headers all the
+        subresponses have in common are moved into a shared headers part."""
+        texts = []
+        for batch_request in requests:
             batch_request.transport.seek(0,0)
-            message.attach(multipart.HTTPResponseMessage(batch_request.transport.getvalue(), batch_request.request.request_id))
-        message_string = message.as_string(write_headers=False)
-        headers = CRLF.join((
-            "%s %s %s" % (http.protocol_version, 
-                          self.response_code, 
-                          http.responses[self.response_code]),
-            "Date: %s" % http.datetimeToString(),
-            "Server: %s" % self.server,
-            "Allow: POST",
-            "Content-length: %s" % len(message_string),
-            "Content-type: %s" % message.get('content-type'),
-            "Mime-version: %s" % message.get('mime-version', 1.0),
-        ))
-        client.transport.write(headers)
-        client.transport.write(CRLF)
-        client.transport.write(CRLF)
-        client.transport.write(message_string)
-        client.channel.transport.loseConnection()
+            texts.append(batch_request.transport.getvalue())
+
+        writer = multipart.MultipartWriter()
+        if shared_headers:
+            responses = []
+            for text in texts:
+                try:
+                    responses.append(multipart.HTTPResponse(text))
+                except multipart.BadResponseException:
+                    responses = []
+                    break
+            shared = multipart.common_headers([r.headers for r in responses])
+            if shared:
+                writer.add(multipart.SharedHeadersPart(shared))
+                common = set(shared)
+                for i, (text, response) in enumerate(zip(texts, responses)):
+                    lines = [text[:text.find(CRLF)]]
+                    lines.extend(["%s: %s" % (header, value) for header, value
+                        in response.headers if (header, value) not in common])
+                    texts[i] = CRLF.join(lines) + CRLF + CRLF + response.data
+
+        for batch_request, text in zip(requests, texts):
+            writer.add(multipart.HTTPResponsePart(text, batch_request.request.request_id,
+                self.response_encoding(batch_request.request)))
+        return writer
+
+    def start_response(self, client, writer, length=None):
+        """Sets the status and headers of the batch response to `client`,
+        whose body is the multipart body of `writer`. If `length` isn't
+        given, the body is sent in the chunked Transfer-Encoding."""
+        message_headers = writer.headers()
+        client.setResponseCode(self.response_code)
+        client.setHeader('server', self.server)
+        client.setHeader('allow', 'POST')
+        client.setHeader('batch-extensions', multipart.SHARED_HEADERS_EXTENSION)
+        client.setHeader('content-type', message_headers['Content-Type'])
+        client.setHeader('mime-version', message_headers['MIME-Version'])
+        if length is not None:
+            client.setHeader('content-length', str(length))
+
+    def render_batch(self, results, requests, client, lost=()):
+        """Sends the whole batch response to `client` once all the proxied
+        `requests` are complete. The response is finished like any other, so
+        the client's connection is kept alive for its next batch if it can
+        be. Nothing is sent if `lost` says the client has gone."""
+        wait = self.batch_wait(requests)
+        if lost:
+            return
+        writer = self.response_parts(requests, self.accepts_shared_headers(client))
+        self.start_response(client, writer, writer.length)
+        client.setHeader('batch-queue-wait', '%.3f' % wait)
+        for chunk in writer.iterchunks():
+            client.write(chunk)
+        client.finish()
+
+    def stream_batch(self, requests, client, lost=(), flow=None, fast=False):
+        """Sends the batch response to `client` part by part, writing each
+        subresponse of the proxied `requests` as soon as it has been received,
+        in the order they complete.
+
+        The multipart boundary has to be picked before any subresponse is
+        seen, so a subresponse that happens to contain it is sent in the
+        ``base64`` Content-Transfer-Encoding instead. Headers aren't shared
+        between subresponses when streaming. Once `lost` says the client has
+        gone, nothing more is written. The subrequests are queued as
+        belonging to `flow`, and ahead of others if `fast`.
+
+        """
+        writer = multipart.MultipartWriter()
+        self.start_response(client, writer)
+        client.write(writer.preamble + '\n')
+
+        def write_part(result, batch_request):
+            text = batch_request.transport.getvalue()
+            # Let the subresponse go as soon as it's written.
+            batch_request.transport = None
+            if lost:
+                return
+            subrequest = batch_request.request
+            part = multipart.HTTPResponsePart(text, subrequest.request_id,
+                self.response_encoding(subrequest))
+            if part.contains_boundary(writer.boundary):
+                part = multipart.HTTPResponsePart(text, subrequest.request_id, 'base64')
+            for chunk in writer.part_chunks(part):
+                client.write(chunk)
+
+        def write_failed(reason, batch_request):
+            # Answer with a 502 rather than leave the subresponse out, should
+            # it fail to be written.
+            batch_request.transport = StringTransport()
+            batch_request.write_error(reason)
+            write_part(None, batch_request)
+
+        def finish(results):
+            self.batch_wait(requests)
+            if not lost:
+                client.write(writer.closing())
+                client.finish()
+
+        deferreds = []
+        for batch_request in requests:
+            d = self.forward(batch_request, flow, fast)
+            d.addCallback(write_part, batch_request)
+            deferreds.append(d.addErrback(write_failed, batch_request))
+        defer.DeferredList(deferreds, consumeErrors=True).addCallback(finish)
+
+    def forward(self, batch_request, flow=None, fast=False):
+        """Forwards the subrequest of `batch_request` once the queue lets it,
+        answering it with a ``503`` if it's shed instead, or a ``502`` if it
+        fails any other way. The subrequest is queued as belonging to `flow`,
+        and ahead of others if `fast`."""
+        queued = self.reactor.seconds()
+        def process():
+            batch_request.wait = self.reactor.seconds() - queued
+            return batch_request.process()
+        d = self.queue.run(process, flow=flow, fast=fast)
+        d.addErrback(batch_request.write_unavailable)
+        return d.addErrback(batch_request.write_error)
+
+    def batch_flow(self, request):
+        """Returns the flow the subrequests of the batch request `request`
+        are queued in: the client named in its `client_header` header, or
+        else the client's address."""
+        client = request.received_headers.get(self.client_header)
+        if client:
+            return client.strip()
+        return request.getClientIP()
+
+    def batch_wait(self, requests):
+        """Records and returns the longest time any of the proxied `requests`
+        of a batch waited in the queue, in seconds."""
+        waits = [r.wait for r in requests if r.wait is not None]
+        wait = max(waits or [0.0])
+        self.waited_batches += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        log.msg('Batch of %d subrequests waited %.3fs for the backend'
+                % (len(requests), wait))
+        return wait
+
+    def stats(self):
+        """Returns a dictionary of metrics for tuning the proxy: the depth and
+        counters of the subrequest queue and of any global queue, the
+        connection pool's counters, the number of batches turned away, and
+        how long batches have waited for the backend."""
+        stats = {
+            'queue': self.queue.stats(),
+            'shed_batches': self.shed_batches,
+            'batch_wait': {
+                'batches': self.waited_batches,
+                'mean': self.total_wait / max(self.waited_batches, 1),
+                'max': self.max_wait,
+            },
+        }
+        if self.queue.parent is not None:
+            stats['global_queue'] = self.queue.parent.stats()
+        if self.pool is not None:
+            stats['pool'] = self.pool.stats()
+        return stats
 
     def render(self, request):
         if request.method.lower() != 'post':
             from twisted.web.server import UnsupportedMethod
             raise UnsupportedMethod(('POST',))
 
-        batch_requests = [BatchRequest(self.host, self.port, r) for r in self.parse_batch_request(request)]
-        deferreds = [r.process() for r in batch_requests]
-        defer.DeferredList(deferreds, consumeErrors=True).addCallback(self.render_batch, batch_requests, request)
+        if self.queue.overloaded():
+            # Turn the whole batch away rather than queue still more.
+            self.shed_batches += 1
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            request.setHeader('retry-after', str(RETRY_AFTER))
+            request.setHeader('content-type', 'text/plain')
+            return 'Too many subrequests are waiting to be forwarded.\n'
+
+        try:
+            subrequests = self.parse_batch_request(request)
+        except (zlib.error, IOError):
+            request.setResponseCode(http.BAD_REQUEST)
+            request.setHeader('content-type', 'text/plain')
+            return 'The batch request body is not valid gzip data.\n'
+        batch_requests = [BatchRequest(self.host, self.port, r, self.agent)
+                          for r in subrequests]
+        # The reason the client went away, if it goes before its response is
+        # finished.
+        lost = []
+        request.notifyFinish().addErrback(lost.append)
+        flow = self.batch_flow(request)
+        fast = len(batch_requests) <= self.small_batch
+        if self.streaming:
+            self.stream_batch(batch_requests, request, lost, flow, fast)
+            return server.NOT_DONE_YET
+        deferreds = [self.forward(r, flow, fast) for r in batch_requests]
+        defer.DeferredList(deferreds, consumeErrors=True).addCallback(self.render_batch, batch_requests, request, lost)
         return server.NOT_DONE_YET
 
 
@@ -202,6 +775,7 @@ if __name__ == '__main__':
         else:
             remote_port = 8000
 
+    log.startLogging(sys.stdout)
     site = server.Site(BatchProxyResource(remote_host, remote_port, 'batch-processor'))
     reactor.listenTCP(port, site, interface=iface)
     reactor.run()
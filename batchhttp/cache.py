@@ -0,0 +1,381 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+Cache backends for the batch HTTP client.
+
+Both backends can be given as the `cache` of a `batchhttp.client.BatchClient`
+(or any `httplib2.Http`) in place of an `httplib2.FileCache`. Besides the
+`get()`, `set()` and `delete()` methods `httplib2` uses, they provide
+`get_many()` and `set_many()`, with which a batch request reads and writes the
+cache entries of all its subrequests at once, and count their hits and misses
+(see `stats()`).
+
+`MemoryCache` keeps a bounded number of entries in the process's memory.
+`SQLiteCache` keeps them in a SQLite database file that any number of
+processes can share.
+
+"""
+
+import threading
+import time
+try:
+    import sqlite3
+except ImportError:
+    # Python before 2.5 has no sqlite3.
+    sqlite3 = None
+
+
+class CacheStats(object):
+
+    """Counts the hits and misses of a cache."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.evictions = 0
+
+    def stats(self):
+        """Returns a mapping of the cache's ``hits``, ``misses``, ``sets`` and
+        ``evictions`` counts since it was created."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'sets': self.sets,
+            'evictions': self.evictions,
+        }
+
+
+class _Entry(object):
+
+    __slots__ = ('key', 'value', 'expires', 'prev', 'next')
+
+    def __init__(self, key, value, expires):
+        self.key = key
+        self.value = value
+        self.expires = expires
+        self.prev = self.next = None
+
+
+class MemoryCache(CacheStats):
+
+    """A thread safe in-memory cache that discards the least recently used
+    entries to stay within its limits.
+
+    The cache holds at most `max_entries` entries, and if `max_bytes` is given,
+    no more than that many bytes of cached text. Entries are also discarded
+    once they are `ttl` seconds old, if a `ttl` is given; otherwise they're
+    kept (and used for revalidation once stale) for as long as there's room.
+    The `ttl` applies to every entry alike, whatever the freshness lifetime of
+    the cached response: it bounds how long a stale response is kept for
+    revalidation, and is no substitute for the response's own lifetime, which
+    `httplib2` checks when an entry is read.
+
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None):
+        CacheStats.__init__(self)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+
+        self._entries = {}
+        # A circular list of entries, most recently used first.
+        self._head = _Entry(None, None, None)
+        self._head.prev = self._head.next = self._head
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _unlink(self, entry):
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+
+    def _push(self, entry):
+        head = self._head
+        entry.prev, entry.next = head, head.next
+        head.next.prev = entry
+        head.next = entry
+
+    def _remove(self, entry):
+        self._unlink(entry)
+        del self._entries[entry.key]
+        self.size -= len(entry.value)
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires is not None and entry.expires <= now:
+            self._remove(entry)
+            self.evictions += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._unlink(entry)
+        self._push(entry)
+        return entry.value
+
+    def _set(self, key, value, now):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._remove(entry)
+        if self.max_bytes is not None and len(value) > self.max_bytes:
+            # It would only push everything else out and then itself.
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = now + self.ttl
+        entry = self._entries[key] = _Entry(key, value, expires)
+        self._push(entry)
+        self.size += len(value)
+        self.sets += 1
+
+        while len(self._entries) > self.max_entries or (
+            self.max_bytes is not None and self.size > self.max_bytes):
+            self._remove(self._head.prev)
+            self.evictions += 1
+
+    def get(self, key):
+        """Returns the cached text for `key`, or ``None`` if there is none."""
+        self._lock.acquire()
+        try:
+            return self._get(key, time.time())
+        finally:
+            self._lock.release()
+
+    def get_many(self, keys):
+        """Returns a mapping of those of the given keys that are in the cache
+        to their cached text."""
+        now = time.time()
+        found = {}
+        self._lock.acquire()
+        try:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not None:
+                    found[key] = value
+        finally:
+            self._lock.release()
+        return found
+
+    def set(self, key, value):
+        """Caches the text `value` for `key`."""
+        self._lock.acquire()
+        try:
+            self._set(key, value, time.time())
+        finally:
+            self._lock.release()
+
+    def set_many(self, mapping):
+        """Caches all the keys and text values in `mapping`."""
+        now = time.time()
+        self._lock.acquire()
+        try:
+            for key, value in mapping.iteritems():
+                self._set(key, value, now)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        """Removes any cached text for `key`."""
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._remove(entry)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Removes everything from the cache."""
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._head.prev = self._head.next = self._head
+            self.size = 0
+        finally:
+            self._lock.release()
+
+
+class SQLiteCache(CacheStats):
+
+    """A cache kept in a SQLite database file, which can be shared by many
+    threads and processes.
+
+    Entries older than `ttl` seconds, if a `ttl` is given, are ignored and
+    eventually deleted; as for `MemoryCache`, the `ttl` is the same for every
+    entry, whatever the freshness lifetime of its response. If `max_entries`
+    is given, the least recently used entries are deleted whenever the cache
+    grows past that many. To spare a write for every read, an entry's use is
+    only recorded if it wasn't already within the last `touch_interval`
+    seconds, so recency is only that precise.
+
+    Each thread uses its own connection to the database. Statistics are
+    counted separately by each `SQLiteCache` instance.
+
+    """
+
+    # SQLite allows up to 999 parameters per statement.
+    batch_size = 500
+    touch_interval = 10
+
+    def __init__(self, path, ttl=None, max_entries=None, timeout=5.0):
+        if sqlite3 is None:
+            raise ImportError('SQLiteCache requires the sqlite3 module')
+        CacheStats.__init__(self)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        db = self._db()
+        db.execute('CREATE TABLE IF NOT EXISTS batchhttp_cache ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, stored REAL NOT NULL, '
+            'used REAL NOT NULL)')
+        db.execute('CREATE INDEX IF NOT EXISTS batchhttp_cache_stored '
+            'ON batchhttp_cache (stored)')
+        db.execute('CREATE INDEX IF NOT EXISTS batchhttp_cache_used '
+            'ON batchhttp_cache (used)')
+        db.commit()
+
+    def _db(self):
+        try:
+            return self._local.db
+        except AttributeError:
+            db = self._local.db = sqlite3.connect(self.path, timeout=self.timeout)
+            db.text_factory = str
+            return db
+
+    def _count(self, hits, misses):
+        self._lock.acquire()
+        try:
+            self.hits += hits
+            self.misses += misses
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        """Returns the cached text for `key`, or ``None`` if there is none."""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """Returns a mapping of those of the given keys that are in the cache
+        to their cached text, read in as few queries as possible."""
+        keys = dict.fromkeys(keys).keys()
+        found = {}
+        touch = []
+        db = self._db()
+        now = time.time()
+        oldest = 0
+        if self.ttl is not None:
+            oldest = now - self.ttl
+        for i in range(0, len(keys), self.batch_size):
+            batch = keys[i:i+self.batch_size]
+            rows = db.execute('SELECT key, value, used FROM batchhttp_cache '
+                'WHERE stored > ? AND key IN (%s)' % ', '.join(['?'] * len(batch)),
+                [oldest] + batch)
+            for key, value, used in rows:
+                found[key] = str(value)
+                if used <= now - self.touch_interval:
+                    touch.append((now, key))
+        self._count(len(found), len(keys) - len(found))
+        if touch:
+            self._touch(db, touch)
+        return found
+
+    def _touch(self, db, touch):
+        try:
+            db.executemany('UPDATE batchhttp_cache SET used = ? WHERE key = ?',
+                touch)
+            db.commit()
+        except sqlite3.OperationalError:
+            # Recency is only a hint for eviction, so a read doesn't fail
+            # for want of it if another process keeps the database locked.
+            db.rollback()
+
+    def set(self, key, value):
+        """Caches the text `value` for `key`."""
+        self.set_many({key: value})
+
+    def set_many(self, mapping):
+        """Caches all the keys and text values in `mapping` in one
+        transaction."""
+        if not mapping:
+            return
+        now = time.time()
+        db = self._db()
+        try:
+            db.executemany('INSERT OR REPLACE INTO batchhttp_cache '
+                '(key, value, stored, used) VALUES (?, ?, ?, ?)',
+                [(key, buffer(value), now, now)
+                 for key, value in mapping.iteritems()])
+            evicted = self._prune(db, now)
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+        self._lock.acquire()
+        try:
+            self.sets += len(mapping)
+            self.evictions += evicted
+        finally:
+            self._lock.release()
+
+    def _prune(self, db, now):
+        evicted = 0
+        if self.ttl is not None:
+            evicted += db.execute('DELETE FROM batchhttp_cache WHERE stored <= ?',
+                (now - self.ttl,)).rowcount
+        if self.max_entries is not None:
+            count = db.execute('SELECT COUNT(*) FROM batchhttp_cache').fetchone()[0]
+            if count > self.max_entries:
+                evicted += db.execute('DELETE FROM batchhttp_cache WHERE key IN '
+                    '(SELECT key FROM batchhttp_cache ORDER BY used LIMIT ?)',
+                    (count - self.max_entries,)).rowcount
+        return evicted
+
+    def delete(self, key):
+        """Removes any cached text for `key`."""
+        db = self._db()
+        db.execute('DELETE FROM batchhttp_cache WHERE key = ?', (key,))
+        db.commit()
+
+    def clear(self):
+        """Removes everything from the cache."""
+        db = self._db()
+        db.execute('DELETE FROM batchhttp_cache')
+        db.commit()
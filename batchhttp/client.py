@@ -36,24 +36,29 @@ callbacks.
 
 """
 
+import calendar
+import copy
 import email
-try:
-    from email.feedparser import FeedParser
-    from email.header import Header
-except ImportError:
-    from email.Parser import FeedParser
-    from email.Header import Header
 from httplib import HTTPException
 import logging
 import mimetools
 import new
-from StringIO import StringIO
+import Queue
+import socket
+import threading
+import time
 from urlparse import urljoin, urlparse, urlunparse
 import weakref
+import zlib
 
 import httplib2
 
-from batchhttp.multipart import MultipartHTTPMessage, HTTPRequestMessage
+from batchhttp.multipart import BodyView, MultipartWriter, HTTPRequestPart
+from batchhttp.multipart import ChunkedGzipBody, gzip_chunks
+from batchhttp.multipart import SharedHeaders, SharedHeadersPart, SHARED_HEADERS_EXTENSION
+from batchhttp.multipart import common_headers, inherit_headers
+from batchhttp.multipart import MultipartFeedParser, ParserError, TRANSFER_ENCODINGS
+from batchhttp.multipart import parse_content_type, parse_headers, parse_multipart
 
 log = logging.getLogger(__name__)
 
@@ -75,6 +80,57 @@ class NonBatchResponseError(BatchError):
         BatchError.__init__(self, message)
 
 
+class PartialBatchError(BatchError):
+    """An exception raised when some of the several batch requests into which
+    a large batch was split could not be completed.
+
+    The subresponses of the batch requests that did complete have already
+    been dispatched to their callbacks. The exceptions raised by the failed
+    batch requests (or their callbacks) are available as `errors`.
+
+    """
+    def __init__(self, errors, chunks):
+        self.errors = errors
+        message = ('%d of %d batch requests failed: %s'
+            % (len(errors), chunks, '; '.join([str(e) for e in errors])))
+        BatchError.__init__(self, message)
+
+
+class ConnectionPool(object):
+
+    """A thread safe collection of idle HTTP connections.
+
+    Connections are pooled as the mappings `httplib2.Http` keeps in its
+    `connections` attribute, so a connection mapping acquired from the pool
+    can be used by one `httplib2.Http` (and thus one thread) at a time, then
+    released for reuse by another.
+
+    """
+
+    def __init__(self):
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Returns a connection mapping that is not in use, creating an empty
+        one if there are no idle ones."""
+        self._lock.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+        finally:
+            self._lock.release()
+        return {}
+
+    def release(self, connections):
+        """Returns the connection mapping `connections` to the pool."""
+        self._lock.acquire()
+        try:
+            self._idle.append(connections)
+        finally:
+            self._lock.release()
+
+
 class WeaklyBoundMethod(object):
 
     """A bound method that only weakly holds the instance to which it's bound.
@@ -174,6 +230,648 @@ class WeakCallback(object):
         return callback(*args, **kwargs)
 
 
+class BatchFuture(object):
+
+    """A handle to the eventual subresponse of a batched subrequest.
+
+    A `BatchFuture` is returned by `BatchClient.batch()` when no callback is
+    given. It resolves to a tuple of the `httplib2.Response` and the body text
+    of the subresponse as soon as that subresponse has been decoded, which,
+    for a streaming client, may be well before the rest of the batch response
+    has arrived. If the batch request fails, or the batch response contains no
+    subresponse for it, it resolves to the exception instead.
+
+    As with callbacks, the subrequest is only performed if the `BatchFuture`
+    is still referenced when the batch request is completed.
+
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def __call__(self, url, response, content):
+        self.set_result((response, content))
+
+    def done(self):
+        """Returns whether the subresponse (or an exception) is available."""
+        return self._event.isSet()
+
+    def result(self, timeout=None):
+        """Returns the ``(response, content)`` tuple of the subresponse,
+        waiting up to `timeout` seconds (or forever, if `timeout` is ``None``)
+        for it to be decoded.
+
+        If the subrequest failed, its exception is raised instead. If the
+        subresponse is still not available after `timeout` seconds, a
+        `BatchError` is raised.
+
+        """
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise BatchError('Timed out waiting for subresponse')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Returns the exception with which the subrequest failed, or ``None``
+        if it succeeded, waiting for it as `result()` does."""
+        self._event.wait(timeout)
+        if not self._event.isSet():
+            raise BatchError('Timed out waiting for subresponse')
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Arranges for `fn` to be called with this `BatchFuture` once it is
+        done, or calls it immediately if it already is."""
+        self._lock.acquire()
+        try:
+            if not self._event.isSet():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def set_result(self, result):
+        self._resolve(result, None)
+
+    def set_exception(self, exc):
+        self._resolve(None, exc)
+
+    def _resolve(self, result, exc):
+        self._lock.acquire()
+        try:
+            if self._event.isSet():
+                return
+            self._result = result
+            self._exception = exc
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                log.exception('Exception in BatchFuture callback %r', fn)
+
+
+def ignore_response(url, response, content):
+    """A subrequest callback that does nothing, for subrequests that are
+    only made for their effect on the cache."""
+    pass
+
+
+class StreamingResponse(object):
+
+    """A file-like view of an HTTP response body that is read from the
+    connection on demand.
+
+    Content encoded with ``gzip`` or ``deflate`` is decompressed as it is
+    read, so `read()` always returns the decoded body text.
+
+    """
+
+    def __init__(self, conn, response):
+        self.conn = conn
+        self.response = response
+
+        encoding = response.getheader('content-encoding', '').lower()
+        if encoding == 'gzip':
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            self.decoder = None
+
+    def read(self, amt=None):
+        """Returns up to `amt` more bytes of the response body, or all the
+        rest of it if `amt` is not given. Returns an empty string once the
+        body is exhausted."""
+        while True:
+            if amt is None:
+                data = self.response.read()
+            else:
+                data = self.response.read(amt)
+            if self.decoder is None:
+                return data
+            if not data:
+                return self.decoder.flush()
+            data = self.decoder.decompress(data)
+            # Keep reading if the compressed block hasn't produced anything.
+            if data:
+                return data
+
+    def close(self):
+        """Releases the connection, closing it if the response body was not
+        completely read."""
+        if not self.response.isclosed():
+            self.conn.close()
+
+
+def authorization(http, uri):
+    """Returns the most specific of `http`'s authorizations that is in scope
+    for `uri`, as `httplib2.Http.request()` would choose it, or ``None``."""
+    scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(uri)
+    auths = [(auth.depth(request_uri), auth) for auth in http.authorizations
+        if auth.inscope(authority, request_uri)]
+    if not auths:
+        return None
+    auths.sort()
+    return auths[0][1]
+
+
+def authorize(http, method, uri, headers, body=None):
+    """Adds to the mapping `headers` the authorization headers that `http`
+    would send with a request for `uri`, using the most specific of its
+    in-scope authorizations as `httplib2.Http.request()` does."""
+    auth = authorization(http, uri)
+    if auth is not None:
+        scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(uri)
+        auth.request(method, request_uri, headers, body)
+
+
+class RewindingHTTPConnection(httplib2.HTTPConnectionWithTimeout):
+    """An HTTP connection that rewinds a streamed request body before sending
+    it, so that a request httplib2 sends again on a fresh connection after a
+    failed attempt carries the whole body."""
+
+    def request(self, method, url, body=None, headers={}):
+        if hasattr(body, 'rewind'):
+            body.rewind()
+        httplib2.HTTPConnectionWithTimeout.request(self, method, url, body,
+            headers)
+
+
+class RewindingHTTPSConnection(httplib2.HTTPSConnectionWithTimeout):
+    """The HTTPS equivalent of `RewindingHTTPConnection`."""
+
+    def request(self, method, url, body=None, headers={}):
+        if hasattr(body, 'rewind'):
+            body.rewind()
+        httplib2.HTTPSConnectionWithTimeout.request(self, method, url, body,
+            headers)
+
+
+def open_connection(http, scheme, authority):
+    """Opens a new connection to `authority` configured as `http` would.
+
+    The connection uses `http`'s timeout and proxy settings and, for HTTPS,
+    its certificate authorities, validation setting and any client
+    certificate it holds for `authority`.
+
+    """
+    proxy_info = http.proxy_info
+    if callable(proxy_info):
+        # httplib2 0.7 defaults to reading the proxy from the environment.
+        proxy_info = proxy_info(scheme)
+    if (hasattr(proxy_info, 'applies_to')
+        and not proxy_info.applies_to(authority.split(':')[0])):
+        proxy_info = None
+
+    kwargs = {'timeout': http.timeout, 'proxy_info': proxy_info}
+    if scheme != 'https':
+        return RewindingHTTPConnection(authority, **kwargs)
+
+    if hasattr(http, 'ca_certs'):
+        kwargs['ca_certs'] = http.ca_certs
+        kwargs['disable_ssl_certificate_validation'] = \
+            http.disable_ssl_certificate_validation
+    certs = list(http.certificates.iter(authority))
+    if certs:
+        kwargs['key_file'], kwargs['cert_file'] = certs[0]
+    return RewindingHTTPSConnection(authority, **kwargs)
+
+
+def rewinding_connection(http, uri):
+    """Makes sure `http`'s connection to the host in `uri` is one that rewinds
+    a streamed request body before each attempt, replacing any other kind of
+    connection `http` keeps for it."""
+    scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(uri)
+    conn_key = scheme + ':' + authority
+    conn = http.connections.get(conn_key)
+    if not isinstance(conn, (RewindingHTTPConnection,
+                             RewindingHTTPSConnection)):
+        if conn is not None:
+            conn.close()
+        conn = http.connections[conn_key] = open_connection(http, scheme,
+            authority)
+    return conn
+
+
+def stream_request(http, uri, method="GET", body=None, headers=None):
+    """Performs an HTTP request without reading the response body.
+
+    The request is made over `http`'s connection to the host in `uri` (a
+    connection is opened and kept in `http.connections` if there isn't one),
+    with any of `http`'s authorizations that are in scope applied. Unlike
+    `httplib2.Http.request()`, no caching or redirection is performed.
+
+    Returns a tuple of an `httplib2.Response` instance describing the response
+    and a `StreamingResponse` from which to read its body. The caller should
+    `close()` the `StreamingResponse` when done with it.
+
+    """
+    if headers is None:
+        headers = {}
+    else:
+        headers = dict([(k.lower(), v) for k, v in headers.iteritems()])
+    if 'user-agent' not in headers:
+        headers['user-agent'] = 'Python-httplib2/%s' % httplib2.__version__
+
+    scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(uri)
+    authorize(http, method, uri, headers, body)
+
+    conn_key = scheme + ':' + authority
+    for attempt in range(2):
+        conn = http.connections.get(conn_key)
+        if conn is None:
+            conn = http.connections[conn_key] = open_connection(http,
+                scheme, authority)
+
+        if hasattr(body, 'rewind'):
+            body.rewind()
+        try:
+            conn.request(method, request_uri, body, headers)
+            response = conn.getresponse()
+        except (socket.error, HTTPException):
+            # The connection may have been a kept-alive one the server has
+            # since dropped, so try once more on a fresh connection.
+            conn.close()
+            del http.connections[conn_key]
+            if attempt:
+                raise
+        else:
+            break
+
+    return httplib2.Response(response), StreamingResponse(conn, response)
+
+
+class SubrequestCache(object):
+
+    """Applies the cache and credentials of an `httplib2.Http` instance to
+    the subrequests of a batch request, as `httplib2.Http.request()` would to
+    the requests it makes itself.
+
+    Each subrequest's cache entry is read only once, ideally all together
+    before the batch request is built (see `load()`), and is then used both
+    to find fresh responses and validators for the subrequest and to fill in
+    ``304 Not Modified`` subresponses. Entries for the subresponses are
+    written back together by `flush()`.
+
+    Caches with `get_many()` and `set_many()` methods, such as those in
+    `batchhttp.cache`, are read and written with one call each per batch.
+
+    The authorizations for each host are also found only once, and the
+    headers of those that don't vary by request (such as Basic
+    authorization) are computed only once, until a subresponse brings an
+    authentication challenge from that host.
+
+    """
+
+    # Authorizations whose headers are the same for every request.
+    static_authorizations = (httplib2.BasicAuthentication,
+        httplib2.GoogleLoginAuthentication)
+
+    def __init__(self, http):
+        self.http = http
+        self.cache = http.cache
+        self.entries = {}
+        self.pending = {}
+        self._forget_authorizations()
+
+    def cache_key(self, reqinfo):
+        """Returns the key under which the response to the subrequest
+        `reqinfo` is cached."""
+        scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(
+            httplib2.iri2uri(reqinfo['uri']))
+        return defrag_uri
+
+    def load(self, requests):
+        """Reads the cache entries for all the given `Request` instances that
+        haven't been read already."""
+        if self.cache is None:
+            return
+        keys = []
+        for request in requests:
+            key = self.cache_key(request.reqinfo)
+            if key not in self.entries and key not in keys:
+                keys.append(key)
+        if hasattr(self.cache, 'get_many'):
+            values = self.cache.get_many(keys)
+            for key in keys:
+                self.entries[key] = self._parse(key, values.get(key))
+        else:
+            for key in keys:
+                self.entries[key] = self._parse(key, self.cache.get(key))
+
+    # `httplib2._updateCache()` writes through these, so its changes are kept
+    # in `pending` until they're flushed.
+
+    def set(self, key, value):
+        self.pending[key] = value
+
+    def delete(self, key):
+        self.pending[key] = None
+
+    def flush(self):
+        """Writes any new cache entries for the subresponses to the cache."""
+        pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        updates = {}
+        for key, value in pending.iteritems():
+            if value is None:
+                self.cache.delete(key)
+            else:
+                updates[key] = value
+        if hasattr(self.cache, 'set_many'):
+            self.cache.set_many(updates)
+        else:
+            for key, value in updates.iteritems():
+                self.cache.set(key, value)
+
+    def _parse(self, key, value):
+        if not value:
+            return None
+        try:
+            info, content = value.split('\r\n\r\n', 1)
+        except ValueError:
+            self.cache.delete(key)
+            return None
+        return email.message_from_string(info), content
+
+    def entry(self, reqinfo):
+        """Returns the cache entry for the subrequest `reqinfo` as a tuple of
+        an `email.Message` of the cached headers and the cached content, or
+        ``None`` if there isn't one."""
+        if self.cache is None:
+            return None
+        key = self.cache_key(reqinfo)
+        if key not in self.entries:
+            self.entries[key] = self._parse(key, self.cache.get(key))
+        return self.entries[key]
+
+    def _method(self, reqinfo):
+        return reqinfo.get('method', 'GET').upper()
+
+    def _headers(self, reqinfo):
+        headers = httplib2._normalize_headers(reqinfo.get('headers') or {})
+        headers.setdefault('accept-encoding', 'gzip, deflate')
+        return headers
+
+    def _usable_entry(self, reqinfo, headers):
+        # Returns the cache entry that `httplib2` would use to answer or
+        # validate a GET or HEAD request with `headers`.
+        if self._method(reqinfo) not in ('GET', 'HEAD') or 'range' in headers:
+            return None
+        entry = self.entry(reqinfo)
+        if entry is None:
+            return None
+        info = entry[0]
+        if '-x-permanent-redirect-url' in info:
+            return None
+        if 'vary' in info:
+            for header in info['vary'].lower().replace(' ', '').split(','):
+                if headers.get(header) != info['-varied-%s' % header]:
+                    return None
+        return entry
+
+    def fresh_response(self, reqinfo):
+        """Returns the response to the subrequest `reqinfo` from the cache,
+        if it's there and still fresh enough to use without asking the
+        server.
+
+        The response is returned as a tuple of an `httplib2.Response` and the
+        response body, as `httplib2.Http.request()` would return it. If the
+        subrequest has to be performed, ``None`` is returned.
+
+        """
+        headers = self._headers(reqinfo)
+        entry = self._usable_entry(reqinfo, headers)
+        if entry is None:
+            return None
+        info, content = entry
+        if httplib2._entry_disposition(info, headers) != 'FRESH':
+            return None
+        response = httplib2.Response(info)
+        response.fromcache = True
+        return response, content
+
+    def stale_response(self, reqinfo, grace=0):
+        """Returns the response to the subrequest `reqinfo` from the cache if
+        it's stale, but recently enough that it may be used while it's
+        revalidated.
+
+        The response may be used for as many seconds after it became stale as
+        its ``stale-while-revalidate`` Cache-Control directive says, or
+        `grace` seconds if it has none. Responses with the ``no-cache`` or
+        ``must-revalidate`` directives are never used once stale. The
+        response is returned as for `fresh_response()`; if the stale response
+        can't be used, ``None`` is returned.
+
+        """
+        headers = self._headers(reqinfo)
+        entry = self._usable_entry(reqinfo, headers)
+        if entry is None:
+            return None
+        info, content = entry
+        if httplib2._entry_disposition(info, dict(headers)) != 'STALE':
+            return None
+
+        cc = httplib2._parse_cache_control(info)
+        if 'no-cache' in cc or 'must-revalidate' in cc:
+            return None
+        window = grace
+        if 'stale-while-revalidate' in cc:
+            try:
+                window = int(cc['stale-while-revalidate'])
+            except ValueError:
+                pass
+        staleness = self._staleness(info, cc)
+        if staleness is None or staleness > window:
+            return None
+
+        response = httplib2.Response(info)
+        response.fromcache = True
+        return response, content
+
+    def _staleness(self, info, cc):
+        # Returns how many seconds ago the cached response went stale.
+        try:
+            date = calendar.timegm(email.Utils.parsedate_tz(info['date']))
+        except (TypeError, ValueError):
+            return None
+        lifetime = 0
+        if 'max-age' in cc:
+            try:
+                lifetime = int(cc['max-age'])
+            except ValueError:
+                pass
+        elif 'expires' in info:
+            expires = email.Utils.parsedate_tz(info['expires'])
+            if expires is not None:
+                lifetime = max(0, calendar.timegm(expires) - date)
+        return max(0, time.time() - date) - lifetime
+
+    def _forget_authorizations(self, authority=None):
+        if authority is None:
+            self.host_authorizations = {}
+            self.authorization_headers = {}
+            self.authorization_count = len(self.http.authorizations)
+            return
+        for auth in self.host_authorizations.pop(authority, ()):
+            self.authorization_headers.pop(auth, None)
+
+    def authorization(self, uri):
+        """Returns the most specific of the authorizations that are in scope
+        for `uri`, as `authorization()` does, or ``None``.
+
+        The authorizations for each host are memoized, so only those for the
+        host in `uri` are considered.
+
+        """
+        scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(uri)
+        if self.authorization_count != len(self.http.authorizations):
+            # Some were added since they were memoized.
+            self._forget_authorizations()
+        try:
+            candidates = self.host_authorizations[authority]
+        except KeyError:
+            candidates = self.host_authorizations[authority] = [auth
+                for auth in self.http.authorizations
+                if getattr(auth, 'host', authority) == authority]
+        if not candidates:
+            return None
+
+        auths = [(auth.depth(request_uri), auth) for auth in candidates
+            if auth.inscope(authority, request_uri)]
+        if not auths:
+            return None
+        auths.sort()
+        return auths[0][1]
+
+    def authorize(self, method, uri, headers, body=None):
+        """Adds to the mapping `headers` the authorization headers for a
+        request for `uri`, as the `authorize()` function does."""
+        auth = self.authorization(uri)
+        if auth is None:
+            return
+        scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(uri)
+        if not isinstance(auth, self.static_authorizations):
+            auth.request(method, request_uri, headers, body)
+            return
+        try:
+            added = self.authorization_headers[auth]
+        except KeyError:
+            added = self.authorization_headers[auth] = {}
+            auth.request(method, request_uri, added, body)
+        headers.update(added)
+
+    def request_headers(self, reqinfo):
+        """Returns the headers and body with which to send the subrequest
+        `reqinfo`, including any authorization headers and cache validators.
+
+        Unsafe subrequests invalidate their cache entries, as they would if
+        they were performed by `httplib2.Http.request()`.
+
+        """
+        http = self.http
+        method = self._method(reqinfo)
+        body = reqinfo.get('body')
+        headers = self._headers(reqinfo)
+        if 'user-agent' not in headers:
+            headers['user-agent'] = 'Python-httplib2/%s (gzip)' % httplib2.__version__
+
+        if method in ('GET', 'HEAD'):
+            entry = self._usable_entry(reqinfo, headers)
+            if entry is not None and httplib2._entry_disposition(entry[0], dict(headers)) == 'STALE':
+                info = entry[0]
+                if 'etag' in info and not http.ignore_etag and 'if-none-match' not in headers:
+                    headers['if-none-match'] = info['etag']
+                if 'last-modified' in info and 'if-modified-since' not in headers:
+                    headers['if-modified-since'] = info['last-modified']
+        else:
+            entry = self.entry(reqinfo)
+            if entry is not None:
+                info = entry[0]
+                if (method in http.optimistic_concurrency_methods and 'etag' in info
+                    and not http.ignore_etag and 'if-match' not in headers):
+                    # http://www.w3.org/1999/04/Editing/
+                    headers['if-match'] = info['etag']
+                # RFC 2616 Section 13.10
+                key = self.cache_key(reqinfo)
+                self.cache.delete(key)
+                self.entries[key] = None
+
+        self.authorize(method, httplib2.iri2uri(reqinfo['uri']), headers, body)
+        return headers, body
+
+    def wants_content(self, reqinfo, response):
+        """Returns whether `update_response()` needs the content of the
+        subresponse `response` as a string, to decompress it or perhaps to
+        store it in the cache."""
+        if response.get('content-encoding') in ('gzip', 'deflate'):
+            return True
+        return (self.cache is not None and response.status in (200, 203)
+            and self._method(reqinfo) in ('GET', 'HEAD'))
+
+    def update_response(self, reqinfo, response, content):
+        """Updates the cache with the subresponse to the subrequest `reqinfo`
+        (once `flush()` is called), and returns the `httplib2.Response` and
+        content to give to the subrequest's callback.
+
+        Compressed content is decompressed, and a ``304 Not Modified``
+        subresponse to a validated subrequest is answered with the cached
+        content, as ``200 OK``.
+
+        """
+        content = httplib2._decompressContent(response, content)
+
+        uri = httplib2.iri2uri(reqinfo['uri'])
+        auth = self.authorization(uri)
+        if auth is not None:
+            # Let it see challenges, such as a new Digest nonce.
+            auth.response(response, content)
+        if response.status == 401:
+            scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(uri)
+            self._forget_authorizations(authority)
+
+        method = self._method(reqinfo)
+        if self.cache is None or method not in ('GET', 'HEAD'):
+            return response, content
+
+        headers = self._headers(reqinfo)
+        key = self.cache_key(reqinfo)
+        entry = self._usable_entry(reqinfo, headers)
+        if response.status == 304 and method == 'GET' and entry is not None:
+            # Merge the new end-to-end headers into the cached ones.
+            info, content = entry
+            for header in httplib2._get_end2end_headers(response):
+                del info[header]
+                info[header] = response[header]
+            merged = httplib2.Response(info)
+            httplib2._updateCache(headers, merged, content, self, key)
+            merged.status = 200
+            merged.fromcache = True
+            self.entries[key] = info, content
+            return merged, content
+        if response.status in (200, 203):
+            if 'content-location' not in response:
+                response['content-location'] = uri
+            httplib2._updateCache(headers, response, content, self, key)
+            self.entries.pop(key, None)
+        elif entry is not None:
+            self.delete(key)
+            self.entries[key] = None
+        return response, content
+
+
 class Request(object):
 
     """A subrequest of a batched HTTP request.
@@ -218,116 +916,71 @@ class Request(object):
 
         """
         self.reqinfo = reqinfo
+        self.future = None
 
         if hasattr(callback, 'im_self'):  # instancemethod
             self.callback = WeaklyBoundMethod(callback)
         else:
             self.callback = WeakCallback(callback)
+            if isinstance(callback, BatchFuture):
+                self.future = self.callback.callback
 
     def alive(self):
         """Returns whether this `Request` instance's callback still exists."""
         return self.callback.alive()
 
-    def _update_headers_from_cache(self, http):
-        objreq = self.reqinfo
+    def fail(self, exc):
+        """Resolves this `Request` instance's `BatchFuture`, if it has one
+        that is still waiting, to the exception `exc`."""
+        if self.future is None:
+            return
+        future = self.future()
+        if future is not None:
+            future.set_exception(exc)
 
-        if http.cache is not None or http.authorizations:
-            class StopCharade(Exception):
-                pass
-
-            class CaptureConnections(object):
-                def __contains__(self, key):
-                    return True
-                def __getitem__(self, key):
-                    return self.http
-
-            class CaptureHTTPConnection(object):
-                def connect(self):
-                    pass
-
-                def request(self, method, request_uri, body, headers):
-                    self.url     = request_uri
-                    self.body    = body
-                    self.headers = headers
-                    raise StopCharade()
-
-                def close(self):
-                    pass
-
-            real_connections = http.connections
-            conns = CaptureConnections()
-            conn = CaptureHTTPConnection()
-            conns.http = conn
-            http.connections = conns
-            try:
-                try:
-                    http.request(**objreq)
-                except StopCharade:
-                    return conn.headers, conn.body
-            finally:
-                # Put the real connections back.
-                http.connections = real_connections
+    def dedup_key(self):
+        """Returns a key that is the same for all subrequests that must get
+        the same response, or ``None`` if this subrequest should never share
+        a response with another.
 
-        # We didn't finish our request, or there was no cache, so return what
-        # we were given.
-        return objreq.get('headers', {}), objreq.get('body')
+        Only ``GET`` and ``HEAD`` subrequests without bodies are shared, and
+        only with subrequests for the same URL with the same headers.
 
-    def _update_response_from_cache(self, http, response, realbody):
-        if http.cache is not None or http.authorizations:
-            class HandoffConnections(object):
-                def __contains__(self, key):
-                    return True
-                def __getitem__(self, key):
-                    return self.http
-
-            class HandoffHTTPConnection(object):
-                def connect(self):
-                    pass
-
-                def request(self, method, request_uri, body, headers):
-                    pass
-
-                def read(self):
-                    return httplib2._decompressContent(response, realbody)
-
-                def getresponse(self):
-                    return self
-
-                def close(self):
-                    pass
-
-                def __getattr__(self, key):
-                    return getattr(response, key)
-
-            real_connections = http.connections
-            fc = HandoffConnections()
-            fc.http = HandoffHTTPConnection()
-            http.connections = fc
+        """
+        objreq = self.reqinfo
+        method = objreq.get('method', 'GET').upper()
+        if method not in ('GET', 'HEAD') or objreq.get('body'):
+            return None
+        headers = objreq.get('headers') or {}
+        headers = [(k.lower(), v) for k, v in headers.iteritems()]
+        headers.sort()
+        return method, objreq['uri'], tuple(headers)
+
+    def as_message(self, http, id, encoding='quoted-printable', cache=None, shared_headers=()):
+        """Converts this `Request` instance into a
+        `batchhttp.multipart.HTTPRequestPart` suitable for adding to a
+        `batchhttp.multipart.MultipartWriter` instance.
 
-            unset = object()
-            real_follow_redirects = getattr(http, 'follow_redirects', unset)
-            http.follow_redirects = False
+        Parameter `encoding` is the Content-Transfer-Encoding with which to
+        encode the subrequest; see `batchhttp.multipart.TRANSFER_ENCODINGS`.
+        Parameter `cache` is the `SubrequestCache` through which to apply
+        `http`'s cache and credentials to the subrequest; if it's not given, a
+        new one is used. Headers among the `shared_headers` pairs are left
+        out, for the batch request to declare once for all its subrequests.
 
-            try:
-                response, realbody = http.request(**self.reqinfo)
-            finally:
-                http.connections = real_connections
-                if real_follow_redirects is unset:
-                    del http.follow_redirects
-                else:
-                    http.follow_redirects = real_follow_redirects
+        The subrequest's ``body`` may be a file-like object instead of a
+        string, in which case it's read from its current position only as the
+        batch request is written (see `batchhttp.multipart.HTTPPart`).
 
-            # Fix up the status code, since httplib2 writes the 304 through
-            # to the cache, but we want to treat it like a 200.
-            if response.status == 304:
-                response.status = 200
+        If this `Request` instance's callback no longer exists, a
+        `ReferenceError` is raised.
 
-        return response, realbody
+        """
+        return self.message(self.prepare(http, cache), id, encoding, shared_headers)
 
-    def as_message(self, http, id):
-        """Converts this `Request` instance into a
-        `batchhttp.multipart.HTTPRequestMessage` suitable for adding to a
-        `batchhttp.multipart.MultipartHTTPMessage` instance.
+    def prepare(self, http, cache=None):
+        """Returns the request line, the mapping of headers and the body with
+        which to send this subrequest, as `as_message()` would send it.
 
         If this `Request` instance's callback no longer exists, a
         `ReferenceError` is raised.
@@ -336,36 +989,62 @@ class Request(object):
         if not self.callback.alive():
             raise ReferenceError("No callback to return request's response to")
 
-        headers, body = self._update_headers_from_cache(http)
+        if cache is None:
+            cache = SubrequestCache(http)
+        headers, body = cache.request_headers(self.reqinfo)
 
         objreq = self.reqinfo
         url = objreq['uri']
         method = objreq.get('method', 'GET')
         parts = urlparse(url)
-        host = parts[1]
-
-        # Use whole URL in request line per HTTP/1.1 5.1.2 (proxy behavior).
-        requesttext = "%s %s HTTP/1.1\r\n" % (method, url)
-        headers['host'] = host
+        headers['host'] = parts[1]
         # Prevent compression as it's unlikely to survive batching.
         headers['accept-encoding'] = 'identity'
-        for header, value in headers.iteritems():
-            requesttext += "%s: %s\r\n" % (header, value)
-        requesttext += '\r\n'
-        requesttext += body or ''
-
-        requesttext = requesttext.encode('ascii')
-        submsg = HTTPRequestMessage(requesttext, id)
-        return submsg
 
-    def decode_response(self, http, part):
+        # Use whole URL in request line per HTTP/1.1 5.1.2 (proxy behavior).
+        return "%s %s HTTP/1.1" % (method, url), headers, body
+
+    def message(self, prepared, id, encoding='quoted-printable', shared_headers=()):
+        """Makes the `batchhttp.multipart.HTTPRequestPart` for the subrequest
+        `prepared` by `prepare()`. The other parameters are as for
+        `as_message()`. A unicode body is encoded in the charset named in its
+        Content-Type, or else UTF-8."""
+        requestline, headers, body = prepared
+        shared = set(shared_headers)
+        lines = [requestline]
+        for header, value in headers.iteritems():
+            if (header, value) not in shared:
+                lines.append("%s: %s" % (header, value))
+        lines.extend(['', ''])
+        # The request line and headers must be ASCII, but the body is sent as
+        # bytes, so it's kept out of their encoding.
+        requesttext = '\r\n'.join(lines)
+        if isinstance(requesttext, unicode):
+            requesttext = requesttext.encode('ascii')
+        if hasattr(body, 'read'):
+            # File bodies are read only as the batch request is written.
+            bodyfile = body
+        else:
+            if isinstance(body, unicode):
+                content_type, params = parse_content_type(headers.get('content-type'))
+                body = body.encode(params.get('charset', 'utf-8'))
+            requesttext += body or ''
+            bodyfile = None
+        return HTTPRequestPart(requesttext, id, encoding, bodyfile)
+
+    def decode_response(self, http, part, cache=None, views=False, spill_threshold=None):
         """Decodes and dispatches the given subresponse to this `Request`
         instance's callback.
 
         Parameter `http` is the `httplib2.Http` instance to use for retrieving
         unmodified content from cache, updating with new authorization
-        headers, etc. Parameter `part` is the `email.message.Message`
-        containing the subresponse content to decode.
+        headers, etc. Parameter `part` is the `batchhttp.multipart.Part`
+        containing the subresponse content to decode. Parameter `cache` is as
+        for `as_message()`.
+
+        If `views` is true, the callback is given the subresponse body as a
+        read-only `batchhttp.multipart.BodyView` of the batch response rather
+        than a string (see `parse_response()`).
 
         If this `Request` instance's callback no longer exists, a
         `ReferenceError` is raised instead of decoding anything. If the
@@ -375,35 +1054,77 @@ class Request(object):
         if not self.callback.alive():
             raise ReferenceError("No callback to return response to")
 
-        # Parse the part body into a status line and a Message.
-        messagetext = part.get_payload(decode=True)
-        messagefile = StringIO(messagetext)
-        status_line = messagefile.readline()
-        message = email.message_from_file(messagefile)
+        httpresponse, body = self.parse_response(http, part, cache, views,
+            spill_threshold)
+        self.callback(self.reqinfo['uri'], httpresponse, body)
 
-        if status_line.startswith('HTTP/'):
-            status_code = status_line.split(' ')[1]
-        else:
-            status_code = status_line.split(' ')[0]
-        message['status'] = int(status_code)
+    def parse_response(self, http, part, cache=None, views=False, spill_threshold=None):
+        """Decodes the given subresponse, returning a tuple of an
+        `httplib2.Response` and the subresponse body.
 
-        httpresponse = httplib2.Response(message)
+        The parameters are as for `decode_response()`, but no callback is
+        called, whether or not this `Request` instance's callback still
+        exists.
 
-        # httplib2.Response doesn't lower case header keys itself, so a
-        # Response from an email Message is inconsistent with one from an
-        # httplib.HTTPResponse. Enforce lower case here.
-        for k, v in httpresponse.items():
-            del httpresponse[k]
-            httpresponse[k.lower()] = v
+        If `views` is true, the body is a `batchhttp.multipart.BodyView`. A
+        body sent in an identity Content-Transfer-Encoding is viewed in place
+        in the batch response, without being copied. Other bodies are decoded
+        once; into a temporary file, viewed through an `mmap`, if the part
+        was spilled to disk or is larger than `spill_threshold` bytes. Bodies
+        that must be decompressed or may be cached are still copied out.
 
-        body = message.get_payload()
-        if body is None:
-            raise BatchError('Could not decode subrequest body from MIME payload')
-        httpresponse, body = self._update_response_from_cache(http, httpresponse, body)
-        if body is None:
-            raise BatchError('Could not decode subrequest body through httplib2')
+        """
+        # Parse the part body into a status line, headers and body.
+        if views:
+            payload = part.payload_view(spill_threshold)
+            messagetext, start = payload.data, payload.offset
+            end = start + len(payload)
+        else:
+            messagetext = part.get_payload(decode=True)
+            if messagetext is None:
+                raise BatchError('Could not decode subrequest body from MIME payload')
+            start, end = 0, len(messagetext)
+        eol = messagetext.find('\n', start, end)
+        if eol == -1:
+            eol = end
+        status_line = messagetext[start:eol].split(None, 2)
+        if status_line and status_line[0].startswith('HTTP/'):
+            status_line = status_line[1:]
+        try:
+            status_code = int(status_line[0])
+        except (IndexError, ValueError):
+            raise BatchError('Could not decode subresponse status line %r'
+                % (messagetext[start:eol],))
+        headers, body_start = parse_headers(messagetext, eol + 1, end)
+        headers = inherit_headers(headers, part.shared_headers)
+
+        # Combine repeated headers the way httplib does.
+        info = {}
+        for header, value in headers:
+            if header in info:
+                info[header] = '%s, %s' % (info[header], value)
+            else:
+                info[header] = value
+        info['status'] = str(status_code)
 
-        self.callback(self.reqinfo['uri'], httpresponse, body)
+        httpresponse = httplib2.Response(info)
+        if len(status_line) > 1:
+            httpresponse.reason = status_line[1].strip()
+
+        if cache is None:
+            cache = SubrequestCache(http)
+        if not views:
+            body = messagetext[body_start:]
+            return cache.update_response(self.reqinfo, httpresponse, body)
+
+        if cache.wants_content(self.reqinfo, httpresponse):
+            body = messagetext[body_start:end]
+        else:
+            body = BodyView(messagetext, body_start, end - body_start)
+        httpresponse, body = cache.update_response(self.reqinfo, httpresponse, body)
+        if isinstance(body, basestring):
+            body = BodyView(body)
+        return httpresponse, body
 
 
 class BatchRequest(object):
@@ -411,9 +1132,40 @@ class BatchRequest(object):
     """A collection of HTTP responses that should be performed in a batch as
     one response."""
 
-    def __init__(self, headers=None):
+    read_size = 65536
+    # The delimiter line written before each part, on top of its headers
+    # and payload.
+    part_overhead = 40
+    gzip_level = 6
+
+    def __init__(self, headers=None, streaming=False, transfer_encoding='quoted-printable',
+                 max_subrequests=None, max_batch_bytes=None, concurrency=4,
+                 stale_while_revalidate=False, stale_grace=0, stream_upload=False,
+                 body_views=False, spill_threshold=None, gzip_request=False,
+                 hoist_headers=True, extensions=None):
         self.requests = list()
+        self.duplicates = dict()
+        self.deduplicated = 0
+        self.fresh = list()
+        self.stale = list()
+        self.cache = None
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_grace = stale_grace
         self.headers = headers
+        self.streaming = streaming
+        self.stream_upload = stream_upload
+        self.body_views = body_views
+        self.spill_threshold = spill_threshold
+        self.gzip_request = gzip_request
+        self.transfer_encoding = transfer_encoding
+        self.max_subrequests = max_subrequests
+        self.max_batch_bytes = max_batch_bytes
+        self.concurrency = concurrency
+        self.hoist_headers = hoist_headers
+        if extensions is None:
+            extensions = set()
+        self.extensions = extensions
+        self.hoisted = []
 
     def __len__(self):
         """Returns the number of subrequests there are to perform.
@@ -425,16 +1177,29 @@ class BatchRequest(object):
         """
         return len([r for r in self.requests if r.alive()])
 
-    def add(self, reqinfo, callback):
+    def add(self, reqinfo, callback=None):
         """Adds a new `Request` instance to this `BatchRequest` instance.
 
         Parameters `reqinfo` and `callback` should be an HTTP request info
         mapping and a callable object, suitable for using to construct a new
-        `Request` instance.
+        `Request` instance. If `callback` is omitted, a new `BatchFuture` is
+        used.
+
+        Returns the `callback`, so that a `BatchFuture` created here can be
+        given to the caller.
 
         """
+        if callback is None:
+            callback = BatchFuture()
         r = Request(reqinfo, callback)
         self.requests.append(r)
+        return callback
+
+    def fail_futures(self, exc):
+        """Resolves the `BatchFuture` of every subrequest whose subresponse
+        hasn't been dispatched to the exception `exc`."""
+        for request in self.requests:
+            request.fail(exc)
 
     def process(self, http, endpoint):
         """Performs a batch request.
@@ -448,53 +1213,345 @@ class BatchRequest(object):
         the root of the site named in `endpoint`.
 
         If this `BatchRequest` instance contains no `Request` instances that
-        can deliver their subresponses, no batch request will occur.
+        can deliver their subresponses, no batch request will occur. Neither
+        will one occur if all their responses are fresh in `http`'s cache: the
+        cached responses are dispatched before any batch request is made.
+
+        If this `BatchRequest` instance is `streaming`, the batch response is
+        read from the connection incrementally, and each subresponse is
+        dispatched to its callback as soon as it has arrived (see
+        `handle_stream()`). If it is `stream_upload`, the batch request body
+        is written to the connection as it's put together, with its
+        ``Content-Length`` worked out beforehand.
+
+        If the subrequests exceed the `max_subrequests` or `max_batch_bytes`
+        limits, they are split into several batch requests, which are
+        performed concurrently (see `process_chunks()`).
+
+        Any `BatchFuture` whose subresponse was not dispatched is resolved to
+        the exception that stopped the batch request or, if the batch response
+        simply lacked its subresponse, to a `BatchError`.
 
         """
-        headers, body = self.construct(http)
-        if self.headers and headers:
-            headers.update(self.headers)
-        if headers and body:
-            batch_url = urljoin(endpoint, '/batch-processor')
-            response, content = http.request(batch_url, body=body, method="POST", headers=headers)
-            self.handle_response(http, response, content)
+        try:
+            try:
+                self._process(http, endpoint)
+            finally:
+                if self.cache is not None:
+                    self.cache.flush()
+        except Exception, exc:
+            self.fail_futures(exc)
+            raise
+        self.fail_futures(BatchError('Batch response included no subresponse for the request'))
+
+    def _process(self, http, endpoint):
+        chunks = self.construct_chunks(http)
+        self.dispatch_fresh()
+        if not chunks:
+            return
+        batch_url = urljoin(endpoint, '/batch-processor')
+        if len(chunks) == 1:
+            headers, body = chunks[0]
+            parts = self.perform(http, batch_url, headers, body)
+            try:
+                for part in parts:
+                    self.dispatch_part(http, part)
+            finally:
+                if hasattr(parts, 'close'):
+                    parts.close()
+        else:
+            self.process_chunks(http, batch_url, chunks)
 
-    def construct(self, http):
-        """Builds a batch HTTP request from the `BatchRequest` instance's
-        constituent subrequests.
+    def perform(self, http, batch_url, headers, body):
+        """Makes one batch HTTP request to `batch_url`, returning an iterator
+        over the `batchhttp.multipart.Part` instances of the batch response.
 
-        The batch request is returned as a tuple containing a mapping of HTTP
-        headers and the text of the request body.
+        If this `BatchRequest` is `streaming`, the parts are read from the
+        connection as the iterator is consumed.
 
         """
-        if not len(self):
-            log.debug('No requests were made for the batch')
-            return None, None
+        if self.headers:
+            headers.update(self.headers)
+        if self.streaming:
+            response, stream = stream_request(http, batch_url, body=body, method="POST", headers=headers)
+            self.note_extensions(response)
+            return self.stream_parts(response, stream)
+        if hasattr(body, 'rewind'):
+            # httplib2 retries a failed request itself, without rewinding.
+            rewinding_connection(http, batch_url)
+        response, content = http.request(batch_url, body=body, method="POST", headers=headers)
+        self.note_extensions(response)
+        return iter(self.response_parts(response, content))
+
+    def note_extensions(self, response):
+        """Records the batch protocol extensions the batch processor says it
+        supports in the ``Batch-Extensions`` header of `response`, so that
+        later batch requests to the same endpoint, sharing the `extensions`
+        set, can use them.
+
+        The set is made to match what the response advertises, so an
+        extension the batch processor no longer offers is forgotten. Until
+        the ``shared-headers`` extension has been seen, every subrequest is
+        sent with all its own headers.
+
+        """
+        value = response.get('batch-extensions') or ''
+        advertised = set(ext.strip().lower() for ext in value.split(',')
+            if ext.strip())
+        # Update in place without dropping anything that's still offered, as
+        # other threads' batch requests may be reading the set.
+        self.extensions.intersection_update(advertised)
+        self.extensions.update(advertised)
+
+    def process_chunks(self, http, batch_url, chunks):
+        """Performs the batch requests in `chunks`, a sequence of header
+        mapping and body pairs as returned by `construct_chunks()`,
+        concurrently.
+
+        Up to `concurrency` batch requests are made at once, each on its own
+        thread with connections from `http`'s `connection_pool` (or a new
+        pool, if `http` has none). Subresponses are dispatched on the calling
+        thread as each chunk's response arrives.
+
+        If any of the chunks fail, the subresponses of the others are still
+        dispatched, then a `PartialBatchError` describing the failures is
+        raised.
 
-        msg = MultipartHTTPMessage()
+        """
+        pool = getattr(http, 'connection_pool', None)
+        if pool is None:
+            pool = ConnectionPool()
+
+        events = Queue.Queue()
+        pending = Queue.Queue()
+        for index, chunk in enumerate(chunks):
+            pending.put((index, chunk))
+
+        def work():
+            conns = pool.acquire()
+            try:
+                clone = copy.copy(http)
+                clone.connections = conns
+                while True:
+                    try:
+                        index, (headers, body) = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        for part in self.perform(clone, batch_url, headers, body):
+                            events.put((index, part, None))
+                    except Exception, exc:
+                        events.put((index, None, exc))
+                    events.put((index, None, None))
+            finally:
+                pool.release(conns)
+
+        for i in range(min(self.concurrency, len(chunks))):
+            worker = threading.Thread(target=work)
+            worker.setDaemon(True)
+            worker.start()
+
+        errors = {}
+        remaining = len(chunks)
+        while remaining:
+            index, part, exc = events.get()
+            if part is not None:
+                if index in errors:
+                    continue
+                try:
+                    self.dispatch_part(http, part)
+                except Exception, exc:
+                    errors[index] = exc
+            elif exc is not None:
+                errors.setdefault(index, exc)
+            else:
+                remaining -= 1
+
+        if errors:
+            raise PartialBatchError([errors[index] for index in sorted(errors)], len(chunks))
+
+    def _messages(self, http):
+        # Subrequests identical to an earlier one are left out, to be given
+        # that one's subresponse (see `dispatch_part()`), as are those with
+        # fresh cached responses (see `dispatch_fresh()`). So are those with
+        # stale ones, if they may be used while they're revalidated; they're
+        # listed in `stale` for the client to revalidate later.
+        prepared = []
+        sent = {}
+        self.duplicates = {}
+        self.deduplicated = 0
+        self.fresh = []
+        self.stale = []
+        self.cache = cache = SubrequestCache(http)
+        cache.load([r for r in self.requests if r.alive()])
         request_id = 1
         for request in self.requests:
+            if not request.alive():
+                request_id += 1
+                continue
+
+            key = request.dedup_key()
+            if key in sent:
+                self.duplicates.setdefault(sent[key], []).append(request)
+                self.deduplicated += 1
+                request_id += 1
+                continue
+            cached = cache.fresh_response(request.reqinfo)
+            if cached is None and self.stale_while_revalidate:
+                cached = cache.stale_response(request.reqinfo, self.stale_grace)
+                if cached is not None:
+                    self.stale.append(request.reqinfo)
+            if cached is not None:
+                self.fresh.append((request, cached))
+                request_id += 1
+                continue
+
             try:
-                submsg = request.as_message(http, request_id)
+                prepared.append((request, request_id, request.prepare(http, cache)))
             except ReferenceError:
                 pass
             else:
-                msg.attach(submsg)
+                if key is not None:
+                    sent[key] = request_id
             request_id += 1
 
-        # Do this ahead of getting headers, since the boundary is not
-        # assigned until we bake the multipart message:
-        content = msg.as_string(write_headers=False)
-        hdrs = msg.items()
-        headers = {}
-        for hdr in hdrs:
-            headers[hdr[0]] = hdr[1]
+        # Headers every subrequest would send alike are declared once, in a
+        # shared headers part, if the batch processor has said it reads one.
+        self.hoisted = []
+        if self.hoist_headers and SHARED_HEADERS_EXTENSION in self.extensions:
+            self.hoisted = common_headers([headers.items()
+                for request, request_id, (requestline, headers, body) in prepared])
+        messages = [request.message(subrequest, request_id, self.transfer_encoding,
+                self.hoisted)
+            for request, request_id, subrequest in prepared]
+
+        if self.deduplicated:
+            log.debug('Left %d duplicate subrequests out of the batch'
+                % self.deduplicated)
+        if self.fresh:
+            log.debug('Answered %d subrequests from the cache (%d of them stale)'
+                % (len(self.fresh), len(self.stale)))
+        return messages
+
+    def dispatch_fresh(self):
+        """Dispatches the cached responses of the subrequests that were left
+        out of the batch request because they were fresh in the cache.
+
+        This is done by `process()`, before performing the batch request. Any
+        other code that constructs and performs the batch request itself
+        should do it too.
+
+        """
+        fresh, self.fresh = self.fresh, []
+        for request, (response, content) in fresh:
+            if self.body_views:
+                content = BodyView(content)
+            try:
+                request.callback(request.reqinfo['uri'], response, content)
+            except ReferenceError:
+                pass
+
+    def _assemble(self, messages):
+        writer = MultipartWriter()
+        if self.hoisted:
+            writer.add(SharedHeadersPart(self.hoisted, self.transfer_encoding))
+        for submsg in messages:
+            writer.add(submsg)
+        headers = writer.headers()
+        if self.hoist_headers:
+            headers['Batch-Extensions'] = SHARED_HEADERS_EXTENSION
+        if self.gzip_request:
+            headers['Content-Encoding'] = 'gzip'
+            if self.stream_upload:
+                del headers['Content-Length']
+                headers['Transfer-Encoding'] = 'chunked'
+                content = ChunkedGzipBody(writer, self.gzip_level)
+            else:
+                content = ''.join(gzip_chunks(writer.iterchunks(), self.gzip_level))
+                headers['Content-Length'] = str(len(content))
+        elif self.stream_upload:
+            content = writer.open()
+        else:
+            content = writer.getvalue()
 
         # lets prefer gzip encoding on the batch response
         headers['accept-encoding'] = 'gzip;q=1.0, identity; q=0.5, *;q=0'
 
         return headers, content
 
+    def construct(self, http):
+        """Builds a batch HTTP request from the `BatchRequest` instance's
+        constituent subrequests.
+
+        The batch request is returned as a tuple containing a mapping of HTTP
+        headers and the text of the request body. If this `BatchRequest` is
+        `stream_upload`, the body is instead a file-like
+        `batchhttp.multipart.MultipartBody` that writes the body as it's read.
+
+        If this `BatchRequest` is `gzip_request`, the body is compressed with
+        gzip, and sent with a ``Content-Encoding: gzip`` header. A streamed
+        compressed body can't know its length in advance, so it is a
+        `batchhttp.multipart.ChunkedGzipBody`, sent in the chunked
+        Transfer-Encoding.
+
+        A ``GET`` or ``HEAD`` subrequest identical to an earlier one is left
+        out, and gets that one's subresponse instead (see
+        `Request.dedup_key()`). The number left out is counted in the
+        `deduplicated` attribute.
+
+        Subrequests whose responses are fresh in `http`'s cache are left out
+        as well, to be answered by `dispatch_fresh()`. If that leaves nothing
+        to send, ``(None, None)`` is returned.
+
+        """
+        if not len(self):
+            log.debug('No requests were made for the batch')
+            return None, None
+
+        messages = self._messages(http)
+        if not messages:
+            return None, None
+        return self._assemble(messages)
+
+    def construct_chunks(self, http):
+        """Builds one or more batch HTTP requests from the `BatchRequest`
+        instance's constituent subrequests, splitting them so that no batch
+        request contains more than `max_subrequests` subrequests or (unless
+        it contains only a single subrequest) is larger than about
+        `max_batch_bytes` bytes.
+
+        Returns a list of tuples, each containing a mapping of HTTP headers and
+        the text of a request body (or a file-like body, as for `construct()`). If there are no subrequests to perform
+        (perhaps because their responses are all fresh in the cache; see
+        `construct()`), the list is empty.
+
+        """
+        if not len(self):
+            log.debug('No requests were made for the batch')
+            return []
+
+        messages = self._messages(http)
+        if not messages:
+            return []
+        if self.max_subrequests is None and self.max_batch_bytes is None:
+            return [self._assemble(messages)]
+
+        chunks, chunk, chunk_bytes = [], [], 0
+        for submsg in messages:
+            size = len(submsg) + self.part_overhead
+            if chunk and (len(chunk) == self.max_subrequests
+                or self.max_batch_bytes is not None
+                and chunk_bytes + size > self.max_batch_bytes):
+                chunks.append(chunk)
+                chunk, chunk_bytes = [], 0
+            chunk.append(submsg)
+            chunk_bytes += size
+        chunks.append(chunk)
+
+        log.debug('Split batch of %d subrequests into %d batches'
+            % (len(messages), len(chunks)))
+        return [self._assemble(chunk) for chunk in chunks]
+
     def handle_response(self, http, response, content):
         """Dispatches the subresponses contained in the given batch HTTP
         response to the associated callbacks.
@@ -510,66 +1567,145 @@ class BatchRequest(object):
         constituent subresponses, a `BatchError` is raised.
 
         """
+        for part in self.response_parts(response, content):
+            self.dispatch_part(http, part)
+
+    def response_parts(self, response, content):
+        """Returns the list of `batchhttp.multipart.Part` instances in the
+        given batch HTTP response, raising a `BatchError` if it is not a
+        successful multipart batch response."""
         # was the response okay?
         if response.status != 207:
             log.debug('Received non-batch response %d %s with content:\n%s'
                 % (response.status, response.reason, content))
             raise NonBatchResponseError(response.status, response.reason)
 
-        # parse content into pieces
-
-        # Prevent the application/http-response sub-parts from turning into
-        # Messages, as the HTTP status line will confuse the parser and
-        # we'll just get a text/plain Message with our response for the
-        # payload anyway.
-        class HttpAverseParser(FeedParser):
-            def _parse_headers(self, lines):
-                FeedParser._parse_headers(self, lines)
-                if self._cur.get_content_type() == 'application/http-response':
-                    self._set_headersonly()
-
-        p = HttpAverseParser()
-        headers = ""
-        for hdr in response:
-            headers += "%s: %s\n" % (hdr, Header(response[hdr]).encode(), )
-
-        p.feed(headers)
-        p.feed("\n")
-        p.feed(content)
-        message = p.close()
-
-        if not message.is_multipart():
-            log.debug('RESPONSE: ' + str(response))
+        boundary = self.response_boundary(response)
+        try:
+            return list(SharedHeaders().apply(parse_multipart(content, boundary)))
+        except ParserError, exc:
             log.debug('CONTENT: ' + content)
-            raise BatchError('Response was not a MIME multipart response set')
+            raise BatchError('Could not parse batch response: %s' % (exc,))
 
-        response = {}
-        messages = message.get_payload()
+    def handle_stream(self, http, response, stream):
+        """Dispatches the subresponses contained in the given batch HTTP
+        response to the associated callbacks as they are read.
+
+        Parameters `http` and `response` are as for `handle_response()`.
+        Parameter `stream` is a file-like object from which the (decoded) batch
+        response content can be read.
 
-        for part in messages:
-            if part.get_content_type() != 'application/http-response':
-                raise BatchError('Batch response included a part that was not an HTTP response message')
+        Each subresponse is dispatched as soon as its part of the content has
+        been read, and is released before reading continues, so the whole
+        batch response is never held in memory at once. If the batch response
+        is not a successful ``207 Multi-Status`` response or is not a complete
+        multipart response, a `BatchError` is raised; subresponses that were
+        read before the problem was found will already have been dispatched.
+
+        """
+        for part in self.stream_parts(response, stream):
+            self.dispatch_part(http, part)
+
+    def stream_parts(self, response, stream):
+        """Generates the `batchhttp.multipart.Part` instances of the given
+        batch HTTP response as they are read from `stream`, closing `stream`
+        when done. A `BatchError` is raised if the response is not a
+        successful and complete multipart batch response."""
+        try:
+            if response.status != 207:
+                content = stream.read()
+                log.debug('Received non-batch response %d %s with content:\n%s'
+                    % (response.status, response.reason, content))
+                raise NonBatchResponseError(response.status, response.reason)
+
+            boundary = self.response_boundary(response)
+
+            parser = MultipartFeedParser(boundary, self.spill_threshold)
+            shared = SharedHeaders()
+            while not parser.done:
+                data = stream.read(self.read_size)
+                if not data:
+                    break
+                for part in shared.apply(parser.feed(data)):
+                    yield part
             try:
-                request_id = int(part['Multipart-Request-ID'])
-            except KeyError:
-                raise BatchError('Batch response included a part with no Multipart-Request-ID header')
-            except ValueError:
-                raise BatchError('Batch response included a part with an invalid Multipart-Request-ID header')
+                parser.close()
+            except ParserError, exc:
+                raise BatchError('Batch response was incomplete: %s' % (exc,))
+        finally:
+            stream.close()
+
+    def response_boundary(self, response):
+        """Returns the multipart boundary of the batch HTTP response described
+        by `response`, raising a `BatchError` if it is not a multipart
+        response."""
+        content_type, params = parse_content_type(response.get('content-type'))
+        boundary = params.get('boundary')
+        if not content_type.startswith('multipart/') or not boundary:
+            log.debug('RESPONSE: ' + str(response))
+            raise BatchError('Response was not a MIME multipart response set')
+        return boundary
+
+    def dispatch_part(self, http, part):
+        """Dispatches one subresponse, the `batchhttp.multipart.Part` `part`
+        of a batch response, to its associated `Request` instance.
+
+        If the part is not an identifiable HTTP response message, a
+        `BatchError` is raised.
 
-            request = self.requests[request_id-1]
+        """
+        if part.get_content_type() != 'application/http-response':
+            raise BatchError('Batch response included a part that was not an HTTP response message')
+        try:
+            request_id = int(part['Multipart-Request-ID'])
+        except (KeyError, TypeError):
+            raise BatchError('Batch response included a part with no Multipart-Request-ID header')
+        except ValueError:
+            raise BatchError('Batch response included a part with an invalid Multipart-Request-ID header')
+
+        if not 0 < request_id <= len(self.requests):
+            raise BatchError('Batch response included a part with an unknown Multipart-Request-ID header')
+        request = self.requests[request_id-1]
+        if self.cache is None or self.cache.http is not http:
+            self.cache = SubrequestCache(http)
+        duplicates = self.duplicates.get(request_id)
+        if not duplicates:
             try:
-                request.decode_response(http, part)
+                request.decode_response(http, part, self.cache, self.body_views,
+                    self.spill_threshold)
             except ReferenceError:
                 # We shouldn't have lost any references to request objects
                 # since the request, but just in case.
                 pass
+            return
+
+        # Give every identical subrequest its own copy of the response.
+        httpresponse, body = request.parse_response(http, part, self.cache,
+            self.body_views, self.spill_threshold)
+        for request in [request] + duplicates:
+            try:
+                request.callback(request.reqinfo['uri'], copy.copy(httpresponse),
+                    copy.copy(body))
+            except ReferenceError:
+                pass
 
 
 class BatchClient(httplib2.Http):
 
-    """Sort of an HTTP client for performing a batch HTTP request."""
+    """Sort of an HTTP client for performing a batch HTTP request.
 
-    def __init__(self, endpoint=None, **kwargs):
+    A `BatchClient` can be shared by many threads. Each thread has its own
+    open batch request, and takes connections from the client's
+    `connection_pool` as it needs them, so all the threads share the client's
+    cache, credentials and idle connections.
+
+    """
+
+    def __init__(self, endpoint=None, streaming=False, transfer_encoding='quoted-printable',
+                 max_subrequests=None, max_batch_bytes=None, concurrency=4,
+                 stale_while_revalidate=False, stale_grace=0, stream_upload=False,
+                 body_views=False, spill_threshold=None, gzip_request=False,
+                 hoist_headers=True, **kwargs):
         """Configures the `BatchClient` instance to use the given batch
         processor endpoint.
 
@@ -578,14 +1714,140 @@ class BatchClient(httplib2.Http):
         should be the resource ``/batch-processor`` at the root of the site
         specified in `endpoint`.
 
+        If parameter `streaming` is true, batch responses are read from the
+        connection incrementally, and each subresponse is given to its
+        callback as soon as it arrives instead of once the whole batch
+        response has been received.
+
+        Parameter `transfer_encoding` is the Content-Transfer-Encoding with
+        which to send subrequests. The default, ``quoted-printable``, is safe
+        for any batch processor; ``binary`` or ``8bit`` send subrequests
+        verbatim, which is smaller and cheaper for binary and non-ASCII
+        content. Subresponses are decoded from whichever of these encodings
+        the batch processor uses.
+
+        Parameters `max_subrequests` and `max_batch_bytes` limit the number of
+        subrequests and the approximate size of the body of each batch request.
+        Larger batches are split into several batch requests, up to
+        `concurrency` of which are performed at once over separate pooled
+        connections.
+
+        If parameter `stale_while_revalidate` is true, subrequests whose
+        cached responses have only recently become stale are answered from
+        the cache straight away, and revalidated afterward in a background
+        batch request (see `revalidate()`). How long a response may be used
+        once stale is given by its ``stale-while-revalidate`` Cache-Control
+        directive, or is `stale_grace` seconds if it has none.
+
+        If parameter `stream_upload` is true, batch request bodies are written
+        to the connection as they're put together instead of being built in
+        memory first. Subrequest bodies given as files are then read only as
+        they're sent.
+
+        If parameter `body_views` is true, callbacks are given subresponse
+        bodies as read-only file-like `batchhttp.multipart.BodyView` objects
+        that refer to the batch response instead of copying out of it. When
+        the batch response is `streaming`, a subresponse larger than
+        `spill_threshold` bytes is written to a temporary file as it arrives,
+        and its body is a view of an `mmap` of that file, so large
+        subresponses needn't be held in memory.
+
+        If parameter `gzip_request` is true, batch request bodies are
+        compressed with gzip. The batch processor must accept a
+        ``Content-Encoding: gzip`` request, as `batchhttp.batchproxy` does.
+
+        If parameter `hoist_headers` is true (the default), batch requests
+        offer the ``shared-headers`` extension, and once the batch processor
+        has answered that it supports it, headers common to all of a batch's
+        subrequests are sent once in a shared headers part instead of in every
+        subrequest. Batch processors that don't answer get self-contained
+        subrequests as before. What each endpoint supports is kept in
+        `batch_extensions`, following its latest batch response.
+
         """
+        if transfer_encoding.lower() not in TRANSFER_ENCODINGS:
+            raise ValueError('Unsupported transfer encoding %r' % (transfer_encoding,))
         self.endpoint = endpoint
+        self.streaming = streaming
+        self.stream_upload = stream_upload
+        self.body_views = body_views
+        self.spill_threshold = spill_threshold
+        self.gzip_request = gzip_request
+        self.hoist_headers = hoist_headers
+        self.batch_extensions = {}
+        self.transfer_encoding = transfer_encoding
+        self.max_subrequests = max_subrequests
+        self.max_batch_bytes = max_batch_bytes
+        self.concurrency = concurrency
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_grace = stale_grace
+        self.connection_pool = ConnectionPool()
+        self._local = threading.local()
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
         super(BatchClient, self).__init__(**kwargs)
+        # Let this thread take its connections from the pool like any other.
+        del self._local.connections
+
+    def _get_batchrequest(self):
+        return self._local.batchrequest
+
+    def _set_batchrequest(self, batchrequest):
+        self._local.batchrequest = batchrequest
+
+    def _del_batchrequest(self):
+        del self._local.batchrequest
+
+    batchrequest = property(_get_batchrequest, _set_batchrequest, _del_batchrequest,
+        doc="""The current thread's open `BatchRequest`, if any.""")
+
+    def _get_connections(self):
+        try:
+            return self._local.connections
+        except AttributeError:
+            connections = self._local.connections = self.connection_pool.acquire()
+            return connections
+
+    def _set_connections(self, connections):
+        self._local.connections = connections
+
+    connections = property(_get_connections, _set_connections,
+        doc="""The mapping of open connections used by the current thread.
+
+        A thread's connections are taken from `connection_pool` when it
+        first makes a request, and returned to it once that request (or the
+        batch request it is part of) is complete. Connections assigned
+        explicitly are kept until they're replaced.""")
+
+    def _hold_connections(self):
+        # Returns whether the current thread took its connections from the
+        # pool just now, and so should give them back when it's done.
+        if hasattr(self._local, 'connections'):
+            return False
+        self._local.connections = self.connection_pool.acquire()
+        return True
+
+    def _release_connections(self):
+        connections = self._local.connections
+        del self._local.connections
+        self.connection_pool.release(connections)
+
+    def __copy__(self):
+        # Chunks of a split batch are performed with copies of the client.
+        # Copy everything, rather than what httplib2's __getstate__ keeps for
+        # pickling, which leaves out the connections and any replacement
+        # request() method. Only the per-thread state isn't shared.
+        clone = self.__class__.__new__(self.__class__)
+        clone.__dict__.update(self.__dict__)
+        clone._local = threading.local()
+        return clone
 
     def batch_request(self, headers=None):
         """Opens a batch request.
 
-        If a batch request is already open, a `BatchError` is raised.
+        If a batch request is already open in the current thread, a
+        `BatchError` is raised. Other threads may have their own batch
+        requests open at the same time.
 
         In Python 2.5 or later, you can use this method with the ``with``
         statement::
@@ -604,15 +1866,28 @@ class BatchClient(httplib2.Http):
         if hasattr(self, 'batchrequest'):
             # hey, we already have a request. this is invalid...
             log.debug('Batch request previously opened at:\n'
-                + ''.join(traceback.format_list(self._opened)))
+                + ''.join(traceback.format_list(self._local.opened)))
             log.debug('New now at:\n' + ''.join(traceback.format_stack()))
             raise BatchError("There's already an open batch request")
-        self.batchrequest = BatchRequest(headers=headers)
-        self._opened = traceback.extract_stack()
+        self.batchrequest = self.new_batch_request(headers)
+        self._local.opened = traceback.extract_stack()
 
         # Return ourself so we can enter a "with" context.
         return self
 
+    def new_batch_request(self, headers=None):
+        """Returns a new, empty `BatchRequest` configured with this client's
+        options, without opening it as the client's batch request."""
+        return BatchRequest(headers=headers, streaming=self.streaming,
+            transfer_encoding=self.transfer_encoding,
+            max_subrequests=self.max_subrequests,
+            max_batch_bytes=self.max_batch_bytes, concurrency=self.concurrency,
+            stale_while_revalidate=self.stale_while_revalidate,
+            stale_grace=self.stale_grace, stream_upload=self.stream_upload,
+            body_views=self.body_views, spill_threshold=self.spill_threshold,
+            gzip_request=self.gzip_request, hoist_headers=self.hoist_headers,
+            extensions=self.batch_extensions.setdefault(self.endpoint, set()))
+
     def complete_batch(self):
         """Closes a batch request, submitting it and dispatching the
         subresponses.
@@ -626,10 +1901,72 @@ class BatchClient(httplib2.Http):
             raise BatchError("There's no batch processor endpoint to which to send a batch request")
         try:
             log.debug('Making batch request for %d items' % len(self.batchrequest))
-            self.batchrequest.process(self, self.endpoint)
+            self.process_batch(self.batchrequest)
         finally:
             del self.batchrequest
 
+    def process_batch(self, batchrequest):
+        """Performs the `BatchRequest` `batchrequest`, whether or not it is
+        the current thread's open batch request, dispatching its
+        subresponses."""
+        if self.endpoint is None:
+            raise BatchError("There's no batch processor endpoint to which to send a batch request")
+        held = self._hold_connections()
+        try:
+            batchrequest.process(self, self.endpoint)
+        finally:
+            if held:
+                self._release_connections()
+            if batchrequest.stale:
+                self.revalidate(batchrequest.stale)
+
+    def revalidate(self, reqinfos):
+        """Revalidates the cached responses to the given subrequests in a
+        batch request of their own, performed on a background thread.
+
+        The subresponses only update the cache. Subrequests that are already
+        being revalidated are left out. Returns the background thread, or
+        ``None`` if there was nothing to revalidate.
+
+        """
+        cache = SubrequestCache(self)
+        todo, keys = [], []
+        self._revalidating_lock.acquire()
+        try:
+            for reqinfo in reqinfos:
+                key = cache.cache_key(reqinfo)
+                if key not in self._revalidating:
+                    self._revalidating.add(key)
+                    todo.append(reqinfo)
+                    keys.append(key)
+        finally:
+            self._revalidating_lock.release()
+        if not todo:
+            return None
+
+        thread = threading.Thread(target=self._revalidate, args=(todo, keys))
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def _revalidate(self, reqinfos, keys):
+        batchrequest = self.new_batch_request()
+        batchrequest.stale_while_revalidate = False
+        for reqinfo in reqinfos:
+            batchrequest.add(reqinfo, ignore_response)
+        try:
+            try:
+                log.debug('Revalidating %d stale cached responses' % len(reqinfos))
+                self.process_batch(batchrequest)
+            except Exception:
+                log.exception('Revalidation batch request failed')
+        finally:
+            self._revalidating_lock.acquire()
+            try:
+                self._revalidating.difference_update(keys)
+            finally:
+                self._revalidating_lock.release()
+
     def clear_batch(self):
         """Closes a batch request without performing it."""
         try:
@@ -638,7 +1975,7 @@ class BatchClient(httplib2.Http):
             # well it's already cleared then isn't it
             pass
 
-    def batch(self, reqinfo, callback):
+    def batch(self, reqinfo, callback=None):
         """Adds the given subrequest to the batch request.
 
         Parameter `reqinfo` is the HTTP request to perform, specified as a
@@ -652,12 +1989,22 @@ class BatchClient(httplib2.Http):
         referenced elsewhere, the subrequest will be omitted from the batch
         request and `callback` will not be called with a subresponse.
 
+        If `callback` is omitted, a `BatchFuture` is returned instead, which
+        resolves to the subresponse once it has been decoded::
+
+        >>> with client.batch_request():
+        ...     moose = client.batch({'uri': moose_uri})
+        >>> response, content = moose.result()
+
+        The same rule applies: drop the `BatchFuture` before the batch request
+        is completed, and the subrequest is omitted.
+
         If no batch request is open, a `BatchError` is raised.
 
         """
         if not hasattr(self, 'batchrequest'):
             raise BatchError("There's no open batch request to add an object to")
-        self.batchrequest.add(reqinfo, callback)
+        return self.batchrequest.add(reqinfo, callback)
 
     def request(self, uri, method="GET", body=None, headers=None, redirections=httplib2.DEFAULT_MAX_REDIRECTS, connection_type=None):
         req_log = logging.getLogger('.'.join((__name__, 'request')))
@@ -671,7 +2018,12 @@ class BatchClient(httplib2.Http):
                     '%s: %s' % (k, v) for k, v in headeritems
                 ]), body or '')
 
-        response, content = super(BatchClient, self).request(uri, method, body, headers, redirections, connection_type)
+        held = self._hold_connections()
+        try:
+            response, content = super(BatchClient, self).request(uri, method, body, headers, redirections, connection_type)
+        finally:
+            if held:
+                self._release_connections()
 
         resp_log = logging.getLogger('.'.join((__name__, 'response')))
         if resp_log.isEnabledFor(logging.DEBUG):
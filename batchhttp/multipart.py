@@ -31,14 +31,20 @@ from email.Message import Message
 from email.Generator import Generator
 from email.MIMEText import MIMEText
 from email.MIMEMessage import MIMEMessage
-from email.Parser import Parser
 from urlparse import urlparse, urlunparse
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 import base64
+import binascii
+import mmap
 import quopri
+import random
+import re
+import sys
+import tempfile
+import zlib
 
 
 def bdecode(s):
@@ -57,23 +63,492 @@ def parse_uri(uri):
     return parts[0], parts[1], urlunparse([None, None] + parts[2:])
 
 
+_param_re = re.compile(r''';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)''')
+
+
+def parse_content_type(value):
+    """Parse a Content-Type header value. Return the lowercased MIME type and a
+    dictionary of its parameters, keyed by lowercased parameter name."""
+    if value is None:
+        return 'text/plain', {}
+    content_type = value.split(';', 1)[0].strip().lower()
+    if content_type.count('/') != 1:
+        # Treat invalid content types as text/plain, as the email package does.
+        content_type = 'text/plain'
+    params = {}
+    for name, param in _param_re.findall(value):
+        param = param.strip()
+        if len(param) > 1 and param[0] == param[-1] == '"':
+            param = re.sub(r'\\(.)', r'\1', param[1:-1])
+        params[name.lower()] = param
+    return content_type, params
+
+
+def parse_headers(text, start=0, end=None):
+    """Parse the MIME or HTTP header block that starts at index `start` of
+    `text`.
+
+    Return a list of (lowercased name, value) pairs, with any folded header
+    values unfolded, and the index at which the body following the headers
+    begins. The header block ends at the first empty line, or at the first line
+    that isn't a header at all.
+
+    """
+    if end is None:
+        end = len(text)
+    headers = []
+    pos = start
+    while pos < end:
+        eol = text.find('\n', pos, end)
+        if eol == -1:
+            line_end = next = end
+        else:
+            line_end, next = eol, eol + 1
+        if line_end > pos and text[line_end-1] == '\r':
+            line_end -= 1
+        if line_end == pos:
+            return headers, next
+        if text[pos] in ' \t' and headers:
+            name, value = headers[-1]
+            headers[-1] = (name, '%s %s' % (value, text[pos:line_end].strip()))
+        else:
+            colon = text.find(':', pos, line_end)
+            if colon <= pos:
+                # Not a header, so the body starts here without a blank line.
+                return headers, pos
+            headers.append((text[pos:colon].strip().lower(),
+                text[colon+1:line_end].strip()))
+        pos = next
+    return headers, end
+
+
+TRANSFER_ENCODINGS = ('quoted-printable', 'binary', '8bit')
+
+
+def delimiter_break(encoding):
+    """Returns the line break to write between a part in the given
+    Content-Transfer-Encoding and the delimiter line after it.
+
+    Parsers take a CR before the delimiter's LF as part of the line break, so
+    a payload copied verbatim (``binary`` or ``8bit``), which may itself end
+    with a CR, is followed by a CRLF. Other payloads, which never end with a
+    bare CR (quoted-printable escapes it), are followed by a bare LF.
+
+    """
+    if encoding and encoding.lower() in ('binary', '8bit'):
+        return '\r\n'
+    return '\n'
+
+
+def _escape_final_cr(encoded):
+    # Quoted-printable leaves a bare CR as it is, but one that ends the payload
+    # would be taken for part of the line break before the next delimiter.
+    if encoded.endswith('\r'):
+        return encoded[:-1] + '=0D'
+    return encoded
+
+
+def encode_payload(payload, encoding):
+    """Encode a MIME part payload in the given Content-Transfer-Encoding.
+
+    Payloads are quoted-printable encoded for ``quoted-printable``, and copied
+    verbatim for ``binary`` and ``8bit``. ``base64`` is also supported, for
+    payloads that must be kept clear of a multipart boundary chosen before
+    they were known (base64 text never contains ``--``). Any other encoding
+    raises a `ValueError`.
+
+    """
+    encoding = encoding.lower()
+    if encoding == 'quoted-printable':
+        encoded = StringIO()
+        quopri.encode(StringIO(payload), encoded, quotetabs=False)
+        return _escape_final_cr(encoded.getvalue())
+    elif encoding in ('binary', '8bit'):
+        return payload
+    elif encoding == 'base64':
+        return base64.encodestring(payload)
+    raise ValueError('Unsupported Content-Transfer-Encoding %r' % (encoding,))
+
+
+def decode_payload(payload, encoding):
+    """Decode a MIME part payload from the given Content-Transfer-Encoding.
+    Payloads in unknown or identity (``binary``, ``8bit`` or ``7bit``)
+    encodings are returned unchanged."""
+    encoding = (encoding or '').lower()
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(payload)
+    elif encoding == 'base64':
+        return bdecode(payload)
+    return payload
+
+
+def decode_blocks(text, encoding, start=0, end=None, blocksize=65536):
+    """Generates the decoded content of the MIME part payload spanning
+    `text[start:end]` about `blocksize` bytes at a time, as `decode_payload()`
+    would decode it whole. `text` may be a string or an `mmap`."""
+    if end is None:
+        end = len(text)
+    encoding = (encoding or '').lower()
+    if encoding == 'quoted-printable':
+        decode = binascii.a2b_qp
+    elif encoding == 'base64':
+        decode = binascii.a2b_base64
+    else:
+        decode = None
+
+    pos = start
+    while pos < end:
+        stop = min(pos + blocksize, end)
+        if decode is not None and stop < end:
+            # Decode whole lines at a time.
+            eol = text.find('\n', stop, end)
+            if eol == -1:
+                stop = end
+            else:
+                stop = eol + 1
+        block = text[pos:stop]
+        if decode is not None:
+            block = decode(block)
+        yield block
+        pos = stop
+
+
+def spill(blocks):
+    """Writes the strings `blocks` to a temporary file, returning a read-only
+    `mmap` of it, or an empty string if there was nothing to write.
+
+    The file is deleted right away, so the disk space it takes is freed when
+    the `mmap` is closed or garbage collected.
+
+    """
+    fp = tempfile.TemporaryFile()
+    try:
+        for block in blocks:
+            fp.write(block)
+        fp.flush()
+        if not fp.tell():
+            return ''
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fp.close()
+
+
+class BodyView(object):
+
+    """A read-only file-like view of `length` bytes of `data`, a string or an
+    `mmap`, starting at index `offset`.
+
+    Reading from a `BodyView` copies out only what is read. The bytes can also
+    be had without copying them at all, as a read-only `buffer` from
+    `getbuffer()`, or all at once as a string from `getvalue()`.
+
+    """
+
+    def __init__(self, data, offset=0, length=None):
+        if length is None:
+            length = len(data) - offset
+        self.data = data
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        return self.getvalue()
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def getbuffer(self):
+        """Returns a read-only `buffer` of the viewed bytes."""
+        return buffer(self.data, self.offset, self.length)
+
+    def getvalue(self):
+        """Returns the viewed bytes as a string."""
+        return self.data[self.offset:self.offset+self.length]
+
+    def read(self, size=-1):
+        """Reads at most `size` bytes, or all the rest if `size` is negative
+        or omitted."""
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        start = self.offset + self.position
+        self.position += size
+        return self.data[start:start+size]
+
+    def readline(self, size=-1):
+        """Reads one line, up to at most `size` bytes."""
+        start = self.offset + self.position
+        end = self.offset + self.length
+        if size is not None and size >= 0:
+            end = min(end, start + size)
+        eol = self.data.find('\n', start, end)
+        if eol != -1:
+            end = eol + 1
+        self.position = end - self.offset
+        return self.data[start:end]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.length
+        self.position = max(0, min(offset, self.length))
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        pass
+
+
+SHARED_HEADERS_TYPE = 'application/http-headers'
+SHARED_HEADERS_EXTENSION = 'shared-headers'
+
+
+def common_headers(header_lists, exclude=('content-length',)):
+    """Returns the (name, value) pairs that occur, once each, in every list
+    of HTTP header pairs in `header_lists`: the headers that can be shared by
+    all the messages in a batch rather than repeated in each.
+
+    Header names are compared case insensitively, and headers named in
+    `exclude` are never shared. If there are fewer than two lists, nothing is
+    worth sharing and the result is empty.
+
+    """
+    if len(header_lists) < 2:
+        return []
+    common = None
+    for headers in header_lists:
+        counts = {}
+        for name, value in headers:
+            name = name.lower()
+            counts[name] = counts.get(name, 0) + 1
+        pairs = set([(name.lower(), value) for name, value in headers
+            if counts[name.lower()] == 1 and name.lower() not in exclude])
+        if common is None:
+            common = pairs
+        else:
+            common &= pairs
+        if not common:
+            return []
+    return sorted(common)
+
+
+def inherit_headers(headers, shared):
+    """Returns the list of HTTP header pairs `headers` with each of the
+    `shared` header pairs that isn't overridden by one of the same name
+    appended."""
+    if not shared:
+        return headers
+    names = set([name.lower() for name, value in headers])
+    return headers + [(name, value) for name, value in shared
+        if name.lower() not in names]
+
+
+class SharedHeaders(object):
+
+    """Tracks the headers shared by the HTTP messages in a multipart body.
+
+    A batch whose processor supports the ``shared-headers`` extension may
+    carry a ``application/http-headers`` part, whose payload is a block of
+    HTTP headers that every HTTP message part after it inherits, unless it
+    has a header of the same name itself. `apply()` takes such parts out of a
+    sequence of parts and sets the `shared_headers` of the others.
+
+    """
+
+    def __init__(self):
+        self.headers = []
+
+    def apply(self, parts):
+        """Generates the `Part` instances in `parts` other than shared header
+        parts, with their `shared_headers` set."""
+        for part in parts:
+            if part.get_content_type() == SHARED_HEADERS_TYPE:
+                self.headers = parse_headers(part.get_payload(decode=True))[0]
+                continue
+            part.shared_headers = self.headers
+            yield part
+
+
 class BadRequestException(Exception): pass
 class BadResponseException(Exception): pass
 class ParserError(Exception): pass
 
 
+class Part(object):
+
+    """A body part of a MIME multipart message.
+
+    `Part` instances are the lightweight records produced by `parse_multipart()`
+    and `MultipartFeedParser`. Their `headers` are a list of (lowercased name,
+    value) pairs and their `payload` is the raw text of the part body, still in
+    its Content-Transfer-Encoding. For convenience, `Part` supports the
+    subset of the `email.message.Message` interface used for HTTP parts.
+
+    The payload is kept as the span from `start` to `end` of the `text` it
+    was parsed from, which may be a string or an `mmap`, and is only copied
+    out when `payload` is asked for.
+
+    The `shared_headers` are the HTTP headers the HTTP message in the part
+    inherits from the batch (see `SharedHeaders`).
+
+    """
+
+    shared_headers = ()
+
+    def __init__(self, headers, text, start=0, end=None):
+        if end is None:
+            end = len(text)
+        self.headers = headers
+        self.text = text
+        self.start = start
+        self.end = end
+
+    @property
+    def payload(self):
+        if self.start == 0 and self.end == len(self.text) and isinstance(self.text, str):
+            return self.text
+        return self.text[self.start:self.end]
+
+    def get(self, name, failobj=None):
+        name = name.lower()
+        for header, value in self.headers:
+            if header == name:
+                return value
+        return failobj
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    @property
+    def request_id(self):
+        return self.get('multipart-request-id')
+
+    def get_content_type(self):
+        return parse_content_type(self.get('content-type'))[0]
+
+    def get_content_maintype(self):
+        return self.get_content_type().split('/')[0]
+
+    def get_content_subtype(self):
+        return self.get_content_type().split('/')[1]
+
+    def get_param(self, param, failobj=None):
+        params = parse_content_type(self.get('content-type'))[1]
+        return params.get(param.lower(), failobj)
+
+    def get_payload(self, decode=False):
+        """Return the part body, decoded from its Content-Transfer-Encoding
+        if `decode` is true."""
+        if decode:
+            return decode_payload(self.payload,
+                self.get('content-transfer-encoding'))
+        return self.payload
+
+    def payload_view(self, spill_threshold=None):
+        """Returns a `BodyView` of the part body, decoded from its
+        Content-Transfer-Encoding.
+
+        Bodies in identity encodings are viewed where they are, without being
+        copied. Others are decoded: into a temporary file, viewed through an
+        `mmap`, if the part is in one already or is larger than
+        `spill_threshold` bytes, and into a string otherwise.
+
+        """
+        encoding = (self.get('content-transfer-encoding') or '').lower()
+        if encoding not in ('quoted-printable', 'base64'):
+            return BodyView(self.text, self.start, self.end - self.start)
+        if isinstance(self.text, mmap.mmap) or (spill_threshold is not None
+                and self.end - self.start > spill_threshold):
+            return BodyView(spill(decode_blocks(self.text, encoding,
+                self.start, self.end)))
+        return BodyView(self.get_payload(decode=True))
+
+
+def parse_part(text, start=0, end=None):
+    """Parse the body part spanning `text[start:end]` into a `Part`."""
+    if end is None:
+        end = len(text)
+    headers, body_start = parse_headers(text, start, end)
+    return Part(headers, text, body_start, end)
+
+
+def parse_multipart(text, boundary, start=0):
+    """Parse the multipart body that begins at index `start` of `text` and is
+    delimited by `boundary`, returning a list of its `Part` instances.
+
+    If the body does not end with a closing delimiter, a `ParserError` is
+    raised.
+
+    """
+    parser = MultipartFeedParser(boundary)
+    if start:
+        text = text[start:]
+    parts = parser.feed(text)
+    parser.close()
+    return parts
+
+
+def _header_lines(text, pos):
+    """Return the CRLF-terminated header lines of `text` starting at index
+    `pos`, up to the first blank line, and the index at which the body after
+    that blank line begins. Only the header block is split, so the cost does
+    not depend on the size of the body."""
+    lines = []
+    length = len(text)
+    while pos < length:
+        eol = text.find("\r\n", pos)
+        if eol == -1:
+            line, next = text[pos:], length
+        else:
+            line, next = text[pos:eol], eol + 2
+        if not line.strip():
+            return lines, next
+        lines.append(line)
+        pos = next
+    return lines, length
+
+
+def _unfold(lines):
+    """Join folded continuation lines onto the header lines they continue."""
+    header = ''
+    for line in lines:
+        if line[0] in ' \t':
+            header = '%s\n%s' % (header, line)
+        else:
+            if header:
+                yield header
+            header = line
+    if header:
+        yield header
+
+
 class HTTPRequest(object):
-    def __init__(self, request, headers=None, request_id=None):
+    def __init__(self, request, headers=None, request_id=None, transfer_encoding=None):
         self.length = None
         self.content_type = None
         if not headers:
             headers = []
         self.headers = headers
         self.request_id = request_id
+        self.transfer_encoding = transfer_encoding
 
-        lines = request.split("\r\n")
-        request_line = lines.pop(0)
-        parts = request_line.split()
+        eol = request.find("\r\n")
+        if eol == -1:
+            eol = len(request)
+        parts = request[:eol].split()
         try:
             self.command = parts[0]
             self.request_uri = parts[1]
@@ -82,28 +557,17 @@ class HTTPRequest(object):
             raise BadRequestException()
         self.scheme, self.host, self.path = parse_uri(self.request_uri)
 
-        line = lines.pop(0)
+        pos = eol + 2
         # IE sends an extraneous empty line (\r\n) after a POST request;
         # ignore such a line, but only once.
-        if not line and self.command == 'POST':
-            line = lines.pop(0)
-        header = ''
-        while line.strip():
-            if line[0] in ' \t':
-                header = '%s\n%s' % (header, line)
-            else:
-                if header:
-                    self.process_header(header)
-                header = line
-            if len(lines):
-                line = lines.pop(0)
-            else:
-                break
-        if header:
+        if self.command == 'POST' and request.startswith("\r\n", pos):
+            pos += 2
+        lines, body_start = _header_lines(request, pos)
+        for header in _unfold(lines):
             self.process_header(header)
 
-        # the rest is response body
-        self.data = "\r\n".join(lines)
+        # the rest is request body
+        self.data = request[body_start:]
 
     def process_header(self, line):
         header, data = line.split(':', 1)
@@ -117,6 +581,11 @@ class HTTPRequest(object):
             self.host = data
         self.headers.append((header, data))
 
+    def inherit(self, shared):
+        """Adds the `shared` header pairs the request doesn't override."""
+        for header, value in inherit_headers(self.headers, shared)[len(self.headers):]:
+            self.process_header('%s: %s' % (header, value))
+
     def __str__(self):
         command = "%s %s %s" % (self.command, self.path, self.version)
         headers = "\r\n".join(["%s: %s" % (header, value) for header, value in self.headers])
@@ -128,9 +597,10 @@ class HTTPResponse(object):
         self.length = None
         self.content_type = None
 
-        lines = response.split("\r\n")
-        response_line = lines.pop(0)
-        parts = response_line.split()
+        eol = response.find("\r\n")
+        if eol == -1:
+            eol = len(response)
+        parts = response[:eol].split()
         try:
             self.version = parts[0]
             self.status = parts[1]
@@ -142,8 +612,8 @@ class HTTPResponse(object):
             self.message = '' # sometimes there is no message
 
         self.headers = []
-        line = lines.pop(0)
-        while line.strip():
+        lines, body_start = _header_lines(response, eol + 2)
+        for line in _unfold(lines):
             header, value = line.split(':', 1)
             header = header.lower()
             value = value.lstrip()
@@ -152,10 +622,16 @@ class HTTPResponse(object):
                 self.length = int(value)
             elif header == 'content-type':
                 self.content_type = value
-            line = lines.pop(0)
 
         # the rest is response body
-        self.data = "\r\n".join(lines)
+        self.data = response[body_start:]
+
+    def inherit(self, shared):
+        """Adds the `shared` header pairs the response doesn't override."""
+        for header, value in inherit_headers(self.headers, shared)[len(self.headers):]:
+            self.headers.append((header, value))
+            if header == 'content-type':
+                self.content_type = value
 
     def __str__(self):
         status = "%s %s %s" % (self.version, self.status, self.message)
@@ -165,7 +641,6 @@ class HTTPResponse(object):
 
 class HTTPParser(object):
     def __init__(self, message):
-        self._parser = Parser()
         self.requests = []
         self.responses = []
         if isinstance(message, basestring):
@@ -174,36 +649,198 @@ class HTTPParser(object):
             self._parse(message)
 
     def _parse_subrequest(self, subrequest):
-        payload = subrequest.get_payload()
+        payload = subrequest.get_payload(decode=True)
         if payload is None:
             raise ParserError("Missing payload in subrequest")
-
-        content_type = subrequest.get('content-transfer-encoding', '').lower()
-        if content_type == 'quoted-printable':
-            payload = quopri.decodestring(payload)
-        elif content_type == 'base64':
-            payload = bdecode(payload)
         return payload
 
-    def _parse(self, fp):
-        msg = self._parser.parse(fp)
-        for subrequest in msg.walk():
+    def _parse_parts(self, parts):
+        for subrequest in SharedHeaders().apply(parts):
             type = subrequest.get_content_maintype()
-            request_id = subrequest.get('multipart-request-id', None)
             if type == 'multipart':
-                continue # walk will descend into child messages
-            if type == 'application':
+                boundary = subrequest.get_param('boundary')
+                if boundary is None:
+                    raise ParserError("Multipart message has no boundary")
+                self._parse_parts(parse_multipart(subrequest.payload, boundary))
+            elif type == 'application':
                 payload = self._parse_subrequest(subrequest)
                 subtype = subrequest.get_content_subtype()
                 if subtype == 'http-request':
-                    self.requests.append(HTTPRequest(payload, request_id=request_id))
+                    request = HTTPRequest(payload, request_id=subrequest.request_id,
+                        transfer_encoding=subrequest.get('content-transfer-encoding'))
+                    request.inherit(subrequest.shared_headers)
+                    self.requests.append(request)
                 elif subtype == 'http-response':
-                    self.responses.append(HTTPResponse(payload))
+                    response = HTTPResponse(payload)
+                    response.inherit(subrequest.shared_headers)
+                    self.responses.append(response)
                 else:
                     raise ParserError("Unrecognized message type: '%s'" % subrequest.get_content_type())
 
+    def _parse(self, fp):
+        self._parsestr(fp.read())
+
     def _parsestr(self, text):
-        self._parse(StringIO(text))
+        self._parse_parts([parse_part(text)])
+
+
+class MultipartFeedParser(object):
+
+    """An incremental parser for the body of a MIME multipart message.
+
+    Feed the body text to a `MultipartFeedParser` in pieces of any size with
+    `feed()`; each call returns the `Part` instances for the body parts
+    completed by that piece. Text belonging to parts that have already been
+    returned is discarded, so only the part currently being received is held
+    in memory. It's kept as the pieces it arrived in, and joined only once
+    the part is complete.
+
+    If `spill_threshold` is given, a part that grows past that many bytes is
+    written out to a temporary file as it's received instead, and its `Part`
+    has the `text` of an `mmap` of that file.
+
+    """
+
+    def __init__(self, boundary, spill_threshold=None):
+        self.dash_boundary = '--' + boundary
+        self.spill_threshold = spill_threshold
+        self.done = False
+        self._buffer = ''
+        self._scan = 0
+        self._in_part = False
+        self._pieces = []
+        self._held = 0
+        self._spill = None
+
+    def _find_delimiter(self, buf, start):
+        """Finds the next delimiter line in `buf` at or after `start`.
+
+        Returns a tuple of the index where the preceding content ends, the
+        index just past the delimiter line, and whether the delimiter is the
+        closing one. If no complete delimiter line is available yet, returns
+        the index at which to resume searching as a plain integer instead.
+
+        """
+        dash_boundary = self.dash_boundary
+        while True:
+            pos = buf.find(dash_boundary, start)
+            if pos == -1:
+                return max(start, len(buf) - len(dash_boundary))
+            if pos > 0 and buf[pos-1] != '\n':
+                start = pos + 1
+                continue
+
+            after = pos + len(dash_boundary)
+            if len(buf) < after + 2:
+                return pos
+            closing = buf[after:after+2] == '--'
+            if closing:
+                next_start = after + 2
+            else:
+                eol = buf.find('\n', after)
+                if eol == -1:
+                    return pos
+                if buf[after:eol].strip():
+                    # Only transport padding may follow a boundary, so this
+                    # is content that merely starts like one.
+                    start = pos + 1
+                    continue
+                next_start = eol + 1
+
+            content_end = pos
+            if pos > 0:
+                content_end -= 1
+                if content_end > 0 and buf[content_end-1] == '\r':
+                    content_end -= 1
+            return content_end, next_start, closing
+
+    def feed(self, data):
+        """Adds `data` to the multipart body being parsed, returning a list of
+        the `Part` instances for any body parts it completed."""
+        if self.done:
+            # Anything after the closing delimiter is epilogue.
+            return []
+        if self._buffer:
+            buf = self._buffer + data
+        else:
+            buf = data
+
+        parts = []
+        base = 0
+        while True:
+            found = self._find_delimiter(buf, base + self._scan)
+            if isinstance(found, int):
+                # Nothing before the CRLF ahead of where the search resumes
+                # can be part of a delimiter, so that much may be set aside
+                # (or, before the first delimiter, dropped) rather than
+                # copied into the buffer again with the next piece.
+                safe = found - 2
+                if safe > base:
+                    if self._in_part:
+                        self._hold(buf[base:safe])
+                    base = safe
+                self._scan = found - base
+                break
+            content_end, next_start, closing = found
+            if self._spill is not None:
+                self._spill_text(buf[base:content_end])
+                parts.append(self._spilled_part())
+            elif self._pieces:
+                self._pieces.append(buf[base:content_end])
+                text = ''.join(self._pieces)
+                self._pieces, self._held = [], 0
+                parts.append(parse_part(text))
+            elif self._in_part:
+                parts.append(parse_part(buf, base, content_end))
+            self._in_part = True
+            base = next_start
+            self._scan = 0
+            if closing:
+                self.done = True
+                base = len(buf)
+                break
+
+        self._buffer = buf[base:]
+        return parts
+
+    def _hold(self, text):
+        # Keep text of the part being received, spilling the whole part to
+        # disk once it has grown past the spill threshold.
+        if self._spill is None and (self.spill_threshold is None or
+                self._held + len(text) <= self.spill_threshold):
+            self._pieces.append(text)
+            self._held += len(text)
+            return
+        if self._pieces:
+            pieces, self._pieces, self._held = self._pieces, [], 0
+            for piece in pieces:
+                self._spill_text(piece)
+        self._spill_text(text)
+
+    def _spill_text(self, text):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        self._spill.write(text)
+
+    def _spilled_part(self):
+        fp, self._spill = self._spill, None
+        try:
+            fp.flush()
+            text = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        return parse_part(text)
+
+    def close(self):
+        """Finishes parsing, raising a `ParserError` if the multipart body
+        ended before its closing delimiter."""
+        self._buffer = ''
+        self._pieces, self._held = [], 0
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if not self.done:
+            raise ParserError("Multipart body ended before its closing boundary")
 
 
 class HTTPGenerator(Generator):
@@ -218,6 +855,9 @@ class HTTPGenerator(Generator):
         if not isinstance(payload, basestring):
             raise TypeError('string payload expected: %s' % type(payload))
         self._fp.write(payload)
+        if delimiter_break(msg['Content-transfer-encoding']) == '\r\n':
+            # The Generator follows the part with a bare newline.
+            self._fp.write('\r')
 
     def _handle_application_http_request(self, msg):
         # Called by Generator to parse MIME messages with a
@@ -250,27 +890,383 @@ class MultipartHTTPMessage(HTTPMessage):
 
 
 class HTTPRequestMessage(HTTPMessage):
-    def __init__(self, http_request, request_id):
+    def __init__(self, http_request, request_id, encoding='quoted-printable'):
         HTTPMessage.__init__(self)
         self.set_type('application/http-request')
         self.add_header('Multipart-Request-ID', str(request_id))
-        self.add_header('Content-transfer-encoding', 'quoted-printable')
-        payload = StringIO()
-        quopri.encode(StringIO(http_request), payload, quotetabs=False)
-        self.set_payload(payload.getvalue())
-        payload.close()
+        self.add_header('Content-transfer-encoding', encoding)
+        self.set_payload(encode_payload(http_request, encoding))
 
 
 class HTTPResponseMessage(HTTPMessage):
-    def __init__(self, http_response, request_id):
+    def __init__(self, http_response, request_id, encoding='quoted-printable'):
         HTTPMessage.__init__(self)
         self.set_type('application/http-response')
         self.add_header('Multipart-Request-ID', str(request_id))
-        self.add_header('Content-transfer-encoding', 'quoted-printable')
-        payload = StringIO()
-        quopri.encode(StringIO(http_response), payload, quotetabs=False)
-        self.set_payload(payload.getvalue())
-        payload.close()
+        self.add_header('Content-transfer-encoding', encoding)
+        self.set_payload(encode_payload(http_response, encoding))
+
+
+_boundary_format = '%s%%0%dd==' % ('=' * 15, len(repr(sys.maxint - 1)))
+_boundary_re = re.compile(r'--(={15}[0-9]+==)')
+
+
+def make_boundary():
+    """Returns a random multipart boundary in the style of the email package.
+    Boundaries are always the same length."""
+    return _boundary_format % random.randrange(sys.maxint)
+
+
+def encode_file(fp, encoding, blocksize=65536):
+    """Generates the contents of the file-like object `fp`, from its current
+    position to its end, encoded in the given Content-Transfer-Encoding about
+    `blocksize` bytes at a time.
+
+    The encoded blocks add up to what `encode_payload()` makes of the same
+    content when it follows the CRLF-terminated header block of an HTTP
+    message. Any encoding but ``quoted-printable``, ``binary`` and ``8bit``
+    raises a `ValueError` once the first block is asked for.
+
+    """
+    encoding = encoding.lower()
+    if encoding == 'quoted-printable':
+        # Each block is held back until the next is read, so the last can be
+        # ended as `encode_payload()` ends it.
+        block = None
+        while True:
+            lines = fp.readlines(blocksize)
+            if not lines:
+                break
+            if block is not None:
+                yield block
+            # Encode whole lines at a time, after a CRLF so that line breaks
+            # are encoded as they are when the whole message is encoded.
+            block = binascii.b2a_qp('\r\n' + ''.join(lines))[2:]
+        if block is not None:
+            yield _escape_final_cr(block)
+    elif encoding in ('binary', '8bit'):
+        while True:
+            block = fp.read(blocksize)
+            if not block:
+                return
+            yield block
+    else:
+        raise ValueError('Unsupported Content-Transfer-Encoding %r' % (encoding,))
+
+
+class HTTPPart(object):
+
+    """An HTTP message body part to be written by a `MultipartWriter`.
+
+    This is the lightweight counterpart of `HTTPRequestMessage` and
+    `HTTPResponseMessage`: the part headers are formatted and the payload is
+    encoded once, when the part is made, and no `email.Message` is involved.
+
+    If a file-like `body` is given, it's the rest of the HTTP message after
+    `http_message`, and is read and encoded only as the part is written. It's
+    read through once when the part is made too, to find its encoded length,
+    but it's never held in memory whole. A `body` that can't be rewound is
+    read into the payload instead.
+
+    """
+
+    content_type = None
+
+    def __init__(self, http_message, request_id, encoding='quoted-printable', body=None):
+        self.encoding = encoding
+        self.payload = encode_payload(http_message, encoding)
+        if request_id is None:
+            self.request_id = None
+            self.head = ("MIME-Version: 1.0\n"
+                "Content-Type: %s\n"
+                "Content-transfer-encoding: %s\n"
+                "\n" % (self.content_type, encoding))
+        else:
+            self.request_id = str(request_id)
+            self.head = ("MIME-Version: 1.0\n"
+                "Content-Type: %s\n"
+                "Multipart-Request-ID: %s\n"
+                "Content-transfer-encoding: %s\n"
+                "\n" % (self.content_type, self.request_id, encoding))
+
+        self.body = None
+        self.body_length = 0
+        self._body_boundaries = ()
+        if body is not None:
+            try:
+                self._body_start = body.tell()
+            except (AttributeError, IOError):
+                self.payload += ''.join(encode_file(body, encoding))
+            else:
+                self.body = body
+                self._scan_body()
+
+    def _scan_body(self):
+        # Find the length of the encoded body, and note anything in it that
+        # looks like a boundary so `contains_boundary()` needn't read it.
+        length = 0
+        boundaries = set()
+        tail = ''
+        for block in encode_file(self.body, self.encoding):
+            length += len(block)
+            text = tail + block
+            boundaries.update(_boundary_re.findall(text))
+            tail = text[-64:]
+        self.body.seek(self._body_start)
+        self.body_length = length
+        self._body_boundaries = boundaries
+
+    def get_payload(self):
+        return self.payload
+
+    def contains_boundary(self, boundary):
+        """Returns whether a delimiter line for the multipart boundary
+        `boundary`, as made by `make_boundary()`, could occur in the part."""
+        return ('--' + boundary) in self.payload or boundary in self._body_boundaries
+
+    def iterchunks(self, blocksize=65536):
+        """Generates the text of the part: its headers, then its payload,
+        reading and encoding any file body `blocksize` bytes at a time."""
+        yield self.head
+        yield self.payload
+        if self.body is not None:
+            self.body.seek(self._body_start)
+            for block in encode_file(self.body, self.encoding, blocksize):
+                yield block
+
+    def __len__(self):
+        return len(self.head) + len(self.payload) + self.body_length
+
+
+class HTTPRequestPart(HTTPPart):
+    content_type = 'application/http-request'
+
+
+class HTTPResponsePart(HTTPPart):
+    content_type = 'application/http-response'
+
+
+class SharedHeadersPart(HTTPPart):
+
+    """A part declaring the `headers` (a list of name and value pairs) shared
+    by the HTTP message parts after it (see `SharedHeaders`)."""
+
+    content_type = SHARED_HEADERS_TYPE
+
+    def __init__(self, headers, encoding='quoted-printable'):
+        text = ''.join(['%s: %s\r\n' % (name, value) for name, value in headers])
+        HTTPPart.__init__(self, text + '\r\n', None, encoding)
+
+
+class MultipartWriter(object):
+
+    """Writes the body of a MIME multipart message directly, as a sequence of
+    string chunks.
+
+    Add `HTTPPart` instances with `add()`, then get the body with `chunks()`
+    or `getvalue()`, or as a file-like `MultipartBody` from `open()`. The
+    `length` of the body is kept as parts are added, so it's known before the
+    body is put together. The output is the same as
+    `MultipartHTTPMessage.as_string(write_headers=False)` gives for the
+    equivalent `HTTPRequestMessage` or `HTTPResponseMessage` parts, without
+    the cost of the email package's `Generator` and its copying.
+
+    """
+
+    preamble = "HTTP MIME Message\n"
+
+    def __init__(self, subtype='parallel'):
+        self.subtype = subtype
+        self.parts = []
+        self.boundary = make_boundary()
+        self._parts_length = 0
+
+    def add(self, part):
+        """Adds the `HTTPPart` `part` to the end of the multipart body."""
+        self.parts.append(part)
+        self._parts_length += len(part) + len(delimiter_break(part.encoding))
+        if part.contains_boundary(self.boundary):
+            # As unlikely as it is, the boundary must not occur in any part,
+            # so pick another one that occurs in none of them.
+            while True:
+                self.boundary = make_boundary()
+                for other in self.parts:
+                    if other.contains_boundary(self.boundary):
+                        break
+                else:
+                    return
+
+    @property
+    def length(self):
+        """The length of the multipart body in bytes."""
+        # Each part is preceded by a delimiter line and followed by the
+        # line break that belongs to the next delimiter (counted with the
+        # part), and the body ends with the closing delimiter line.
+        dash_boundary = len(self.boundary) + 2
+        return (len(self.preamble) + 1
+            + len(self.parts) * (dash_boundary + 1) + self._parts_length
+            + dash_boundary + 3)
+
+    @property
+    def content_type(self):
+        return 'multipart/%s; boundary="%s"' % (self.subtype, self.boundary)
+
+    def headers(self):
+        """Returns a dictionary of the MIME headers for the multipart body,
+        including its ``Content-Length``."""
+        return {
+            'MIME-Version': '1.0',
+            'Content-Type': self.content_type,
+            'Content-Length': str(self.length),
+        }
+
+    def iterchunks(self, blocksize=65536):
+        """Generates the multipart body as a sequence of strings, reading
+        any file bodies of its parts `blocksize` bytes at a time."""
+        yield self.preamble + '\n'
+        for part in self.parts:
+            for chunk in self.part_chunks(part, blocksize):
+                yield chunk
+        yield self.closing()
+
+    def part_chunks(self, part, blocksize=65536):
+        """Generates the text of the `HTTPPart` `part` as it's written in the
+        multipart body, with its delimiter line. Parts may be written this way
+        without being added, as long as they don't contain the `boundary`."""
+        yield '--%s\n' % (self.boundary,)
+        for chunk in part.iterchunks(blocksize):
+            yield chunk
+        yield delimiter_break(part.encoding)
+
+    def closing(self):
+        """Returns the closing delimiter line that ends the multipart body."""
+        return '--%s--\n' % (self.boundary,)
+
+    def chunks(self):
+        """Returns the multipart body as a list of strings."""
+        return list(self.iterchunks())
+
+    def getvalue(self):
+        """Returns the multipart body as a string."""
+        return ''.join(self.iterchunks())
+
+    def open(self):
+        """Returns a `MultipartBody` from which to read the multipart body."""
+        return MultipartBody(self)
+
+
+def gzip_chunks(chunks, level=6):
+    """Generates the strings `chunks` compressed together in gzip format."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def gunzip(data):
+    """Returns the gzip compressed string `data` decompressed."""
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+class StreamingBody(object):
+
+    """A read-only file-like object over a body that is written as it's read.
+
+    Subclasses generate the body from `iterchunks()`. It can be sent (with
+    `httplib`, say, which reads such bodies a block at a time) without ever
+    being held in memory whole.
+
+    Once the end of the body has been read, the next `read()` starts it over
+    from the beginning, so that the same body can be sent again when
+    `httplib2` repeats a request. Call `rewind()` to start over sooner.
+
+    """
+
+    def __init__(self, blocksize=65536):
+        self.blocksize = blocksize
+        self._chunks = None
+        self._buffer = ''
+        self._offset = 0
+
+    def iterchunks(self):
+        raise NotImplementedError()
+
+    def rewind(self):
+        """Starts the body over from the beginning."""
+        self._chunks = None
+        self._buffer = ''
+        self._offset = 0
+
+    def read(self, size=-1):
+        """Reads at most `size` bytes of the body, or all the rest of it if
+        `size` is negative or omitted."""
+        if size == 0:
+            return ''
+        if size is None:
+            size = -1
+        if self._chunks is None:
+            self._chunks = self.iterchunks()
+        data = []
+        while size:
+            if self._offset == len(self._buffer):
+                try:
+                    self._buffer = self._chunks.next()
+                except StopIteration:
+                    break
+                self._offset = 0
+                continue
+            if size < 0:
+                end = len(self._buffer)
+            else:
+                end = min(len(self._buffer), self._offset + size)
+                size -= end - self._offset
+            data.append(self._buffer[self._offset:end])
+            self._offset = end
+
+        data = ''.join(data)
+        if not data:
+            self.rewind()
+        return data
+
+
+class MultipartBody(StreamingBody):
+
+    """A `StreamingBody` over the body of a `MultipartWriter`. Its `len()`
+    is the body's length."""
+
+    def __init__(self, writer, blocksize=65536):
+        StreamingBody.__init__(self, blocksize)
+        self.writer = writer
+
+    def __len__(self):
+        return self.writer.length
+
+    def iterchunks(self):
+        return self.writer.iterchunks(self.blocksize)
+
+
+class ChunkedGzipBody(StreamingBody):
+
+    """A `StreamingBody` over the body of a `MultipartWriter`, compressed in
+    gzip format and framed in the chunked Transfer-Encoding.
+
+    The compressed length isn't known until the body has been written, so the
+    body is sent in chunks rather than with a ``Content-Length``.
+
+    """
+
+    def __init__(self, writer, level=6, blocksize=65536):
+        StreamingBody.__init__(self, blocksize)
+        self.writer = writer
+        self.level = level
+
+    def iterchunks(self):
+        for data in gzip_chunks(self.writer.iterchunks(self.blocksize), self.level):
+            if data:
+                yield '%x\r\n%s\r\n' % (len(data), data)
+        yield '0\r\n\r\n'
 
 if __name__ == '__main__':
     requests = [
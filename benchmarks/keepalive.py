@@ -0,0 +1,134 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+"""
+
+Benchmark of HTTP keep-alive on the batch processor front end: batches per
+second over a single client connection when `BatchProxyResource` closes the
+connection after every batch response, as it used to, and when it keeps the
+connection alive for the next batch.
+
+The proxy listens on a loopback port with a stand-in backend that answers
+every subrequest at once, so the numbers are the cost of the front end
+connection and the batch itself. Run with ``python -m benchmarks.keepalive``
+from the top of the source tree.
+
+"""
+
+import httplib
+import threading
+
+from twisted.internet import defer, reactor
+from twisted.python import failure
+from twisted.web import server
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+
+from batchhttp import multipart
+from batchhttp.batchproxy import BatchProxyResource
+from benchmarks.utils import REQUEST, RESPONSE, bench
+
+
+PARTS = 20
+
+
+class InstantResponse(object):
+
+    version = ('HTTP', 1, 1)
+    code = 200
+    phrase = 'OK'
+    body = RESPONSE.split('\r\n\r\n', 1)[1] % 1
+
+    def __init__(self):
+        self.headers = Headers({'Content-Type': ['application/json']})
+
+    def deliverBody(self, protocol):
+        protocol.dataReceived(self.body)
+        protocol.connectionLost(failure.Failure(ResponseDone()))
+
+
+class InstantAgent(object):
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        return defer.succeed(InstantResponse())
+
+
+def batch():
+    writer = multipart.MultipartWriter()
+    for i in range(1, PARTS + 1):
+        writer.add(multipart.HTTPRequestPart(REQUEST % i, i))
+    return writer.content_type, writer.getvalue()
+
+
+def post(conn, content_type, body, close):
+    headers = {'Content-Type': content_type}
+    if close:
+        headers['Connection'] = 'close'
+    conn.request('POST', '/batch-processor', body, headers)
+    response = conn.getresponse()
+    response.read()
+    assert response.status == 207
+
+
+def main():
+    resource = BatchProxyResource('localhost', 8000, 'batch-processor',
+        agent=InstantAgent())
+    port = reactor.listenTCP(0, server.Site(resource), interface='127.0.0.1')
+    address = port.getHost()
+    thread = threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False})
+    thread.setDaemon(True)
+    thread.start()
+
+    content_type, body = batch()
+
+    def close_each():
+        # A new connection for every batch, closed after its response.
+        conn = httplib.HTTPConnection(address.host, address.port)
+        post(conn, content_type, body, True)
+        conn.close()
+
+    conn = httplib.HTTPConnection(address.host, address.port)
+    def keep_alive():
+        post(conn, content_type, body, False)
+
+    print '%-40s %10d bytes' % ('%d-part batch request' % PARTS, len(body))
+    print
+    closing = bench('connection closed after each batch', close_each, number=100)
+    keeping = bench('connection kept alive', keep_alive, number=100)
+    print
+    print '%-40s %10.1f batches/s' % ('closed after each batch', 1 / closing)
+    print '%-40s %10.1f batches/s' % ('kept alive', 1 / keeping)
+    print '%-40s %10.1fx' % ('keep-alive speedup', closing / keeping)
+
+    conn.close()
+    reactor.callFromThread(reactor.stop)
+    thread.join()
+
+
+if __name__ == '__main__':
+    main()
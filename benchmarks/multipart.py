@@ -0,0 +1,162 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+Benchmarks of parsing batch requests and responses with the multipart engine
+in `batchhttp.multipart`, against the `email` package parsing they replaced,
+and of writing batch requests with `MultipartWriter`, against the `email`
+package `Generator`.
+
+Run with ``python -m benchmarks.multipart`` from the top of the source tree.
+
+"""
+
+import email
+from email.feedparser import FeedParser
+from email.parser import Parser
+from StringIO import StringIO
+
+from batchhttp import multipart
+from benchmarks.utils import REQUEST, RESPONSE, compare
+
+
+PARTS = 500
+
+
+def build(message_class, template):
+    msg = multipart.MultipartHTTPMessage()
+    for request_id in range(1, PARTS + 1):
+        msg.attach(message_class(template % request_id, request_id))
+    return msg
+
+
+def email_request_body(template):
+    # The serialization formerly done in BatchRequest.construct.
+    msg = build(multipart.HTTPRequestMessage, template)
+    return msg.as_string(write_headers=False)
+
+
+def writer_request_body(template):
+    writer = multipart.MultipartWriter()
+    for request_id in range(1, PARTS + 1):
+        writer.add(multipart.HTTPRequestPart(template % request_id, request_id))
+    return writer.getvalue()
+
+
+def email_response_parts(headers, content):
+    # The email package parsing formerly done in BatchRequest.handle_response.
+    class HttpAverseParser(FeedParser):
+        def _parse_headers(self, lines):
+            FeedParser._parse_headers(self, lines)
+            if self._cur.get_content_type() == 'application/http-response':
+                self._set_headersonly()
+
+    p = HttpAverseParser()
+    p.feed(headers)
+    p.feed("\n")
+    p.feed(content)
+    parts = []
+    for part in p.close().get_payload():
+        messagefile = StringIO(part.get_payload(decode=True))
+        status_line = messagefile.readline()
+        parts.append((part['Multipart-Request-ID'], status_line,
+            email.message_from_file(messagefile)))
+    return parts
+
+
+def engine_response_parts(content_type, content):
+    boundary = multipart.parse_content_type(content_type)[1]['boundary']
+    parts = []
+    for part in multipart.parse_multipart(content, boundary):
+        text = part.get_payload(decode=True)
+        eol = text.find('\n')
+        parts.append((part.request_id, text[:eol],
+            multipart.parse_headers(text, eol + 1)))
+    return parts
+
+
+def email_requests(text):
+    # The email package parsing formerly done in multipart.HTTPParser.
+    msg = Parser().parse(StringIO(text))
+    requests = []
+    for part in msg.walk():
+        if part.get_content_type() == 'application/http-request':
+            payload = multipart.decode_payload(part.get_payload(),
+                part.get('content-transfer-encoding'))
+            requests.append(multipart.HTTPRequest(payload,
+                request_id=part.get('multipart-request-id')))
+    return requests
+
+
+def split_response(response):
+    # The line splitting formerly done in multipart.HTTPResponse.
+    lines = response.split("\r\n")
+    status_line = lines.pop(0)
+    headers = []
+    line = lines.pop(0)
+    while line.strip():
+        headers.append(line.split(':', 1))
+        line = lines.pop(0)
+    return status_line, headers, "\r\n".join(lines)
+
+
+def main():
+    response = build(multipart.HTTPResponseMessage, RESPONSE)
+    content = response.as_string(write_headers=False)
+    content_type = response['content-type']
+    headers = 'Content-Type: %s\n' % content_type
+    assert len(email_response_parts(headers, content)) == PARTS
+    assert len(engine_response_parts(content_type, content)) == PARTS
+    compare('%d-part batch response' % PARTS,
+        lambda: email_response_parts(headers, content),
+        lambda: engine_response_parts(content_type, content))
+
+    request = build(multipart.HTTPRequestMessage, REQUEST).as_string()
+    assert len(email_requests(request)) == PARTS
+    assert len(multipart.HTTPParser(request).requests) == PARTS
+    compare('%d-part batch request' % PARTS,
+        lambda: email_requests(request),
+        lambda: multipart.HTTPParser(request))
+
+    assert len(email_request_body(REQUEST)) == len(writer_request_body(REQUEST))
+    compare('writing %d-part batch request' % PARTS,
+        lambda: email_request_body(REQUEST),
+        lambda: writer_request_body(REQUEST))
+
+    body = '{"id": "tag:typepad.com,2003:user-1", "urls": []},\r\n' * 50000
+    big = RESPONSE % 1 + body
+    assert split_response(big)[2] == multipart.HTTPResponse(big).data
+    compare('%d KB HTTPResponse' % (len(big) / 1024),
+        lambda: split_response(big),
+        lambda: multipart.HTTPResponse(big), number=2)
+
+
+if __name__ == '__main__':
+    main()
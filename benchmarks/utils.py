@@ -0,0 +1,74 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import time
+
+
+RESPONSE = ('HTTP/1.0 200 OK\r\n'
+    'Date: Sat, 28 Feb 2009 01:06:38 GMT\r\n'
+    'Server: WSGIServer/0.1 Python/2.5.1\r\n'
+    'Vary: Accept-Encoding\r\n'
+    'ETag: "c09c60cdd450593b54e17544fefbdd25"\r\n'
+    'content-type: application/json\r\n'
+    'Allow: OPTIONS, GET, HEAD\r\n'
+    '\r\n'
+    '{\n  "preferredUsername": "dhough", \n  "displayName": "Deidra Hough", \n'
+    '  "aboutMe": "Velit ridiculus massa a aenean.", \n'
+    '  "id": "tag:typepad.com,2003:user-%d", \n'
+    '  "objectType": "tag:api.typepad.com,2009:User"\n}')
+
+REQUEST = ('GET /users/%d.json HTTP/1.1\r\n'
+    'User-Agent: Python-httplib2/0.6.0\r\n'
+    'Host: 127.0.0.1:5001\r\n'
+    'Accept: */*\r\n'
+    '\r\n')
+
+
+def bench(name, fn, repeat=5, number=10):
+    """Times `fn`, printing and returning the best time per call in
+    seconds."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for j in range(number):
+            fn()
+        elapsed = (time.time() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    print '%-40s %10.3f ms' % (name, best * 1000)
+    return best
+
+
+def compare(name, old, new, **kwargs):
+    """Times the `old` and `new` implementations of `name`, printing the
+    speedup of `new` over `old`."""
+    old_time = bench('%s (old)' % name, old, **kwargs)
+    new_time = bench('%s (new)' % name, new, **kwargs)
+    print '%-40s %10.1fx' % ('%s speedup' % name, old_time / new_time)
+    print
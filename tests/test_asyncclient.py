@@ -0,0 +1,241 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import unittest
+
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.web.client import ResponseDone
+from twisted.web.http_headers import Headers
+
+from batchhttp.asyncclient import AsyncBatchClient
+from batchhttp.client import BatchError, NonBatchResponseError
+from tests import utils
+
+
+CONTENT = """wah-ho, wah-hay
+
+--foomfoomfoom
+Content-Type: application/http-response
+Multipart-Request-ID: 2
+
+200 OK
+Content-Type: application/json
+
+{"name": "drang"}
+--foomfoomfoom
+Content-Type: application/http-response
+Multipart-Request-ID: 1
+
+200 OK
+Content-Type: application/json
+
+{"name": "sturm"}
+--foomfoomfoom--"""
+
+
+class FakeTransport(object):
+
+    stopped = False
+
+    def stopProducing(self):
+        self.stopped = True
+
+
+class FakeResponse(object):
+
+    """A `twisted.web.iweb.IResponse` stand-in that delivers its content in
+    pieces of `piece` bytes."""
+
+    def __init__(self, code, headers, content, phrase='', piece=16):
+        self.code = code
+        self.phrase = phrase
+        self.headers = Headers(dict([(k, [v]) for k, v in headers.items()]))
+        self.content = content
+        self.piece = piece
+        self.delivered = 0
+
+    def deliverBody(self, protocol):
+        transport = FakeTransport()
+        protocol.makeConnection(transport)
+        for i in range(0, len(self.content), self.piece):
+            if transport.stopped:
+                protocol.connectionLost(failure.Failure(Exception('stopped')))
+                return
+            self.delivered = i + self.piece
+            protocol.dataReceived(self.content[i:i+self.piece])
+        protocol.connectionLost(failure.Failure(ResponseDone()))
+
+
+class FakeAgent(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        d = defer.Deferred()
+        self.requests.append((method, uri, headers, bodyProducer, d))
+        return d
+
+
+class TestAsyncBatchClient(unittest.TestCase):
+
+    def client(self):
+        agent = FakeAgent()
+        bat = AsyncBatchClient(endpoint='http://127.0.0.1:8000/', agent=agent)
+        bat.http.cache = None
+        return bat, agent
+
+    def test_batch(self):
+        bat, agent = self.client()
+
+        delivered = {}
+        response = FakeResponse(207, {
+            'Content-Type': 'multipart/parallel; boundary="foomfoomfoom"',
+        }, CONTENT)
+
+        def callbackMoose(url, subresponse, subcontent):
+            delivered['moose'] = (response.delivered, subcontent)
+        def callbackFred(url, subresponse, subcontent):
+            delivered['fred'] = (response.delivered, subcontent)
+
+        bat.batch_request()
+        bat.batch({'uri': 'http://example.com/moose'}, callbackMoose)
+        bat.batch({'uri': 'http://example.com/fred'},  callbackFred)
+        d = bat.complete_batch()
+
+        # Another batch can be opened while the first is in flight.
+        self.failIf(d.called)
+        bat.batch_request()
+        bat.batch({'uri': 'http://example.com/other'}, callbackMoose)
+        d2 = bat.complete_batch()
+        self.assertEquals(len(agent.requests), 2)
+
+        method, uri, headers, producer, response_d = agent.requests[0]
+        self.assertEquals((method, uri), ('POST', 'http://127.0.0.1:8000/batch-processor'))
+        self.assert_('multipart/parallel' in headers.getRawHeaders('content-type')[0])
+        self.assert_(producer.length > 0)
+
+        results = []
+        d.addCallback(results.append)
+        response_d.callback(response)
+        self.assertEquals(results, [None])
+
+        self.assertEquals(delivered['moose'][1], '{"name": "sturm"}')
+        self.assertEquals(delivered['fred'][1], '{"name": "drang"}')
+        # Fred was dispatched before the whole response had been delivered.
+        self.assert_(delivered['fred'][0] < len(CONTENT))
+        self.failIf(d2.called)
+
+    def test_bad_response(self):
+        bat, agent = self.client()
+
+        bat.batch_request()
+        callback = lambda url, subresponse, subcontent: None
+        bat.batch({'uri': 'http://example.com/moose'}, callback)
+        d = bat.complete_batch()
+
+        errors = []
+        d.addErrback(errors.append)
+        agent.requests[0][-1].callback(FakeResponse(500,
+            {'Content-Type': 'text/plain'}, 'oops', phrase='Server Error'))
+        self.assertEquals(len(errors), 1)
+        self.assert_(errors[0].check(NonBatchResponseError))
+
+    def test_truncated(self):
+        bat, agent = self.client()
+
+        bat.batch_request()
+        callback = lambda url, subresponse, subcontent: None
+        bat.batch({'uri': 'http://example.com/moose'}, callback)
+        bat.batch({'uri': 'http://example.com/fred'}, callback)
+        d = bat.complete_batch()
+
+        errors = []
+        d.addErrback(errors.append)
+        agent.requests[0][-1].callback(FakeResponse(207, {
+            'Content-Type': 'multipart/parallel; boundary="foomfoomfoom"',
+        }, CONTENT[:-20]))
+        self.assertEquals(len(errors), 1)
+        self.assert_(errors[0].check(BatchError))
+
+    def test_futures(self):
+        bat, agent = self.client()
+
+        bat.batch_request()
+        moose = bat.batch({'uri': 'http://example.com/moose'})
+        fred = bat.batch({'uri': 'http://example.com/fred'})
+        d = bat.complete_batch()
+
+        errors = []
+        d.addErrback(errors.append)
+        agent.requests[0][-1].callback(FakeResponse(207, {
+            'Content-Type': 'multipart/parallel; boundary="foomfoomfoom"',
+        }, CONTENT[:-20]))
+        self.assertEquals(len(errors), 1)
+
+        self.assertEquals(fred.result(0)[1], '{"name": "drang"}')
+        self.assert_(moose.exception(0) is errors[0].value)
+
+    def test_callback_error(self):
+        bat, agent = self.client()
+
+        def callback(url, subresponse, subcontent):
+            raise ValueError(url)
+
+        bat.batch_request()
+        bat.batch({'uri': 'http://example.com/moose'}, callback)
+        bat.batch({'uri': 'http://example.com/fred'}, callback)
+        d = bat.complete_batch()
+
+        errors = []
+        d.addErrback(errors.append)
+        agent.requests[0][-1].callback(FakeResponse(207, {
+            'Content-Type': 'multipart/parallel; boundary="foomfoomfoom"',
+        }, CONTENT))
+        self.assertEquals(len(errors), 1)
+        self.assert_(errors[0].check(ValueError))
+        self.assertEquals(str(errors[0].value), 'http://example.com/fred')
+
+    def test_errors(self):
+        bat, agent = self.client()
+        self.assertRaises(BatchError, bat.complete_batch)
+        self.assertRaises(BatchError, bat.batch, {'uri': 'http://example.com/'}, None)
+        bat.batch_request()
+        self.assertRaises(BatchError, bat.batch_request)
+
+        results = []
+        bat.complete_batch().addCallback(results.append)
+        self.assertEquals(results, [None])
+        self.assertEquals(agent.requests, [])
+
+
+if __name__ == '__main__':
+    utils.log()
+    unittest.main()
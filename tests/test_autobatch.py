@@ -0,0 +1,120 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import threading
+import unittest
+
+from batchhttp.autobatch import AutoBatcher
+from batchhttp.client import BatchClient, BatchError
+from tests import utils
+
+
+class TestAutoBatcher(unittest.TestCase):
+
+    def client(self, statuses=None):
+        bat = BatchClient(endpoint="http://127.0.0.1:8000/")
+        bat.request = utils.batch_processor(statuses)
+        bat.cache = None
+        bat.authorizations = []
+        return bat
+
+    def test_threads(self):
+        bat = self.client()
+        batcher = AutoBatcher(bat, max_wait=0.05, max_size=100)
+
+        results = {}
+        start = threading.Event()
+        def work(name):
+            start.wait()
+            future = batcher.submit({'uri': 'http://example.com/%s' % name})
+            results[name] = future.result(5)[1]
+
+        names = ['w%d' % i for i in range(10)]
+        threads = [threading.Thread(target=work, args=(name,)) for name in names]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        batcher.close()
+
+        self.assertEquals(results, dict([(name, '/' + name) for name in names]))
+        # The submissions were coalesced into fewer batches than callers.
+        self.assert_(len(bat.request.batches) < len(names))
+        self.assertEquals(sum([len(b) for b in bat.request.batches]), len(names))
+
+    def test_max_size(self):
+        bat = self.client()
+        batcher = AutoBatcher(bat, max_wait=60, max_size=3)
+
+        futures = [batcher.submit({'uri': 'http://example.com/%d' % i})
+            for i in range(7)]
+        for future in futures[:6]:
+            future.result(5)
+        self.failIf(futures[6].done())
+
+        # The last one is only sent once it's flushed.
+        batcher.flush()
+        self.assertEquals(futures[6].result(5)[1], '/6')
+        batcher.close()
+        self.assertEquals(sorted([len(b) for b in bat.request.batches]), [1, 3, 3])
+
+    def test_callbacks(self):
+        bat = self.client()
+        batcher = AutoBatcher(bat, max_wait=60)
+
+        results = []
+        done = threading.Event()
+        def callback(url, subresponse, subcontent):
+            results.append(subcontent)
+            done.set()
+        batcher.submit({'uri': 'http://example.com/moose'}, callback)
+        batcher.close()
+
+        self.assert_(done.isSet())
+        self.assertEquals(results, ['/moose'])
+        self.assertRaises(BatchError, batcher.submit, {'uri': 'http://example.com/fred'})
+
+    def test_errors(self):
+        bat = self.client(statuses={1: 500})
+        batcher = AutoBatcher(bat, max_wait=0)
+
+        future = batcher.submit({'uri': 'http://example.com/moose'})
+        self.assert_(isinstance(future.exception(5), BatchError))
+        # The batcher carries on after a failed batch.
+        future = batcher.submit({'uri': 'http://example.com/fred'})
+        self.assert_(isinstance(future.exception(5), BatchError))
+        batcher.close()
+
+        self.assertRaises(ValueError, AutoBatcher, bat, max_size=0)
+
+
+if __name__ == '__main__':
+    utils.log()
+    unittest.main()
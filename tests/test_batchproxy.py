@@ -0,0 +1,653 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import re
+from StringIO import StringIO
+import unittest
+
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.test import proto_helpers
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyRequest
+
+from batchhttp import multipart
+from batchhttp.batchproxy import BackendPool, BatchProxyResource, BatchRequest
+from batchhttp.batchproxy import OverloadedError, SubrequestQueue
+from tests import utils
+from tests.test_asyncclient import FakeAgent, FakeResponse
+
+
+class FakeRequest(object):
+
+    def __init__(self, headers, content):
+        self.received_headers = headers
+        self.content = StringIO(content)
+
+
+class TestBatchProxyResource(unittest.TestCase):
+
+    def batch(self):
+        writer = multipart.MultipartWriter()
+        for id in range(1, 4):
+            writer.add(multipart.HTTPRequestPart("GET /users/%d.json HTTP/1.1\r\n"
+                "Host: example.com\r\nConnection: keep-alive\r\n\r\n" % id, id))
+        return writer
+
+    def test_parse_batch_request(self):
+        writer = self.batch()
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor')
+        requests = resource.parse_batch_request(FakeRequest({
+            'content-type': writer.content_type,
+        }, writer.getvalue()))
+        self.assertEquals([r.path for r in requests],
+            ['/users/1.json', '/users/2.json', '/users/3.json'])
+        self.assertEquals(requests[0].headers, [('host', 'example.com')])
+
+    def test_parse_gzip_batch_request(self):
+        writer = self.batch()
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor')
+        requests = resource.parse_batch_request(FakeRequest({
+            'content-type': writer.content_type,
+            'content-encoding': 'gzip',
+        }, ''.join(multipart.gzip_chunks(writer.iterchunks()))))
+        self.assertEquals([r.request_id for r in requests], ['1', '2', '3'])
+        self.assertEquals(requests[2].path, '/users/3.json')
+
+    def test_bad_gzip_batch_request(self):
+        agent = FakeAgent()
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor',
+            agent=agent)
+        writer = self.batch()
+        gzipped = ''.join(multipart.gzip_chunks(writer.iterchunks()))
+        for content in ('not gzip', gzipped[:len(gzipped) // 2]):
+            request = DummyRequest([])
+            request.method = 'POST'
+            request.received_headers = {
+                'content-type': writer.content_type,
+                'content-encoding': 'gzip',
+            }
+            request.content = StringIO(content)
+            request.render(resource)
+            self.assertEquals(request.responseCode, 400)
+        self.failIf(agent.requests)
+
+    def test_shared_response_headers(self):
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor')
+        writer = self.batch()
+        requests = [BatchRequest('localhost', 8000, r, None)
+            for r in resource.parse_batch_request(FakeRequest({
+                'content-type': writer.content_type,
+            }, writer.getvalue()))]
+        for id, request in enumerate(requests):
+            request.transport.write("HTTP/1.1 404 Not Found\r\n"
+                "Content-Type: text/plain\r\n"
+                "Content-Length: 1\r\n"
+                "\r\n%d" % id)
+        self.failIf(resource.accepts_shared_headers(FakeRequest({}, '')))
+        self.assert_(resource.accepts_shared_headers(FakeRequest({
+            'batch-extensions': 'gzip, Shared-Headers'}, '')))
+
+        for shared in (False, True):
+            writer = resource.response_parts(requests, shared)
+            text = writer.getvalue()
+            self.assertEquals(text.lower().count('content-type: text/plain'), shared and 1 or 3)
+            parser = multipart.HTTPParser('Content-Type: %s\r\n\r\n%s'
+                % (writer.content_type, text))
+            responses = parser.responses
+            self.assertEquals([r.data for r in responses], ['0', '1', '2'])
+            self.assertEquals(responses[2].content_type, 'text/plain')
+            self.assertEquals(responses[2].status, '404')
+
+    def test_forward(self):
+        agent = FakeAgent()
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor',
+            agent=agent)
+        writer = self.batch()
+        subrequest = resource.parse_batch_request(FakeRequest({
+            'content-type': writer.content_type,
+        }, writer.getvalue()))[0]
+        batch_request = BatchRequest('localhost', 8000, subrequest, agent)
+        d = batch_request.process()
+
+        (method, uri, headers, producer, response_d), = agent.requests
+        self.assertEquals((method, uri), ('GET', 'http://localhost:8000/users/1.json'))
+        self.assertEquals(list(headers.getAllRawHeaders()), [('Host', ['example.com'])])
+        self.assertEquals(producer, None)
+
+        response = FakeResponse(404, {
+            'Content-Type': 'text/plain',
+            'Transfer-Encoding': 'chunked',
+            'Connection': 'keep-alive',
+        }, 'no such user', phrase='Not Found')
+        response.version = ('HTTP', 1, 1)
+        response_d.callback(response)
+        self.assert_(d.called)
+
+        parsed = multipart.HTTPResponse(batch_request.transport.getvalue())
+        self.assertEquals((parsed.status, parsed.data), ('404', 'no such user'))
+        self.assertEquals(sorted(parsed.headers), [('content-length', '12'),
+            ('content-type', 'text/plain')])
+
+    def test_forward_hop_by_hop(self):
+        agent = FakeAgent()
+        subrequest = multipart.HTTPRequest("GET /users/1.json HTTP/1.1\r\n"
+            "Host: example.com\r\nConnection: X-Trace\r\nX-Trace: 1\r\n"
+            "Trailer: X-Checksum\r\n\r\n")
+        batch_request = BatchRequest('localhost', 8000, subrequest, agent)
+        batch_request.process()
+
+        (method, uri, headers, producer, response_d), = agent.requests
+        self.assertEquals(list(headers.getAllRawHeaders()), [('Host', ['example.com'])])
+
+        response = FakeResponse(200, {
+            'Content-Type': 'text/plain',
+            'Content-Length': '2',
+            'Connection': 'Keep-Alive, X-Backend',
+            'X-Backend': 'web3',
+        }, 'ok', phrase='OK')
+        response.version = ('HTTP', 1, 1)
+        response_d.callback(response)
+
+        parsed = multipart.HTTPResponse(batch_request.transport.getvalue())
+        self.assertEquals(sorted(parsed.headers), [('content-length', '2'),
+            ('content-type', 'text/plain')])
+
+    def test_forward_bodiless(self):
+        for method, code, length in (('HEAD', 200, '1234'), ('GET', 304, '1234'),
+                                     ('GET', 204, None)):
+            agent = FakeAgent()
+            subrequest = multipart.HTTPRequest("%s /users/1.json HTTP/1.1\r\n"
+                "Host: example.com\r\n\r\n" % method)
+            batch_request = BatchRequest('localhost', 8000, subrequest, agent)
+            batch_request.process()
+
+            headers = {'Content-Type': 'text/plain'}
+            if length is not None:
+                headers['Content-Length'] = length
+            response = FakeResponse(code, headers, '')
+            response.version = ('HTTP', 1, 1)
+            agent.requests[0][-1].callback(response)
+
+            # The backend's Content-Length is passed on, not the (empty)
+            # body's length.
+            parsed = multipart.HTTPResponse(batch_request.transport.getvalue())
+            self.assertEquals(dict(parsed.headers).get('content-length'), length)
+
+    def test_forward_error(self):
+        agent = FakeAgent()
+        subrequest = multipart.HTTPRequest("POST /users HTTP/1.1\r\n"
+            "Host: example.com\r\nContent-Length: 3\r\n\r\na=b")
+        batch_request = BatchRequest('localhost', 8000, subrequest, agent)
+        d = batch_request.process()
+
+        (method, uri, headers, producer, response_d), = agent.requests
+        self.assertEquals(producer.length, 3)
+        self.failIf(headers.hasHeader('content-length'))
+        response_d.errback(failure.Failure(Exception('refused')))
+        self.assert_(d.called)
+        self.assert_(batch_request.transport.getvalue().startswith(
+            'HTTP/1.1 502 Bad Gateway\r\n'))
+
+    def test_streaming(self):
+        agent = FakeAgent()
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor',
+            transfer_encoding='binary', agent=agent, streaming=True)
+        writer = self.batch()
+        request = DummyRequest([])
+        request.method = 'POST'
+        request.received_headers = {'content-type': writer.content_type}
+        request.content = StringIO(writer.getvalue())
+        request.render(resource)
+
+        self.assertEquals(request.responseCode, 207)
+        content_type, params = multipart.parse_content_type(
+            request.outgoingHeaders['content-type'])
+        boundary = params['boundary']
+        self.failIf('content-length' in request.outgoingHeaders)
+        self.assertEquals(len(agent.requests), 3)
+
+        def respond(index, body):
+            response = FakeResponse(200, {'Content-Type': 'text/plain'}, body,
+                phrase='OK')
+            response.version = ('HTTP', 1, 1)
+            agent.requests[index][-1].callback(response)
+
+        # Subresponses are written as they complete, not in request order.
+        written = len(request.written)
+        respond(2, 'three')
+        self.assert_(len(request.written) > written)
+        self.assert_('three' in ''.join(request.written[written:]))
+        respond(0, 'one --%s\r\n' % boundary)
+        self.failIf(request.finished)
+        respond(1, 'two')
+        self.assertEquals(request.finished, 1)
+
+        parts = multipart.parse_multipart(''.join(request.written), boundary)
+        self.assertEquals([part.request_id for part in parts], ['3', '1', '2'])
+        self.assertEquals(parts[1]['Content-Transfer-Encoding'], 'base64')
+        responses = [multipart.HTTPResponse(part.get_payload(decode=True))
+            for part in parts]
+        self.assertEquals([r.data for r in responses],
+            ['three', 'one --%s\r\n' % boundary, 'two'])
+
+    def test_forward_failure(self):
+        for streaming in (False, True):
+            agent = FakeAgent()
+            resource = BatchProxyResource('localhost', 8000, 'batch-processor',
+                transfer_encoding='binary', agent=agent, streaming=streaming)
+            def request(method, uri, headers=None, bodyProducer=None):
+                if uri.endswith('/users/2.json'):
+                    raise TypeError('no agent for you')
+                return FakeAgent.request(agent, method, uri, headers,
+                    bodyProducer)
+            agent.request = request
+            writer = self.batch()
+            request = DummyRequest([])
+            request.method = 'POST'
+            request.received_headers = {'content-type': writer.content_type}
+            request.content = StringIO(writer.getvalue())
+            request.render(resource)
+
+            for index, (method, uri, headers, producer, d) in enumerate(agent.requests):
+                response = FakeResponse(200, {'Content-Type': 'text/plain'},
+                    str(index), phrase='OK')
+                response.version = ('HTTP', 1, 1)
+                d.callback(response)
+            self.assertEquals(request.finished, 1)
+
+            # The subrequest that failed is answered with a 502, not left out.
+            boundary = multipart.parse_content_type(
+                request.outgoingHeaders['content-type'])[1]['boundary']
+            parts = multipart.parse_multipart(''.join(request.written), boundary)
+            statuses = dict([(part.request_id,
+                multipart.HTTPResponse(part.get_payload(decode=True)).status)
+                for part in parts])
+            self.assertEquals(statuses, {'1': '200', '2': '502', '3': '200'})
+
+    def test_keep_alive(self):
+        agent = FakeAgent()
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor',
+            agent=agent)
+        channel = server.Site(resource).buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        channel.makeConnection(transport)
+
+        writer = self.batch()
+        body = writer.getvalue()
+        for batch in range(2):
+            channel.dataReceived("POST /batch-processor HTTP/1.1\r\n"
+                "Host: batch.example.com\r\n"
+                "Content-Type: %s\r\n"
+                "Content-Length: %d\r\n"
+                "\r\n%s" % (writer.content_type, len(body), body))
+            for method, uri, headers, producer, d in agent.requests[batch*3:]:
+                response = FakeResponse(200, {}, 'ok', phrase='OK')
+                response.version = ('HTTP', 1, 1)
+                d.callback(response)
+
+            # The response is finished normally, and the connection stays
+            # open for the next batch.
+            response = transport.value()
+            transport.clear()
+            self.failIf(transport.disconnecting)
+            head, content = response.split('\r\n\r\n', 1)
+            self.assert_(head.startswith('HTTP/1.1 207 '))
+            length = int(re.search(r'(?i)content-length: (\d+)', head).group(1))
+            self.assertEquals(length, len(content))
+            boundary = re.search(r'boundary="([^"]+)"', head).group(1)
+            self.assertEquals(len(multipart.parse_multipart(content, boundary)), 3)
+
+        channel.connectionLost(failure.Failure(Exception('done')))
+
+    def test_client_gone(self):
+        agent = FakeAgent()
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor',
+            agent=agent)
+        writer = self.batch()
+        request = DummyRequest([])
+        request.method = 'POST'
+        request.received_headers = {'content-type': writer.content_type}
+        request.content = StringIO(writer.getvalue())
+        request.render(resource)
+
+        request.processingFailed(failure.Failure(Exception('gone')))
+        for method, uri, headers, producer, d in agent.requests:
+            response = FakeResponse(200, {}, 'ok', phrase='OK')
+            response.version = ('HTTP', 1, 1)
+            d.callback(response)
+        self.assertEquals(request.written, [])
+        self.failIf(request.finished)
+
+    def test_overloaded(self):
+        clock = task.Clock()
+        agent = FakeAgent()
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor',
+            max_connections=2, max_queued=1, overload_timeout=1, reactor=clock,
+            agent=agent)
+        writer = self.batch()
+
+        def post():
+            request = DummyRequest([])
+            request.method = 'POST'
+            request.received_headers = {'content-type': writer.content_type}
+            request.content = StringIO(writer.getvalue())
+            request.render(resource)
+            return request
+
+        def statuses(request):
+            content_type, params = multipart.parse_content_type(
+                request.outgoingHeaders['content-type'])
+            parts = multipart.parse_multipart(''.join(request.written),
+                params['boundary'])
+            return [multipart.HTTPResponse(part.get_payload(decode=True)).status
+                for part in parts]
+
+        first = post()
+        second = post()
+        self.assertEquals(len(agent.requests), 2)
+        self.assertEquals(resource.queue.stats()['queued'], 4)
+        self.failIf(resource.queue.overloaded())
+
+        # Once the queue has been over its threshold for long enough, the
+        # newest subrequests are shed, and whole batches are turned away.
+        clock.advance(1)
+        self.assertEquals(statuses(second), ['503', '503', '503'])
+        third = post()
+        self.assertEquals(third.responseCode, 503)
+        self.assertEquals(third.outgoingHeaders['retry-after'], '5')
+        self.assertEquals(resource.stats()['shed_batches'], 1)
+        self.assertEquals(resource.stats()['queue']['shed'], 3)
+
+        while len(agent.requests):
+            method, uri, headers, producer, d = agent.requests.pop(0)
+            response = FakeResponse(200, {}, 'ok', phrase='OK')
+            response.version = ('HTTP', 1, 1)
+            d.callback(response)
+        self.assertEquals(statuses(first), ['200', '200', '200'])
+        self.failIf(resource.queue.overloaded())
+
+    def test_stats_resource(self):
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor',
+            stats_path='batch-stats')
+        request = DummyRequest(['batch-stats'])
+        request.received_headers = {'host': 'batch.example.com'}
+        child = resource.getChild('batch-stats', request)
+        stats = json.loads(child.render_GET(request))
+        self.assertEquals(sorted(stats), ['batch_wait', 'pool', 'queue',
+            'shed_batches'])
+        self.assertEquals(stats['queue']['queued'], 0)
+
+    def test_fair_batches(self):
+        clock = task.Clock()
+        agent = FakeAgent()
+        resource = BatchProxyResource('localhost', 8000, 'batch-processor',
+            max_connections=1, small_batch=1, reactor=clock, agent=agent)
+
+        def post(client, count):
+            writer = multipart.MultipartWriter()
+            for id in range(1, count + 1):
+                writer.add(multipart.HTTPRequestPart("GET /%s/%d HTTP/1.1\r\n"
+                    "Host: example.com\r\n\r\n" % (client, id), id))
+            request = DummyRequest([])
+            request.method = 'POST'
+            request.received_headers = {'content-type': writer.content_type,
+                'batch-client': client}
+            request.content = StringIO(writer.getvalue())
+            request.render(resource)
+            return request
+
+        bulk = post('bulk', 20)
+        other = post('other', 2)
+        clock.advance(1)
+        interactive = post('web', 1)
+
+        paths = []
+        while agent.requests:
+            method, uri, headers, producer, d = agent.requests.pop(0)
+            paths.append(uri.split('/', 3)[3])
+            clock.advance(0.5)
+            response = FakeResponse(200, {}, 'ok', phrase='OK')
+            response.version = ('HTTP', 1, 1)
+            d.callback(response)
+
+        # The small batch jumped the queue, and the other client didn't
+        # have to wait for the whole bulk batch.
+        self.assertEquals(paths[:5], ['bulk/1', 'web/1', 'bulk/2', 'other/1',
+            'bulk/3'])
+        self.assertEquals(paths[5], 'other/2')
+        self.assertEquals(interactive.outgoingHeaders['batch-queue-wait'], '0.500')
+        self.assertEquals(other.outgoingHeaders['batch-queue-wait'], '3.500')
+        self.assertEquals(bulk.outgoingHeaders['batch-queue-wait'], '12.000')
+        stats = resource.stats()['batch_wait']
+        self.assertEquals((stats['batches'], stats['max']), (3, 12.0))
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.state = 'QUIESCENT'
+        self.transport = FakeConnectionTransport()
+
+
+class FakeConnectionTransport(object):
+
+    disconnecting = False
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+
+class FakeEndpoint(object):
+
+    def __init__(self):
+        self.connected = []
+
+    def connect(self, factory):
+        connection = FakeConnection()
+        self.connected.append(connection)
+        return defer.succeed(connection)
+
+
+class TestBackendPool(unittest.TestCase):
+
+    def test_reuse(self):
+        clock = task.Clock()
+        pool = BackendPool(clock, max_idle=2, idle_timeout=10)
+        endpoint = FakeEndpoint()
+        key = ('http', 'localhost', 8000)
+
+        connections = []
+        for i in range(3):
+            pool.getConnection(key, endpoint).addCallback(connections.append)
+        self.assertEquals(len(endpoint.connected), 3)
+        for connection in connections:
+            pool._putConnection(key, connection)
+        # Only max_idle connections are kept.
+        self.assert_(connections[0].transport.disconnecting)
+        self.assertEquals(pool.stats()['idle'], 2)
+
+        # A connection the server closed is discarded rather than reused.
+        connections[1].state = 'CONNECTION_LOST'
+        reused = []
+        pool.getConnection(key, endpoint).addCallback(reused.append)
+        self.assertEquals(len(endpoint.connected), 3)
+        self.assert_(reused[0]._clientProtocol is connections[2])
+        self.assertEquals(pool.stats(), {'hits': 1, 'misses': 3,
+            'discarded': 1, 'idle': 0})
+
+        # Idle connections time out.
+        pool._putConnection(key, connections[2])
+        clock.advance(11)
+        self.assert_(connections[2].transport.disconnecting)
+        self.assertEquals(pool.stats()['idle'], 0)
+
+
+class TestSubrequestQueue(unittest.TestCase):
+
+    def test_limits(self):
+        clock = task.Clock()
+        shared = SubrequestQueue(2, reactor=clock)
+        queues = [SubrequestQueue(2, shared, reactor=clock) for i in range(2)]
+
+        pending = []
+        def work():
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        results = []
+        for queue in queues:
+            for i in range(3):
+                queue.run(work).addCallback(results.append)
+        # Each backend may have two going, but only two at once overall.
+        self.assertEquals(len(pending), 2)
+        self.assertEquals(shared.stats()['queued'], 2)
+        self.assertEquals(queues[1].stats()['queued'], 1)
+
+        while pending:
+            pending.pop(0).callback('done')
+        self.assertEquals(results, ['done'] * 6)
+        self.assertEquals(shared.stats(), {'active': 0, 'queued': 0, 'flows': 0,
+            'peak_queued': 2, 'shed': 0, 'overloaded': False})
+
+    def test_shedding(self):
+        clock = task.Clock()
+        queue = SubrequestQueue(1, max_queued=2, overload_timeout=5, reactor=clock)
+        pending = []
+        def work():
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        results = []
+        for i in range(5):
+            queue.run(work).addBoth(results.append)
+        # Over the threshold, but not yet for long enough to shed.
+        self.failIf(queue.overloaded())
+        self.assertEquals(results, [])
+
+        clock.advance(5)
+        self.assert_(queue.overloaded())
+        self.assertEquals(len(results), 2)
+        # Until it drains, more subrequests over the threshold are shed.
+        queue.run(work).addBoth(results.append)
+        self.assertEquals(len(results), 3)
+        for result in results:
+            result.trap(OverloadedError)
+        self.assertEquals(queue.stats()['shed'], 3)
+        self.assertEquals(queue.stats()['queued'], 2)
+
+        pending.pop(0).callback('done')
+        self.failIf(queue.overloaded())
+        self.assertEquals(results[3:], ['done'])
+
+    def test_fair_order(self):
+        queue = SubrequestQueue(1, weights={'b': 2})
+        order = []
+        pending = []
+        def work(name):
+            order.append(name)
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        for i in range(6):
+            queue.run(work, 'a', flow='a')
+        for i in range(3):
+            queue.run(work, 'b', flow='b')
+        queue.run(work, 'c', flow='c')
+        queue.run(work, 'fast', flow='a', fast=True)
+        self.assertEquals(queue.stats()['flows'], 3)
+        while pending:
+            pending.pop(0).callback(None)
+
+        # The first was forwarded at once; then the fast lane goes first,
+        # and the rest take turns, 'b' getting two at a time.
+        self.assertEquals(order, ['a', 'fast', 'a', 'b', 'b', 'c', 'a', 'b',
+            'a', 'a', 'a'])
+        self.assertEquals(queue.stats()['flows'], 0)
+
+    def test_fast_flood(self):
+        queue = SubrequestQueue(1)
+        order = []
+        pending = []
+        def work(name):
+            order.append(name)
+            d = defer.Deferred()
+            pending.append(d)
+            return d
+
+        queue.run(work, 'first')
+        for i in range(5):
+            queue.run(work, 'big', flow='big')
+        # One client sends small batch after small batch.
+        for i in range(30):
+            queue.run(work, 'small', flow='small', fast=True)
+        while pending:
+            pending.pop(0).callback(None)
+
+        # The fast lane takes two turns to the big flow's one, rather than
+        # holding it up until the flood is over.
+        self.assertEquals(order[1:7], ['small', 'small', 'big', 'small', 'small', 'big'])
+        self.assertEquals(order[:16].count('big'), 5)
+        self.assertEquals(queue.stats()['queued'], 0)
+
+    def test_bad_weights(self):
+        # A flow that never earns a turn would stall the round-robin.
+        for weight in (0, -1):
+            self.assertRaises(ValueError, SubrequestQueue, 1,
+                weights={'a': 1, 'b': weight})
+            self.assertRaises(ValueError, BatchProxyResource, 'localhost',
+                8000, 'batch-processor', agent=FakeAgent(),
+                client_weights={'b': weight})
+        self.assertRaises(ValueError, SubrequestQueue, 1, quantum=0)
+        self.assertRaises(ValueError, SubrequestQueue, 1, fast_weight=0)
+
+    def test_shed_longest_flow(self):
+        clock = task.Clock()
+        queue = SubrequestQueue(1, max_queued=3, overload_timeout=1, reactor=clock)
+        results = {}
+        queue.run(defer.Deferred)
+        for name, count in (('bulk', 4), ('web', 1)):
+            for i in range(count):
+                queue.run(lambda: name, flow=name).addBoth(
+                    results.setdefault(name, []).append)
+        clock.advance(1)
+        self.assertEquals(len(results['bulk']), 2)
+        self.assertEquals(results['web'], [])
+
+
+if __name__ == '__main__':
+    utils.log()
+    unittest.main()
@@ -0,0 +1,170 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import email.Utils
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from batchhttp.cache import MemoryCache, SQLiteCache
+from batchhttp.client import BatchClient
+from tests import utils
+
+
+class CacheTests(object):
+
+    def test_get_set(self):
+        cache = self.cache()
+        self.assertEquals(cache.get('a'), None)
+        cache.set('a', 'one')
+        cache.set('b', '\x00\xff binary')
+        self.assertEquals(cache.get('a'), 'one')
+        self.assertEquals(cache.get('b'), '\x00\xff binary')
+        cache.set('a', 'uno')
+        self.assertEquals(cache.get('a'), 'uno')
+        cache.delete('a')
+        cache.delete('nonesuch')
+        self.assertEquals(cache.get('a'), None)
+
+        stats = cache.stats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['sets']), (3, 2, 3))
+
+    def test_many(self):
+        cache = self.cache()
+        values = dict([('key%d' % i, 'value %d' % i) for i in range(600)])
+        cache.set_many(values)
+        found = cache.get_many(['nonesuch'] + values.keys())
+        self.assertEquals(found, values)
+        self.assertEquals(cache.stats()['hits'], 600)
+        self.assertEquals(cache.stats()['misses'], 1)
+
+    def test_ttl(self):
+        cache = self.cache(ttl=60)
+        cache.set('a', 'one')
+        self.assertEquals(cache.get('a'), 'one')
+        now = time.time
+        try:
+            time.time = lambda: now() + 61
+            self.assertEquals(cache.get('a'), None)
+        finally:
+            time.time = now
+
+    def test_max_entries(self):
+        cache = self.cache(max_entries=3)
+        for key in 'abc':
+            cache.set(key, key)
+            # Make sure the entries are stored at distinct times.
+            time.sleep(0.01)
+        cache.get('a')
+        cache.set('d', 'd')
+        found = cache.get_many('abcd')
+        # The least recently used entry was evicted.
+        self.assertEquals(sorted(found), ['a', 'c', 'd'])
+        self.assertEquals(cache.stats()['evictions'], 1)
+
+    def test_client(self):
+        cache = self.cache()
+        now = email.Utils.formatdate(usegmt=True)
+        cache.set('http://example.com/moose', utils.cache_entry({
+            'date': now,
+            'cache-control': 'max-age=3600',
+        }, 'cached moose'))
+
+        bat = BatchClient(endpoint="http://127.0.0.1:8000/", cache=cache)
+        bat.request = utils.batch_processor()
+        bat.batch_request()
+        moose = bat.batch({'uri': 'http://example.com/moose'})
+        fred = bat.batch({'uri': 'http://example.com/fred'})
+        barney = bat.batch({'uri': 'http://example.com/barney'})
+        bat.complete_batch()
+
+        self.assertEquals(moose.result(0)[1], 'cached moose')
+        self.assertEquals(fred.result(0)[1], '/fred')
+        self.assertEquals(bat.request.batches, [['/fred', '/barney']])
+        self.assert_(cache.get('http://example.com/barney').endswith('/barney'))
+        # The cache was read and written once each for the whole batch.
+        self.assertEquals(cache.stats()['hits'], 2)
+        self.assertEquals(cache.stats()['misses'], 2)
+        self.assertEquals(cache.stats()['sets'], 3)
+
+
+class TestMemoryCache(CacheTests, unittest.TestCase):
+
+    def cache(self, **kwargs):
+        return MemoryCache(**kwargs)
+
+    def test_max_bytes(self):
+        cache = MemoryCache(max_bytes=10)
+        cache.set('a', '12345')
+        cache.set('b', '12345')
+        self.assertEquals(cache.size, 10)
+        cache.set('c', '1')
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.get('b'), '12345')
+        cache.set('d', '12345678901')
+        self.assertEquals(cache.get('d'), None)
+        self.assertEquals(len(cache), 2)
+
+
+class TestSQLiteCache(CacheTests, unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cache(self, **kwargs):
+        cache = SQLiteCache(os.path.join(self.dir, 'cache.db'), **kwargs)
+        # Record every use, so recency is exact.
+        cache.touch_interval = 0
+        return cache
+
+    def test_shared(self):
+        one, two = self.cache(), self.cache()
+        one.set('a', 'one')
+        self.assertEquals(two.get('a'), 'one')
+
+    def test_touch_interval(self):
+        cache = self.cache(max_entries=2)
+        cache.touch_interval = 60
+        cache.set('a', 'a')
+        time.sleep(0.01)
+        cache.set('b', 'b')
+        # 'a' was used too recently for the read to be recorded.
+        cache.get('a')
+        cache.set('c', 'c')
+        self.assertEquals(sorted(cache.get_many('abc')), ['b', 'c'])
+
+
+if __name__ == '__main__':
+    utils.log()
+    unittest.main()
@@ -0,0 +1,480 @@
+# Copyright (c) 2009-2010 Six Apart Ltd.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of Six Apart Ltd. nor the names of its contributors may
+#   be used to endorse or promote products derived from this software without
+#   specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import mmap
+from StringIO import StringIO
+import unittest
+
+from batchhttp import multipart
+from tests import utils
+
+
+BODY = ("preamble\r\n"
+    "--xyzzy\r\n"
+    "Content-Type: application/http-response\r\n"
+    "Multipart-Request-ID: 1\r\n"
+    "\r\n"
+    "200 OK\r\n"
+    "\r\n"
+    "--xyzzy-ish but not a boundary\r\n"
+    "--xyzzy   \r\n"
+    "Content-Type: application/http-response\r\n"
+    "Multipart-Request-ID: 2\r\n"
+    "\r\n"
+    "404 Not Found\r\n"
+    "\r\n"
+    "--xyzzy--\r\n"
+    "epilogue")
+
+PARTS = [
+    ([('content-type', 'application/http-response'),
+      ('multipart-request-id', '1')],
+     "200 OK\r\n"
+     "\r\n"
+     "--xyzzy-ish but not a boundary"),
+    ([('content-type', 'application/http-response'),
+      ('multipart-request-id', '2')],
+     "404 Not Found\r\n"),
+]
+
+
+def records(parts):
+    return [(part.headers, part.payload) for part in parts]
+
+
+class TestMultipartFeedParser(unittest.TestCase):
+
+    def feed_in_pieces(self, body, size):
+        parser = multipart.MultipartFeedParser('xyzzy')
+        parts = []
+        for i in range(0, len(body), size):
+            parts.extend(parser.feed(body[i:i+size]))
+        parser.close()
+        return records(parts)
+
+    def test_whole(self):
+        self.assertEquals(self.feed_in_pieces(BODY, len(BODY)), PARTS)
+
+    def test_pieces(self):
+        for size in (1, 2, 3, 7, 11, 64):
+            self.assertEquals(self.feed_in_pieces(BODY, size), PARTS)
+
+    def test_releases_parts(self):
+        parser = multipart.MultipartFeedParser('xyzzy')
+        end = BODY.index('--xyzzy   ')
+        self.assertEquals(records(parser.feed(BODY[:end+12])), PARTS[:1])
+        self.assertEquals(parser._buffer, '')
+
+    def test_no_preamble(self):
+        body = BODY[BODY.index('--xyzzy'):]
+        self.assertEquals(self.feed_in_pieces(body, 5), PARTS)
+
+    def test_unix_newlines(self):
+        body = BODY.replace('\r\n', '\n')
+        parts = [(headers, payload.replace('\r\n', '\n'))
+            for headers, payload in PARTS]
+        self.assertEquals(self.feed_in_pieces(body, 3), parts)
+
+    def test_truncated(self):
+        parser = multipart.MultipartFeedParser('xyzzy')
+        parser.feed(BODY[:BODY.index('404')])
+        self.assertRaises(multipart.ParserError, parser.close)
+
+
+    def test_spill(self):
+        payload = 'x' * 5000 + '\r\n--xyzzy-ish\r\n' + 'y' * 5000
+        body = BODY.replace("404 Not Found\r\n", payload)
+        parts = [PARTS[0], (PARTS[1][0], payload)]
+        for size in (7, 1000, len(body)):
+            parser = multipart.MultipartFeedParser('xyzzy', spill_threshold=200)
+            received = []
+            for i in range(0, len(body), size):
+                received.extend(parser.feed(body[i:i+size]))
+            parser.close()
+            self.assertEquals(records(received), parts)
+            self.failIf(isinstance(received[0].text, mmap.mmap))
+            # A part that arrives whole is already in memory, so isn't spilled.
+            self.assertEquals(isinstance(received[1].text, mmap.mmap),
+                size < len(body))
+
+
+    def test_large_part(self):
+        payload = 'x' * 50000 + '\r\n--xyzzy-ish\r\n' + 'y' * 50000
+        body = BODY.replace("404 Not Found\r\n", payload)
+        parser = multipart.MultipartFeedParser('xyzzy')
+        received = []
+        for i in range(0, len(body), 1000):
+            received.extend(parser.feed(body[i:i+1000]))
+            # The part being received isn't copied into the buffer with each
+            # piece; only enough to find a delimiter in is kept there.
+            self.assert_(len(parser._buffer) < 1000 + len('--xyzzy') + 2)
+        parser.close()
+        self.assertEquals(records(received), [PARTS[0], (PARTS[1][0], payload)])
+
+class TestParsing(unittest.TestCase):
+
+    def test_headers(self):
+        text = ("Content-Type: text/plain\r\n"
+            "X-Folded: one\r\n"
+            "\ttwo\r\n"
+            "\r\n"
+            "body")
+        headers, body_start = multipart.parse_headers(text)
+        self.assertEquals(headers, [('content-type', 'text/plain'),
+            ('x-folded', 'one two')])
+        self.assertEquals(text[body_start:], 'body')
+
+    def test_headers_without_blank_line(self):
+        text = "Content-Type: text/plain\nHTTP MIME Message\n--b\n"
+        headers, body_start = multipart.parse_headers(text)
+        self.assertEquals(headers, [('content-type', 'text/plain')])
+        self.assertEquals(text[body_start:], "HTTP MIME Message\n--b\n")
+
+    def test_content_type(self):
+        self.assertEquals(multipart.parse_content_type(
+            'Multipart/Parallel; boundary="=={{[[ a;b ]]}}=="; x=y'),
+            ('multipart/parallel', {'boundary': '=={{[[ a;b ]]}}==', 'x': 'y'}))
+        self.assertEquals(multipart.parse_content_type('garbage'),
+            ('text/plain', {}))
+
+    def test_part_payload(self):
+        part = multipart.Part([('content-transfer-encoding', 'quoted-printable')],
+            'caf=C3=A9 =3D ok=\r\n')
+        self.assertEquals(part.get_payload(decode=True), 'caf\xc3\xa9 = ok')
+        self.assertEquals(part.get_payload(), 'caf=C3=A9 =3D ok=\r\n')
+
+    def test_payload_view(self):
+        text = 'HTTP/1.1 200 OK\r\n\r\ncaf\xc3\xa9 = ok\r\n' * 100
+        encoded = multipart.encode_payload(text, 'quoted-printable')
+        self.assertEquals(''.join(multipart.decode_blocks(encoded,
+            'quoted-printable', blocksize=10)), text)
+
+        part = multipart.Part([('content-transfer-encoding', 'binary')],
+            'junk' + text + 'junk', 4, 4 + len(text))
+        view = part.payload_view()
+        self.assert_(view.data is part.text)
+        self.assertEquals(view.getvalue(), text)
+
+        part = multipart.Part([('content-transfer-encoding', 'quoted-printable')],
+            encoded)
+        self.assertEquals(part.payload_view().getvalue(), text)
+        view = part.payload_view(spill_threshold=100)
+        self.assert_(isinstance(view.data, mmap.mmap))
+        self.assertEquals(view.getvalue(), text)
+
+    def test_body_view(self):
+        view = multipart.BodyView('xxline one\nline two\nxx', 2, 18)
+        self.assertEquals(len(view), 18)
+        self.assertEquals(view.readline(), 'line one\n')
+        self.assertEquals(view.tell(), 9)
+        self.assertEquals(view.read(), 'line two\n')
+        self.assertEquals(view.read(), '')
+        view.seek(-4, 2)
+        self.assertEquals(view.read(2), 'tw')
+        view.seek(0)
+        self.assertEquals(list(view), ['line one\n', 'line two\n'])
+        self.assertEquals(str(view.getbuffer()), 'line one\nline two\n')
+        self.assertEquals(str(view), 'line one\nline two\n')
+
+    def test_http_parser(self):
+        msg = multipart.MultipartHTTPMessage()
+        msg.attach(multipart.HTTPRequestMessage(
+            "GET /users/1.json HTTP/1.1\r\nHost: example.com\r\n\r\n", 1))
+        msg.attach(multipart.HTTPRequestMessage(
+            "POST /users HTTP/1.1\r\nHost: example.com\r\n\r\nname=caf\xc3\xa9", 2))
+
+        parser = multipart.HTTPParser(msg.as_string())
+        self.assertEquals([r.request_id for r in parser.requests], ['1', '2'])
+        self.assertEquals([r.command for r in parser.requests], ['GET', 'POST'])
+        self.assertEquals(parser.requests[1].data, 'name=caf\xc3\xa9')
+        self.assertEquals(parser.requests[1].host, 'example.com')
+
+    def test_common_headers(self):
+        self.assertEquals(multipart.common_headers([
+            [('Host', 'example.com'), ('Accept', '*/*'), ('Content-Length', '0')],
+            [('host', 'example.com'), ('accept', 'text/plain'), ('content-length', '0')],
+            [('host', 'example.com'), ('x-a', '1'), ('x-a', '2'), ('content-length', '0')],
+        ]), [('host', 'example.com')])
+        self.assertEquals(multipart.common_headers([[('host', 'example.com')]]), [])
+
+    def test_shared_headers(self):
+        writer = multipart.MultipartWriter()
+        writer.add(multipart.SharedHeadersPart([('host', 'example.com'),
+            ('accept', 'application/json')]))
+        writer.add(multipart.HTTPRequestPart(
+            "GET /users/1.json HTTP/1.1\r\n\r\n", 1))
+        writer.add(multipart.HTTPRequestPart(
+            "GET http://example.org/x HTTP/1.1\r\nAccept: text/plain\r\n\r\n", 2))
+
+        parser = multipart.HTTPParser('Content-Type: %s\r\n\r\n%s'
+            % (writer.content_type, writer.getvalue()))
+        first, second = parser.requests
+        self.assertEquals(first.request_id, '1')
+        self.assertEquals(first.host, 'example.com')
+        self.assertEquals(dict(first.headers)['accept'], 'application/json')
+        self.assertEquals(second.host, 'example.org')
+        self.assertEquals(dict(second.headers)['accept'], 'text/plain')
+
+    def test_transfer_encodings(self):
+        request = "POST /x HTTP/1.1\r\nHost: example.com\r\n\r\n\x00\xff=\r\n"
+        for encoding in multipart.TRANSFER_ENCODINGS:
+            msg = multipart.MultipartHTTPMessage()
+            msg.attach(multipart.HTTPRequestMessage(request, 1, encoding))
+            text = msg.as_string()
+            if encoding == 'quoted-printable':
+                self.failIf('\xff' in text)
+            else:
+                self.assert_(request in text)
+
+            parsed = multipart.HTTPParser(text).requests[0]
+            self.assertEquals(parsed.transfer_encoding, encoding)
+            self.assertEquals(parsed.data, '\x00\xff=\r\n')
+
+        self.assertRaises(ValueError, multipart.HTTPRequestMessage, request, 1, 'rot13')
+
+
+class TestMultipartWriter(unittest.TestCase):
+
+    requests = [
+        ("GET /users/1.json HTTP/1.1\r\nHost: example.com\r\n\r\n", 'quoted-printable'),
+        ("POST /users HTTP/1.1\r\nHost: example.com\r\n\r\nname=caf\xc3\xa9", 'binary'),
+        ("PUT /x HTTP/1.1\r\n\r\n\x00\xff=\r\n", '8bit'),
+    ]
+
+    def test_matches_generator(self):
+        msg = multipart.MultipartHTTPMessage()
+        writer = multipart.MultipartWriter()
+        for id, (request, encoding) in enumerate(self.requests):
+            msg.attach(multipart.HTTPRequestMessage(request, id, encoding))
+            writer.add(multipart.HTTPRequestPart(request, id, encoding))
+
+        text = msg.as_string(write_headers=False)
+        self.assertEquals(writer.getvalue(),
+            text.replace(msg.get_boundary(), writer.boundary))
+        self.assertEquals(writer.length, len(writer.getvalue()))
+        self.assertEquals(writer.headers()['Content-Length'], str(writer.length))
+
+        parser = multipart.HTTPParser('Content-Type: %s\r\n\r\n%s'
+            % (writer.content_type, ''.join(writer.chunks())))
+        self.assertEquals([r.data for r in parser.requests],
+            ['', 'name=caf\xc3\xa9', '\x00\xff=\r\n'])
+
+    def test_trailing_cr(self):
+        head = "PUT /x HTTP/1.1\r\n\r\n"
+        for data in ('hello\xff\r', 'hello\xff\r\n', '\r', 'caf\xc3\xa9\r'):
+            request = head + data
+            for encoding in multipart.TRANSFER_ENCODINGS:
+                msg = multipart.MultipartHTTPMessage()
+                writer = multipart.MultipartWriter()
+                for id in range(2):
+                    msg.attach(multipart.HTTPRequestMessage(request, id, encoding))
+                    writer.add(multipart.HTTPRequestPart(request, id, encoding))
+                text = writer.getvalue()
+                self.assertEquals(msg.as_string(write_headers=False),
+                    text.replace(writer.boundary, msg.get_boundary()))
+                self.assertEquals(writer.length, len(text))
+
+                # A file body is encoded the same way.
+                filepart = multipart.HTTPRequestPart(head, 0, encoding,
+                    StringIO(data))
+                self.assertEquals(''.join(filepart.iterchunks()),
+                    ''.join(writer.parts[0].iterchunks()))
+
+                parser = multipart.HTTPParser('Content-Type: %s\r\n\r\n%s'
+                    % (writer.content_type, text))
+                self.assertEquals([r.data for r in parser.requests], [data, data])
+                for size in (1, 3, len(text)):
+                    feed = multipart.MultipartFeedParser(writer.boundary)
+                    parts = []
+                    for i in range(0, len(text), size):
+                        parts.extend(feed.feed(text[i:i+size]))
+                    feed.close()
+                    self.assertEquals([part.get_payload(decode=True)
+                        for part in parts], [request, request])
+
+    def test_empty(self):
+        writer = multipart.MultipartWriter()
+        self.assertEquals(writer.length, len(writer.getvalue()))
+        self.assertEquals(multipart.parse_multipart(writer.getvalue(),
+            writer.boundary), [])
+
+    def test_boundary_in_payload(self):
+        writer = multipart.MultipartWriter()
+        writer.add(multipart.HTTPRequestPart(self.requests[0][0], 1))
+        boundary = writer.boundary
+        request = "PUT /x HTTP/1.1\r\n\r\n--%s\r\n" % boundary
+        writer.add(multipart.HTTPRequestPart(request, 2, 'binary'))
+        self.assertNotEquals(writer.boundary, boundary)
+        self.assertEquals(len(writer.boundary), len(boundary))
+
+        parts = multipart.parse_multipart(writer.getvalue(), writer.boundary)
+        self.assertEquals([part.request_id for part in parts], ['1', '2'])
+        self.assertEquals(writer.length, len(writer.getvalue()))
+
+
+    def test_file_body(self):
+        head = "PUT /x HTTP/1.1\r\nHost: example.com\r\n\r\n"
+        body = 'caf\xc3\xa9 =  \nline two\r\n' * 3000 + 'x' * 100 + '\t'
+        for encoding in multipart.TRANSFER_ENCODINGS:
+            part = multipart.HTTPRequestPart(head + body, 1, encoding)
+            for fp in (StringIO(body), NonSeekable(body)):
+                filepart = multipart.HTTPRequestPart(head, 1, encoding, fp)
+                self.assertEquals(len(filepart), len(part))
+                self.assertEquals(''.join(filepart.iterchunks(100)),
+                    ''.join(part.iterchunks()))
+
+    def test_file_body_boundary(self):
+        writer = multipart.MultipartWriter()
+        boundary = writer.boundary
+        body = StringIO('x' * 70000 + '--' + boundary)
+        writer.add(multipart.HTTPRequestPart('PUT /x HTTP/1.1\r\n\r\n', 1,
+            'binary', body))
+        self.assertNotEquals(writer.boundary, boundary)
+        parts = multipart.parse_multipart(writer.getvalue(), writer.boundary)
+        self.assertEquals(len(parts), 1)
+
+    def test_body(self):
+        writer = multipart.MultipartWriter()
+        for id, (request, encoding) in enumerate(self.requests):
+            writer.add(multipart.HTTPRequestPart(request, id, encoding,
+                StringIO(request * 1000)))
+        text = writer.getvalue()
+
+        body = writer.open()
+        self.assertEquals(len(body), len(text))
+        self.assertEquals(body.read(0), '')
+        pieces = []
+        piece = body.read(8192)
+        while piece:
+            self.assert_(len(piece) <= 8192)
+            pieces.append(piece)
+            piece = body.read(8192)
+        self.assertEquals(''.join(pieces), text)
+
+        # Once read through, the body starts over.
+        self.assertEquals(body.read(), text)
+        self.assertEquals(body.read(), '')
+        body.read(10)
+        body.rewind()
+        self.assertEquals(body.read(), text)
+
+    def test_chunked_gzip_body(self):
+        writer = multipart.MultipartWriter()
+        for id, (request, encoding) in enumerate(self.requests):
+            writer.add(multipart.HTTPRequestPart(request * 1000, id, encoding))
+        body = multipart.ChunkedGzipBody(writer)
+        self.assertRaises(TypeError, len, body)
+
+        data = body.read()
+        compressed = []
+        while data:
+            eol = data.index('\r\n')
+            size = int(data[:eol], 16)
+            compressed.append(data[eol+2:eol+2+size])
+            self.assertEquals(data[eol+2+size:eol+4+size], '\r\n')
+            data = data[eol+4+size:]
+        self.assertEquals(compressed[-1], '')
+        self.assertEquals(multipart.gunzip(''.join(compressed)), writer.getvalue())
+
+
+class NonSeekable(object):
+
+    def __init__(self, data):
+        self.fp = StringIO(data)
+
+    def read(self, size=-1):
+        return self.fp.read(size)
+
+    def readlines(self, hint=-1):
+        return self.fp.readlines(hint)
+
+
+class TestHTTPMessages(unittest.TestCase):
+
+    def test_request(self):
+        body = '{"a": 1}\r\n\r\n' * 1000
+        request = multipart.HTTPRequest("PUT http://example.com/x HTTP/1.1\r\n"
+            "Content-Type: application/json\r\n"
+            "X-Folded: one\r\n"
+            " two\r\n"
+            "Content-Length: %d\r\n"
+            "\r\n%s" % (len(body), body), request_id='3')
+        self.assertEquals((request.command, request.path, request.version),
+            ('PUT', '/x', 'HTTP/1.1'))
+        self.assertEquals(request.host, 'example.com')
+        self.assertEquals(request.headers, [
+            ('content-type', 'application/json'),
+            ('x-folded', 'one\n two'),
+            ('content-length', str(len(body))),
+        ])
+        self.assertEquals(request.length, len(body))
+        self.assertEquals(request.content_type, 'application/json')
+        self.assertEquals(request.data, body)
+
+    def test_ie_post(self):
+        request = multipart.HTTPRequest("POST /x HTTP/1.1\r\n"
+            "\r\n"
+            "Host: example.com\r\n"
+            "\r\n"
+            "a=b")
+        self.assertEquals(request.headers, [('host', 'example.com')])
+        self.assertEquals(request.host, 'example.com')
+        self.assertEquals(request.data, 'a=b')
+
+        request = multipart.HTTPRequest("GET /x HTTP/1.1\r\n"
+            "\r\n"
+            "Host: example.com\r\n")
+        self.assertEquals(request.headers, [])
+        self.assertEquals(request.data, 'Host: example.com\r\n')
+
+    def test_bad_request(self):
+        self.assertRaises(multipart.BadRequestException,
+            multipart.HTTPRequest, "GET\r\n\r\n")
+
+    def test_response(self):
+        response = multipart.HTTPResponse("HTTP/1.1 200 OK\r\n"
+            "Content-Type: text/plain\r\n"
+            "ETag: \"7\"\r\n"
+            "\r\n"
+            "line one\r\n\r\nline two")
+        self.assertEquals((response.version, response.status, response.message),
+            ('HTTP/1.1', '200', 'OK'))
+        self.assertEquals(response.headers, [('content-type', 'text/plain'),
+            ('etag', '"7"')])
+        self.assertEquals(response.content_type, 'text/plain')
+        self.assertEquals(response.data, 'line one\r\n\r\nline two')
+
+        response = multipart.HTTPResponse("HTTP/1.1 204\r\n\r\n")
+        self.assertEquals(response.message, '')
+        self.assertEquals(response.data, '')
+
+
+if __name__ == '__main__':
+    utils.log()
+    unittest.main()
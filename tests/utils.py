@@ -27,14 +27,17 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import httplib
 import httplib2
 import logging
-import os
+import threading
 
 import mox
 import nose
 import nose.tools
 
+from batchhttp import multipart
+
 
 def todo(fn):
     @nose.tools.make_decorator(fn)
@@ -91,3 +94,145 @@ def mock_http(req, resp_or_content):
 def log():
     import sys
     logging.basicConfig(level=logging.DEBUG, stream=sys.stderr, format="%(asctime)s %(levelname)s %(message)s")
+
+
+class FakeResponse(httplib.HTTPResponse):
+
+    """An `httplib.HTTPResponse` stand-in that serves its content in pieces
+    of at most `piece` bytes, recording how much has been read."""
+
+    def __init__(self, status, headers, content, reason='', piece=None):
+        self.status = status
+        self.reason = reason
+        self.version = 11
+        self.headers = headers
+        self.content = content
+        self.piece = piece
+        self.position = 0
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, amt=None):
+        if amt is None or (self.piece is not None and amt > self.piece):
+            amt = self.piece
+        if amt is None:
+            amt = len(self.content)
+        data = self.content[self.position:self.position+amt]
+        self.position += len(data)
+        return data
+
+    def isclosed(self):
+        return self.position >= len(self.content)
+
+
+class FakeConnection(object):
+
+    """An `httplib.HTTPConnection` stand-in that records the requests made
+    of it and returns the given `FakeResponse` instances in order."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.closed = False
+
+    def request(self, method, uri, body=None, headers=None):
+        self.requests.append((method, uri, body, headers))
+
+    def getresponse(self):
+        return self.responses.pop(0)
+
+    def close(self):
+        self.closed = True
+
+
+class DictCache(dict):
+
+    """An `httplib2` cache kept in a dictionary."""
+
+    def set(self, key, value):
+        self[key] = value
+
+    def delete(self, key):
+        self.pop(key, None)
+
+
+def cache_entry(headers, content):
+    """Returns the text `httplib2` would cache for a response with the given
+    headers and content."""
+    headers = ''.join(['%s: %s\r\n' % item for item in headers.items()])
+    return 'status: 200\r\n%s\r\n%s' % (headers, content)
+
+
+def batch_processor(statuses=None, extensions=False):
+    """Returns a fake `BatchClient.request()` that answers each subrequest
+    with its path, and answers each batch with the status for its number
+    of subrequests from `statuses` (207 if it isn't in there).
+
+    If `extensions` is true, the fake batch processor supports the
+    ``shared-headers`` extension, and sends the subresponses' Content-Type
+    in a shared headers part when the batch request offers it.
+
+    The paths of the subrequests in each batch are recorded in the function's
+    `batches` attribute, and the body and headers of each subrequest in its
+    `bodies` and `headers` attributes, keyed by path.
+
+    """
+    batches = []
+    bodies = {}
+    subheaders = {}
+    lock = threading.Lock()
+
+    def request(uri, method, headers, body):
+        headers = dict([(k.lower(), v) for k, v in headers.items()])
+        if hasattr(body, 'read'):
+            body = body.read()
+        if headers.get('content-encoding') == 'gzip':
+            body = multipart.gunzip(body)
+        parser = multipart.HTTPParser('Content-Type: %s\r\n\r\n%s'
+            % (headers['content-type'], body))
+        lock.acquire()
+        try:
+            batches.append([r.path for r in parser.requests])
+            for r in parser.requests:
+                bodies[r.path] = r.data
+                subheaders[r.path] = dict(r.headers)
+        finally:
+            lock.release()
+
+        status = (statuses or {}).get(len(parser.requests), 207)
+        if status != 207:
+            return httplib2.Response({'status': str(status)}), 'oops'
+
+        if not extensions:
+            msg = multipart.MultipartHTTPMessage()
+            for r in parser.requests:
+                msg.attach(multipart.HTTPResponseMessage(
+                    '200 OK\r\nContent-Type: text/plain\r\n\r\n%s' % r.path,
+                    r.request_id))
+            content = msg.as_string(write_headers=False)
+            return httplib2.Response({
+                'status': '207',
+                'content-type': msg['content-type'],
+            }), content
+
+        writer = multipart.MultipartWriter()
+        template = '200 OK\r\nContent-Type: text/plain\r\n\r\n%s'
+        if 'shared-headers' in headers.get('batch-extensions', ''):
+            writer.add(multipart.SharedHeadersPart([('Content-Type', 'text/plain')]))
+            template = '200 OK\r\n\r\n%s'
+        for r in parser.requests:
+            writer.add(multipart.HTTPResponsePart(template % r.path, r.request_id))
+        return httplib2.Response({
+            'status': '207',
+            'content-type': writer.content_type,
+            'batch-extensions': 'shared-headers',
+        }), writer.getvalue()
+
+    request.batches = batches
+    request.bodies = bodies
+    request.headers = subheaders
+    return request